@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Compares the telemetry payload codecs in payload_codec.py: bytes on the wire per sample, and CPU
+# time per sample to build and encode the payloads on the device and to decode them in the cloud.
+# "json-iso" is the format the firmware used before codecs were selectable: default json.dumps
+# separators and ISO 8601 timestamps. Only the binary codecs can be compressed. Codecs whose
+# package is not installed are skipped.
+#
+# Samples are timestamped as the firmware would send them: one every --interval-ms, with timer
+# jitter. --values adds that many noisy sensor readings to each sample, like a bridged topic.
+
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import time
+
+containers_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(containers_dir, "common"))
+
+import payload_codec
+
+
+def make_sample(version, codec, sent_at, values):
+    # Same as MqttPublisher.timer_callback, sent_at is in epoch seconds
+    if codec in ("json", "json-iso"):
+        timestamp = datetime.datetime.fromtimestamp(sent_at, datetime.timezone.utc).isoformat()
+    else:
+        timestamp = int(sent_at * 1000)
+    sample = {"version": version, "timestamp": timestamp}
+    if values:
+        sample["values"] = values
+    return sample
+
+
+def make_send_times(count, interval, jitter):
+    start = time.time()
+    return [start + index * interval + random.gauss(0, jitter) for index in range(count)]
+
+
+def make_values(count, value_count):
+    # Readings that drift slowly with sensor noise on top, rounded like a real sensor's output
+    levels = [random.uniform(-10, 10) for _ in range(value_count)]
+    readings = []
+    for _ in range(count):
+        levels = [level + random.gauss(0, 0.05) for level in levels]
+        readings.append([round(level + random.gauss(0, 0.2), 4) for level in levels])
+    return readings
+
+
+def encode(samples, version, codec, compress):
+    # Same as TelemetryPipeline.encode
+    message = (
+        samples[0]
+        if len(samples) == 1
+        else {"version": version, "timestamp": samples[-1]["timestamp"], "samples": samples}
+    )
+    if codec == "json-iso":
+        return json.dumps(message)
+    return payload_codec.encode(message, codec, compress and len(samples) > 1)
+
+
+def bench_codec(codec, compress, batch_size, send_times, readings):
+    version = "3"
+    payloads = []
+    start = time.perf_counter()
+    for index in range(0, len(send_times) - batch_size + 1, batch_size):
+        samples = [
+            make_sample(version, codec, send_times[sample_index], readings[sample_index])
+            for sample_index in range(index, index + batch_size)
+        ]
+        payloads.append(encode(samples, version, codec, compress))
+    encode_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for payload in payloads:
+        payload_codec.decode(payload)
+    decode_seconds = time.perf_counter() - start
+
+    samples = len(payloads) * batch_size
+    total_bytes = sum(
+        len(payload.encode("utf-8") if isinstance(payload, str) else payload)
+        for payload in payloads
+    )
+    return {
+        "codec": codec + ("+zlib" if compress else ""),
+        "batch_size": batch_size,
+        "bytes_per_sample": total_bytes / samples,
+        "encode_us_per_sample": encode_seconds / samples * 1e6,
+        "decode_us_per_sample": decode_seconds / samples * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the telemetry payload codecs")
+    parser.add_argument("--samples", type=int, default=100000)
+    parser.add_argument("--batch-sizes", default="1,10,100")
+    parser.add_argument("--interval-ms", type=float, default=5000, help="firmware publish interval")
+    parser.add_argument("--jitter-ms", type=float, default=20, help="timer jitter, std deviation")
+    parser.add_argument("--values", type=int, default=0, help="sensor readings per sample")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    codecs = ["json-iso"]
+    for codec in payload_codec.CODECS:
+        try:
+            payload_codec.check_codec(codec)
+            codecs.append(codec)
+        except payload_codec.PayloadError as e:
+            print(f"Skipping {codec}: {e}")
+
+    # Every codec encodes the same samples
+    random.seed(args.seed)
+    send_times = make_send_times(args.samples, args.interval_ms / 1000, args.jitter_ms / 1000)
+    readings = make_values(args.samples, args.values)
+
+    results = []
+    for batch_size in [int(size) for size in args.batch_sizes.split(",")]:
+        for codec in codecs:
+            results.append(bench_codec(codec, False, batch_size, send_times, readings))
+            if batch_size > 1 and codec not in ("json-iso", "json"):
+                results.append(bench_codec(codec, True, batch_size, send_times, readings))
+
+    print(f"{'codec':<16}{'batch':>6}{'bytes/sample':>14}{'encode us':>12}{'decode us':>12}")
+    for result in results:
+        print(
+            f"{result['codec']:<16}{result['batch_size']:>6}{result['bytes_per_sample']:>14.1f}"
+            f"{result['encode_us_per_sample']:>12.2f}{result['decode_us_per_sample']:>12.2f}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Benchmarks the firmware update path against the in-process fakes in fakes.py:
+#  - the firmware's ConnectionHelper connecting through a fake discovery endpoint
+#  - the agent's job handlers and job_handler_callback serving N simulated devices
+# and reports latency percentiles and throughput. Results can be saved with --output and compared
+# against a previous run with --baseline, which exits non-zero on a regression.
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+containers_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [
+    os.path.join(containers_dir, "common"),
+    os.path.join(containers_dir, "device", "agent"),
+    os.path.join(containers_dir, "ros-image-v1", "ws", "src", "service"),
+]
+
+import mqtt5_connection
+import payload_codec
+import retry_policy
+
+# The firmware image copies the modules in "common" into its package at build time
+sys.modules["service.retry_policy"] = retry_policy
+sys.modules["service.payload_codec"] = payload_codec
+sys.modules["service.mqtt5_connection"] = mqtt5_connection
+# Every run starts with empty job journals
+os.environ["JOB_JOURNAL_DIR"] = tempfile.mkdtemp(prefix="bench-journal-")
+
+import agent
+from async_job_handler import AsyncJobHandler
+from docker_runtime import DockerRuntime
+from job_handler import JobHandler
+from service import connection_helper
+from fakes import FakeBroker, FakeDiscovery, FakeDockerClient, FakeJobsService, FakeMqttConnection
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(values):
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "p50_ms": percentile(values, 0.5) * 1000,
+        "p95_ms": percentile(values, 0.95) * 1000,
+        "max_ms": max(values) * 1000,
+    }
+
+
+def bench_connection(args):
+    broker = FakeBroker(args.broker_latency_ms / 1000)
+    discovery = FakeDiscovery(
+        broker,
+        core_count=args.cores,
+        unreachable_count=args.unreachable,
+        failures=args.discovery_failures,
+        latency=args.discovery_latency_ms / 1000,
+    )
+    logger = logging.getLogger("connection_helper")
+    durations = []
+    with tempfile.NamedTemporaryFile("w", suffix=".json") as config_file:
+        json.dump(
+            {
+                "certificatePath": "device.pem.crt",
+                "privateKeyPath": "private.pem.key",
+                "rootCAPath": "AmazonRootCA1.pem",
+                "region": "us-east-1",
+                "retryAttempts": args.discovery_failures + 2,
+                "retryWaitTime": 0.01,
+                "retryMaxWaitTime": 0.1,
+            },
+            config_file,
+        )
+        config_file.flush()
+        with discovery.patch(connection_helper):
+            for run in range(args.connect_runs):
+                # Every run starts from a healthy discovery endpoint apart from the failures
+                discovery.discover_calls = 0
+                start = time.monotonic()
+                helper = connection_helper.ConnectionHelper(
+                    logger, config_file.name, f"bench-firmware-{run}", discover_endpoints=True
+                )
+                durations.append(time.monotonic() - start)
+                helper.mqtt_conn.disconnect()
+    broker.stop()
+    return {"connect": summarize(durations)}
+
+
+def connect_device(broker, device_agent):
+    # The agent's job handlers are handed connections that are already connected
+    mqtt_connection = FakeMqttConnection(broker, device_agent.agent_thing_name)
+    mqtt_connection.connect().result()
+    return mqtt_connection
+
+
+def run_threaded_handlers(args, broker, device_agents, stop_event):
+    job_handlers = []
+    threads = []
+    for device_agent in device_agents:
+        mqtt_connection = connect_device(broker, device_agent)
+        device_agent.start(mqtt_connection)
+        job_handler = JobHandler(
+            device_agent.agent_thing_name,
+            mqtt_connection,
+            device_agent.job_handler_callback,
+            device_agent.job_prefetch_callback,
+            pipeline_depth=args.pipeline_depth,
+            journal=device_agent.journal,
+        )
+        job_handlers.append(job_handler)
+        thread = threading.Thread(target=job_handler.run, name="bench_job_handler")
+        thread.start()
+        threads.append(thread)
+
+    stop_event.wait()
+    for job_handler in job_handlers:
+        job_handler.exit("Benchmark done")
+    for thread in threads:
+        thread.join()
+
+
+def run_asyncio_handlers(args, broker, device_agents, stop_event):
+    # Same layout as agent.run_multiple_devices
+    connection_count = max(1, min(args.connections, len(device_agents)))
+    mqtt_connections = [
+        connect_device(broker, device_agent) for device_agent in device_agents[:connection_count]
+    ]
+    executor = ThreadPoolExecutor(max_workers=args.job_workers, thread_name_prefix="job_worker")
+    job_handlers = []
+    for index, device_agent in enumerate(device_agents):
+        mqtt_connection = mqtt_connections[index % connection_count]
+        device_agent.start(mqtt_connection)
+        job_handlers.append(
+            AsyncJobHandler(
+                device_agent.agent_thing_name,
+                mqtt_connection,
+                device_agent.job_handler_callback,
+                device_agent.job_prefetch_callback,
+                executor=executor,
+                owns_connection=False,
+                journal=device_agent.journal,
+            )
+        )
+
+    async def run_job_handlers():
+        runs = asyncio.gather(*(job_handler.run_async() for job_handler in job_handlers))
+        await asyncio.get_running_loop().run_in_executor(None, stop_event.wait)
+        for job_handler in job_handlers:
+            job_handler.exit("Benchmark done")
+        await runs
+        for mqtt_connection in mqtt_connections:
+            await asyncio.wrap_future(mqtt_connection.disconnect())
+
+    asyncio.run(run_job_handlers())
+    executor.shutdown()
+
+
+def bench_jobs(args):
+    broker = FakeBroker(args.broker_latency_ms / 1000)
+    jobs_service = FakeJobsService(broker)
+    docker_client = FakeDockerClient(
+        pull_latency=args.pull_ms / 1000,
+        run_latency=args.run_ms / 1000,
+        stop_latency=args.stop_ms / 1000,
+        broker=broker,
+        boot_latency=args.boot_ms / 1000,
+    )
+
+    agent.runtime = DockerRuntime(client_factory=lambda: docker_client)
+    agent.cutover_mode = args.cutover
+    agent.readiness_timeout = args.timeout
+    agent.standby_window = args.standby_window
+    agent.image_pulls.clear()
+    agent.runtime.start()
+
+    device_agents = [agent.FirmwareAgent(f"bench-device-{index}") for index in range(args.devices)]
+    jobs = []
+    for job_index in range(args.jobs):
+        for device_agent in device_agents:
+            job_document = {"operation": "Deploy-ROS-Firmware", "version": f"bench-{job_index}"}
+            jobs.append(
+                jobs_service.add_job(
+                    device_agent.agent_thing_name, f"bench-job-{job_index}", job_document
+                )
+            )
+
+    stop_event = threading.Event()
+    run_handlers = run_asyncio_handlers if args.engine == "asyncio" else run_threaded_handlers
+    handlers_thread = threading.Thread(
+        target=run_handlers, args=(args, broker, device_agents, stop_event), name="bench_handlers"
+    )
+    handlers_thread.start()
+    is_done = jobs_service.all_done.wait(args.timeout)
+    stop_event.set()
+    handlers_thread.join()
+    agent.runtime.stop()
+    broker.stop()
+
+    received_to_running = []
+    running_to_acknowledged = []
+    received_to_acknowledged = []
+    failed = 0
+    for job in jobs:
+        if job.status != "SUCCEEDED":
+            failed += 1
+            continue
+        device_name = job.thing_name[: -len("-agent")]
+        container_name = f"{device_name}-firmware-{job.job_document['version']}"
+        running_at = docker_client.started_at[container_name]
+        received_to_running.append(running_at - job.started_at)
+        running_to_acknowledged.append(job.completed_at - running_at)
+        received_to_acknowledged.append(job.completed_at - job.started_at)
+
+    completed = [job for job in jobs if job.completed_at is not None]
+    elapsed = 0
+    if completed:
+        elapsed = max(job.completed_at for job in completed) - min(
+            job.started_at for job in completed
+        )
+    return {
+        "received_to_running": summarize(received_to_running),
+        "running_to_acknowledged": summarize(running_to_acknowledged),
+        "received_to_acknowledged": summarize(received_to_acknowledged),
+        "jobs": len(jobs),
+        "failed_jobs": failed,
+        "timed_out": not is_done,
+        "jobs_per_second": len(completed) / elapsed if elapsed else 0,
+        "image_pulls": docker_client.pull_count,
+    }
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    regressions = []
+    for name, summary in baseline["metrics"].items():
+        current = results["metrics"].get(name, {})
+        if "p95_ms" in summary and current.get("p95_ms", 0) > summary["p95_ms"] * (1 + tolerance):
+            regressions.append(
+                f"{name} p95 {current['p95_ms']:.1f}ms, baseline {summary['p95_ms']:.1f}ms"
+            )
+    if results["jobs_per_second"] < baseline["jobs_per_second"] * (1 - tolerance):
+        regressions.append(
+            f"{results['jobs_per_second']:.1f} jobs/s, baseline {baseline['jobs_per_second']:.1f}"
+        )
+    return regressions
+
+
+def print_results(results):
+    print(f"{'metric':<28}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}")
+    for name, summary in results["metrics"].items():
+        if summary["count"]:
+            print(
+                f"{name:<28}{summary['count']:>8}{summary['p50_ms']:>10.1f}"
+                f"{summary['p95_ms']:>10.1f}{summary['max_ms']:>10.1f}"
+            )
+        else:
+            print(f"{name:<28}{0:>8}")
+    print(
+        f"{results['jobs']} jobs on {results['devices']} devices ({results['engine']}, "
+        f"{results['cutover']}): {results['jobs_per_second']:.1f} jobs/s, "
+        f"{results['failed_jobs']} failed, {results['image_pulls']} image pulls"
+    )
+    if results["timed_out"]:
+        print("Timed out before every job completed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the firmware update path")
+    parser.add_argument("--devices", type=int, default=10)
+    parser.add_argument("--jobs", type=int, default=5, help="jobs queued per device")
+    parser.add_argument("--engine", choices=["threaded", "asyncio"], default="threaded")
+    parser.add_argument("--cutover", choices=["stop-start", "blue-green"], default="stop-start")
+    parser.add_argument("--pipeline-depth", type=int, default=0)
+    parser.add_argument(
+        "--standby-window", type=float, default=0, help="seconds the previous firmware is paused"
+    )
+    parser.add_argument("--connections", type=int, default=1, help="asyncio engine only")
+    parser.add_argument("--job-workers", type=int, default=4, help="asyncio engine only")
+    parser.add_argument("--broker-latency-ms", type=float, default=1)
+    parser.add_argument("--pull-ms", type=float, default=50)
+    parser.add_argument("--run-ms", type=float, default=20)
+    parser.add_argument("--stop-ms", type=float, default=10)
+    parser.add_argument("--boot-ms", type=float, default=20)
+    parser.add_argument("--connect-runs", type=int, default=20)
+    parser.add_argument("--cores", type=int, default=1)
+    parser.add_argument("--unreachable", type=int, default=1, help="dead addresses per core")
+    parser.add_argument("--discovery-failures", type=int, default=0)
+    parser.add_argument("--discovery-latency-ms", type=float, default=5)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare the results to this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    # The agent logs every step of every job
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.CRITICAL)
+    connection_results = bench_connection(args)
+    job_results = bench_jobs(args)
+
+    results = {
+        "devices": args.devices,
+        "engine": args.engine,
+        "cutover": args.cutover,
+        "metrics": dict(
+            connection_results,
+            **{
+                name: job_results.pop(name)
+                for name in (
+                    "received_to_running",
+                    "running_to_acknowledged",
+                    "received_to_acknowledged",
+                )
+            },
+        ),
+        **job_results,
+    }
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+    if results["failed_jobs"] or results["timed_out"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,621 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# In-process stand-ins for the Greengrass core (MQTT broker and IoT Jobs service), the docker
+# daemon and Greengrass discovery, so that the agent and firmware code can be benchmarked without
+# any network or cloud access.
+
+import heapq
+import itertools
+import json
+import threading
+import time
+import traceback
+import uuid
+from awscrt import mqtt
+from awsiot.greengrass_discovery import DiscoverResponse
+from concurrent.futures import Future
+from unittest import mock
+import docker
+
+TERMINAL_JOB_STATUSES = {"SUCCEEDED", "FAILED", "REJECTED", "REMOVED", "CANCELED", "TIMED_OUT"}
+# Shape of the images pulled from the fake registry
+FAKE_LAYER_COUNT = 3
+FAKE_LAYER_SIZE = 10 * 1024 * 1024
+
+
+def topic_matches(topic_filter, topic):
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    for index, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if index >= len(topic_levels):
+            return False
+        if level != "+" and level != topic_levels[index]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+def completed_future(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def failed_future(exception):
+    future = Future()
+    future.set_exception(exception)
+    return future
+
+
+class FakeBroker:
+    # Routes messages between fake connections. Messages are delivered one at a time on a single
+    # dispatch thread after the configured latency, like the awscrt event loop thread would.
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.subscriptions = []  # (topic filter, callback)
+        self.condition = threading.Condition()
+        self.queue = []  # heap of (due time, sequence, callback, topic, payload)
+        self.sequence = itertools.count()
+        self.is_stopping = False
+        self.delivered = 0
+        self.dispatch_thread = threading.Thread(
+            target=self.dispatch_thread_fn, name="fake_broker", daemon=True
+        )
+        self.dispatch_thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.is_stopping = True
+            self.condition.notify()
+        self.dispatch_thread.join()
+
+    def subscribe(self, topic_filter, callback):
+        with self.lock:
+            self.subscriptions.append((topic_filter, callback))
+
+    def unsubscribe(self, topic_filter, callback=None):
+        with self.lock:
+            self.subscriptions = [
+                (subscribed_filter, subscribed_callback)
+                for subscribed_filter, subscribed_callback in self.subscriptions
+                if subscribed_filter != topic_filter
+                or (callback is not None and subscribed_callback is not callback)
+            ]
+
+    def publish(self, topic, payload):
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        with self.lock:
+            callbacks = [
+                callback
+                for topic_filter, callback in self.subscriptions
+                if topic_matches(topic_filter, topic)
+            ]
+        due = time.monotonic() + self.latency
+        with self.condition:
+            for callback in callbacks:
+                heapq.heappush(self.queue, (due, next(self.sequence), callback, topic, payload))
+            self.condition.notify()
+
+    def dispatch_thread_fn(self):
+        while True:
+            with self.condition:
+                while not self.is_stopping:
+                    now = time.monotonic()
+                    if self.queue and self.queue[0][0] <= now:
+                        break
+                    self.condition.wait(self.queue[0][0] - now if self.queue else None)
+                if self.is_stopping:
+                    return
+                _, _, callback, topic, payload = heapq.heappop(self.queue)
+            try:
+                callback(
+                    topic=topic,
+                    payload=payload,
+                    dup=False,
+                    qos=mqtt.QoS.AT_LEAST_ONCE,
+                    retain=False,
+                )
+            except Exception:
+                traceback.print_exc()
+            self.delivered += 1
+
+
+class FakeMqttConnection(mqtt.Connection):
+    # Subclasses mqtt.Connection because the awsiot service clients check for it. The native
+    # connection is never created, every operation goes straight to the fake broker.
+    def __init__(self, broker, client_id, fail_connect=None, **kwargs):
+        self.broker = broker
+        self.client_id = client_id
+        self.fail_connect = fail_connect
+        self.is_connected = False
+        self.subscriptions = {}  # topic filter -> callback registered with the broker
+        self.packet_ids = itertools.count(1)
+
+    def connect(self):
+        if self.fail_connect:
+            return failed_future(self.fail_connect)
+        self.is_connected = True
+        return completed_future({"return_code": 0, "session_present": False})
+
+    def disconnect(self):
+        # Messages already queued by the broker are dropped rather than delivered
+        self.is_connected = False
+        for topic, callback in self.subscriptions.items():
+            self.broker.unsubscribe(topic, callback)
+        self.subscriptions = {}
+        return completed_future({})
+
+    def subscribe(self, topic, qos, callback=None):
+        def on_message(**kwargs):
+            if self.is_connected:
+                callback(**kwargs)
+
+        self.unsubscribe(topic)
+        self.broker.subscribe(topic, on_message)
+        self.subscriptions[topic] = on_message
+        packet_id = next(self.packet_ids)
+        return completed_future({"packet_id": packet_id, "topic": topic, "qos": qos}), packet_id
+
+    def unsubscribe(self, topic):
+        callback = self.subscriptions.pop(topic, None)
+        if callback:
+            self.broker.unsubscribe(topic, callback)
+        packet_id = next(self.packet_ids)
+        return completed_future({"packet_id": packet_id}), packet_id
+
+    def publish(self, topic, payload, qos, retain=False):
+        self.broker.publish(topic, payload)
+        packet_id = next(self.packet_ids)
+        return completed_future({"packet_id": packet_id}), packet_id
+
+
+class FakeJob:
+    def __init__(self, thing_name, job_id, job_document):
+        self.thing_name = thing_name
+        self.job_id = job_id
+        self.job_document = job_document
+        self.status = "QUEUED"
+        self.status_details = None
+        self.version_number = 1
+        self.queued_at = time.time()
+        # Monotonic times of when the job was handed out by start-next and when it completed
+        self.started_at = None
+        self.completed_at = None
+
+    def summary(self):
+        return {
+            "jobId": self.job_id,
+            "queuedAt": self.queued_at,
+            "lastUpdatedAt": time.time(),
+            "versionNumber": self.version_number,
+            "executionNumber": 1,
+        }
+
+    def execution(self):
+        return dict(
+            self.summary(),
+            thingName=self.thing_name,
+            status=self.status,
+            statusDetails=self.status_details,
+            jobDocument=self.job_document,
+        )
+
+
+class FakeJobsService:
+    # Implements the IoT Jobs MQTT API on the fake broker: get pending, start-next, describe and
+    # update requests, plus the notify and notify-next events.
+    def __init__(self, broker):
+        self.broker = broker
+        self.lock = threading.Lock()
+        self.jobs = {}  # thing name -> list of FakeJob, in queue order
+        self.pending_count = 0
+        self.all_done = threading.Event()
+        broker.subscribe("$aws/things/+/jobs/#", self.on_request)
+
+    def add_job(self, thing_name, job_id, job_document):
+        job = FakeJob(thing_name, job_id, job_document)
+        with self.lock:
+            self.jobs.setdefault(thing_name, []).append(job)
+            self.pending_count += 1
+            self.all_done.clear()
+            is_next = self.next_job(thing_name) is job
+        self.notify(thing_name, is_next)
+        return job
+
+    def all_jobs(self):
+        with self.lock:
+            return [job for jobs in self.jobs.values() for job in jobs]
+
+    def next_job(self, thing_name):
+        pending = [job for job in self.jobs.get(thing_name, []) if job.status == "IN_PROGRESS"]
+        pending += [job for job in self.jobs.get(thing_name, []) if job.status == "QUEUED"]
+        return pending[0] if pending else None
+
+    def find_job(self, thing_name, job_id):
+        for job in self.jobs.get(thing_name, []):
+            if job.job_id == job_id:
+                return job
+        return None
+
+    def respond(self, topic, payload):
+        payload["timestamp"] = time.time()
+        self.broker.publish(topic, json.dumps(payload))
+
+    def notify(self, thing_name, next_changed):
+        with self.lock:
+            jobs = self.jobs.get(thing_name, [])
+            summaries = {
+                status: [job.summary() for job in jobs if job.status == status]
+                for status in ("IN_PROGRESS", "QUEUED")
+            }
+            next_job = self.next_job(thing_name)
+            next_execution = next_job.execution() if next_job else None
+        self.respond(f"$aws/things/{thing_name}/jobs/notify", {"jobs": summaries})
+        if next_changed:
+            payload = {"execution": next_execution} if next_execution else {}
+            self.respond(f"$aws/things/{thing_name}/jobs/notify-next", payload)
+
+    def on_request(self, topic, payload, **kwargs):
+        levels = topic.split("/")
+        thing_name = levels[2]
+        operation = levels[4:]
+        # Responses and events published by this service also match the subscription
+        if operation == ["get"]:
+            handler = self.on_get_pending
+        elif operation == ["start-next"]:
+            handler = self.on_start_next
+        elif len(operation) == 2 and operation[1] == "update":
+            handler = self.on_update
+        elif len(operation) == 2 and operation[1] == "get":
+            handler = self.on_describe
+        else:
+            return
+        request = json.loads(payload) if payload else {}
+        handler(topic, thing_name, operation[0], request)
+
+    def on_get_pending(self, topic, thing_name, job_id, request):
+        with self.lock:
+            jobs = self.jobs.get(thing_name, [])
+            response = {
+                "clientToken": request.get("clientToken"),
+                "inProgressJobs": [job.summary() for job in jobs if job.status == "IN_PROGRESS"],
+                "queuedJobs": [job.summary() for job in jobs if job.status == "QUEUED"],
+            }
+        self.respond(f"{topic}/accepted", response)
+
+    def on_start_next(self, topic, thing_name, job_id, request):
+        response = {"clientToken": request.get("clientToken")}
+        with self.lock:
+            job = self.next_job(thing_name)
+            if job:
+                if job.status == "QUEUED":
+                    job.status = "IN_PROGRESS"
+                    job.version_number += 1
+                    job.started_at = time.monotonic()
+                job.status_details = request.get("statusDetails")
+                response["execution"] = job.execution()
+        self.respond(f"{topic}/accepted", response)
+
+    def on_describe(self, topic, thing_name, job_id, request):
+        with self.lock:
+            job = self.find_job(thing_name, job_id)
+            execution = job.execution() if job else None
+        if execution is None:
+            self.reject(topic, request, "ResourceNotFound", f"Job {job_id} not found")
+            return
+        self.respond(
+            f"{topic}/accepted", {"clientToken": request.get("clientToken"), "execution": execution}
+        )
+
+    def on_update(self, topic, thing_name, job_id, request):
+        with self.lock:
+            job = self.find_job(thing_name, job_id)
+            if job is None or job.status in TERMINAL_JOB_STATUSES:
+                error = ("ResourceNotFound" if job is None else "TerminalStateReached", job_id)
+            elif request.get("expectedVersion") not in (None, job.version_number):
+                error = ("VersionMismatch", job.version_number)
+            else:
+                error = None
+                job.status = request.get("status", job.status)
+                job.status_details = request.get("statusDetails", job.status_details)
+                job.version_number += 1
+                is_terminal = job.status in TERMINAL_JOB_STATUSES
+                if is_terminal:
+                    job.completed_at = time.monotonic()
+                    self.pending_count -= 1
+                    if self.pending_count == 0:
+                        self.all_done.set()
+                execution_state = {
+                    "status": job.status,
+                    "statusDetails": job.status_details,
+                    "versionNumber": job.version_number,
+                }
+        if error:
+            self.reject(topic, request, error[0], f"Cannot update job ({error[1]})")
+            return
+        self.respond(
+            f"{topic}/accepted",
+            {"clientToken": request.get("clientToken"), "executionState": execution_state},
+        )
+        if is_terminal:
+            self.notify(thing_name, True)
+
+    def reject(self, topic, request, code, message):
+        self.respond(
+            f"{topic}/rejected",
+            {"clientToken": request.get("clientToken"), "code": code, "message": message},
+        )
+
+
+class FakeEventStream:
+    # Stands in for the docker events stream. The index is kept up to date by DockerRuntime itself,
+    # so no events are ever produced.
+    def __init__(self):
+        self.closed = threading.Event()
+
+    def __iter__(self):
+        self.closed.wait()
+        return iter(())
+
+    def close(self):
+        self.closed.set()
+
+
+class FakeContainer:
+    def __init__(self, client, image_ref, name, labels, environment):
+        self.client = client
+        self.id = uuid.uuid4().hex
+        self.image_ref = image_ref
+        self.name = name
+        self.labels = labels
+        self.environment = environment or {}
+        self.status = "created"
+
+    @property
+    def attrs(self):
+        # Same shape as the sparse container list entries
+        return {
+            "Id": self.id,
+            "Names": [f"/{self.name}"],
+            "Labels": self.labels,
+            "State": self.status,
+            "Image": self.image_ref,
+        }
+
+    def start(self):
+        time.sleep(self.client.run_latency)
+        self.status = "running"
+        self.client.on_container_started(self)
+
+    def restart(self):
+        time.sleep(self.client.stop_latency)
+        self.start()
+
+    def stop(self):
+        time.sleep(self.client.stop_latency)
+        self.status = "exited"
+
+    def pause(self):
+        self.status = "paused"
+
+    def unpause(self):
+        self.status = "running"
+
+    def remove(self):
+        with self.client.lock:
+            if self.status == "running":
+                raise docker.errors.APIError(f"Conflict: container {self.name} is running")
+            del self.client.containers_by_id[self.id]
+
+
+class FakeContainerCollection:
+    def __init__(self, client):
+        self.client = client
+
+    def list(self, all=False, sparse=False, filters=None):
+        labels = (filters or {}).get("label", [])
+        with self.client.lock:
+            containers = list(self.client.containers_by_id.values())
+        return [
+            container
+            for container in containers
+            if (all or container.status == "running")
+            and all_labels_present(labels, container.labels)
+        ]
+
+    def run(self, image_ref, name=None, labels=None, environment=None, **kwargs):
+        with self.client.lock:
+            if image_ref not in self.client.images_by_tag:
+                raise docker.errors.ImageNotFound(f"No such image: {image_ref}")
+            if any(container.name == name for container in self.client.containers_by_id.values()):
+                raise docker.errors.APIError(f"Conflict: container name {name} is already in use")
+            container = FakeContainer(self.client, image_ref, name, labels or {}, environment)
+            self.client.containers_by_id[container.id] = container
+        container.start()
+        return container
+
+    def prepare_model(self, attrs):
+        with self.client.lock:
+            return self.client.containers_by_id[attrs["Id"]]
+
+
+def all_labels_present(labels, container_labels):
+    return all(label.split("=")[0] in container_labels for label in labels)
+
+
+class FakeImage:
+    def __init__(self, image_ref):
+        self.id = f"sha256:{uuid.uuid4().hex}"
+        self.tags = [image_ref]
+        self.created = int(time.time())
+
+
+class FakeImageCollection:
+    def __init__(self, client):
+        self.client = client
+
+    def get(self, image_ref):
+        with self.client.lock:
+            return self.client.images_by_tag[image_ref]
+
+    def remove(self, image_ref):
+        with self.client.lock:
+            if any(c.image_ref == image_ref for c in self.client.containers_by_id.values()):
+                raise docker.errors.APIError(f"Conflict: image {image_ref} is in use")
+            del self.client.images_by_tag[image_ref]
+
+
+class FakeApiClient:
+    def __init__(self, client):
+        self.client = client
+
+    def pull(self, repository, tag=None, stream=False, decode=False):
+        # Streams progress messages for a few layers, spread over the pull latency
+        image_ref = f"{repository}:{tag}"
+        layer_ids = [uuid.uuid4().hex[:12] for _ in range(FAKE_LAYER_COUNT)]
+        for layer_id in layer_ids:
+            yield {"status": "Pulling fs layer", "id": layer_id}
+        for layer_id in layer_ids:
+            time.sleep(self.client.pull_latency / FAKE_LAYER_COUNT)
+            detail = {"current": FAKE_LAYER_SIZE, "total": FAKE_LAYER_SIZE}
+            yield {"status": "Downloading", "progressDetail": detail, "id": layer_id}
+            yield {"status": "Pull complete", "id": layer_id}
+        with self.client.lock:
+            self.client.images_by_tag[image_ref] = FakeImage(image_ref)
+            self.client.pull_count += 1
+        yield {"status": f"Downloaded newer image for {image_ref}"}
+
+    def images(self):
+        with self.client.lock:
+            return [
+                {"Id": image.id, "RepoTags": image.tags}
+                for image in self.client.images_by_tag.values()
+            ]
+
+
+class FakeDockerClient:
+    # Enough of docker.DockerClient for DockerRuntime. When given a broker, every container that
+    # starts "boots" after boot_latency and publishes one firmware message with the version of its
+    # image, which is what the agent waits for in blue-green mode.
+    def __init__(
+        self, pull_latency=0.0, run_latency=0.0, stop_latency=0.0, broker=None, boot_latency=0.0
+    ):
+        self.pull_latency = pull_latency
+        self.run_latency = run_latency
+        self.stop_latency = stop_latency
+        self.broker = broker
+        self.boot_latency = boot_latency
+        self.lock = threading.Lock()
+        self.containers_by_id = {}
+        self.images_by_tag = {}
+        self.pull_count = 0
+        # Container name -> monotonic time it was last started
+        self.started_at = {}
+        self.containers = FakeContainerCollection(self)
+        self.images = FakeImageCollection(self)
+        self.api = FakeApiClient(self)
+
+    def ping(self):
+        return True
+
+    def df(self):
+        # Every image is FAKE_LAYER_COUNT unshared layers, and containers write nothing
+        with self.lock:
+            images = list(self.images_by_tag.values())
+            containers = list(self.containers_by_id.values())
+        image_size = FAKE_LAYER_COUNT * FAKE_LAYER_SIZE
+        return {
+            "LayersSize": image_size * len(images),
+            "Images": [
+                {
+                    "Id": image.id,
+                    "RepoTags": list(image.tags),
+                    "Created": image.created,
+                    "Size": image_size,
+                    "SharedSize": 0,
+                }
+                for image in images
+            ],
+            "Containers": [
+                {"Names": [f"/{container.name}"], "SizeRw": 0} for container in containers
+            ],
+        }
+
+    def events(self, decode=False, filters=None):
+        return FakeEventStream()
+
+    def on_container_started(self, container):
+        with self.lock:
+            self.started_at[container.name] = time.monotonic()
+        topic = container.environment.get("TOPIC")
+        if self.broker and topic:
+            message = json.dumps(
+                {"version": container.image_ref.split(":")[-1], "timestamp": time.time()}
+            )
+            timer = threading.Timer(self.boot_latency, self.broker.publish, (topic, message))
+            timer.daemon = True
+            timer.start()
+
+
+class FakeDiscovery:
+    # Stands in for the Greengrass discovery endpoint and for the cores it returns. The first
+    # failures discover calls fail, and the first unreachable_count connectivity entries of every
+    # core refuse connections.
+    def __init__(self, broker, core_count=1, unreachable_count=0, failures=0, latency=0.0):
+        self.broker = broker
+        self.unreachable_hosts = set()
+        self.failures = failures
+        self.latency = latency
+        self.discover_calls = 0
+        self.connect_attempts = 0
+        self.lock = threading.Lock()
+        cores = []
+        for core_index in range(core_count):
+            connectivity = []
+            for index in range(unreachable_count + 1):
+                host = f"10.0.{core_index}.{index + 1}"
+                if index < unreachable_count:
+                    self.unreachable_hosts.add(host)
+                connectivity.append(
+                    {"Id": host, "HostAddress": host, "PortNumber": 8883, "Metadata": ""}
+                )
+            cores.append(
+                {"thingArn": f"arn:aws:iot:::thing/core-{core_index}", "Connectivity": connectivity}
+            )
+        self.payload = {
+            "GGGroups": [{"GGGroupId": "bench", "Cores": cores, "CAs": ["-----CA-----"]}]
+        }
+
+    def client(self, *args, **kwargs):
+        return self
+
+    def discover(self, thing_name):
+        time.sleep(self.latency)
+        with self.lock:
+            self.discover_calls += 1
+            should_fail = self.discover_calls <= self.failures
+        if should_fail:
+            return failed_future(ConnectionError("Discovery endpoint unavailable"))
+        return completed_future(DiscoverResponse.from_payload(self.payload))
+
+    def mtls_from_path(self, endpoint, client_id=None, **kwargs):
+        with self.lock:
+            self.connect_attempts += 1
+        fail_connect = None
+        if endpoint in self.unreachable_hosts:
+            fail_connect = ConnectionRefusedError(f"{endpoint} refused the connection")
+        return FakeMqttConnection(self.broker, client_id, fail_connect=fail_connect)
+
+    def patch(self, connection_helper_module):
+        # Replaces the discovery client, the TLS setup and the connection builder used by the
+        # given module for the duration of the returned context manager
+        return mock.patch.multiple(
+            connection_helper_module,
+            DiscoveryClient=self.client,
+            io=mock.MagicMock(),
+            mqtt_connection_builder=mock.MagicMock(mtls_from_path=self.mtls_from_path),
+        )
@@ -0,0 +1,99 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# MQTT 5 connections for the update agent and the firmware. It is copied into both images from the
+# "common" build context.
+#
+# The MQTT 5 client is returned wrapped in an awscrt mqtt.Connection, so the Jobs client and every
+# publisher and subscriber written against MQTT 3.1.1 work unchanged with either protocol version,
+# while the client underneath aliases topics, honours the broker's receive maximum and lets the
+# session expire. The adapter publishes without MQTT 5 properties, so user properties are only sent
+# with CONNECT, to correlate the connection: per-message properties such as a job id are not sent.
+# Jobs requests and responses are correlated by the clientToken in their payload instead.
+
+import uuid
+from awscrt import mqtt5
+from awsiot import mqtt5_client_builder
+
+MQTT_VERSIONS = (3, 5)
+DEFAULT_SESSION_EXPIRY_SECONDS = 3600
+DEFAULT_RECEIVE_MAXIMUM = 32
+DEFAULT_TOPIC_ALIAS_CACHE_SIZE = 16
+
+
+def check_mqtt_version(mqtt_version):
+    if mqtt_version not in MQTT_VERSIONS:
+        raise ValueError(
+            f"Unsupported MQTT version {mqtt_version}, expected one of "
+            f"{', '.join(str(version) for version in MQTT_VERSIONS)}"
+        )
+
+
+def new_connection_id():
+    # Sent as a user property of CONNECT, so that broker logs can be matched with the client's
+    return str(uuid.uuid4())
+
+
+def topic_aliasing_options(cache_size):
+    # Aliases replace long topics such as $aws/things/<thing>/jobs/<job id>/update/accepted with a
+    # two byte number once they have been sent in full. The outbound cache is least recently used
+    # first and the broker decides how many aliases it accepts; 0 disables aliasing both ways.
+    if not cache_size:
+        return mqtt5.TopicAliasingOptions(
+            outbound_behavior=mqtt5.OutboundTopicAliasBehaviorType.DISABLED,
+            inbound_behavior=mqtt5.InboundTopicAliasBehaviorType.DISABLED,
+        )
+    return mqtt5.TopicAliasingOptions(
+        outbound_behavior=mqtt5.OutboundTopicAliasBehaviorType.LRU,
+        outbound_cache_max_size=cache_size,
+        inbound_behavior=mqtt5.InboundTopicAliasBehaviorType.ENABLED,
+        inbound_cache_max_size=cache_size,
+    )
+
+
+def mtls_from_path(
+    endpoint,
+    port,
+    cert_filepath,
+    pri_key_filepath,
+    client_id,
+    ca_bytes=None,
+    ca_filepath=None,
+    on_connection_interrupted=None,
+    on_connection_resumed=None,
+    keep_alive_secs=30,
+    session_expiry=DEFAULT_SESSION_EXPIRY_SECONDS,
+    receive_maximum=DEFAULT_RECEIVE_MAXIMUM,
+    topic_alias_cache_size=DEFAULT_TOPIC_ALIAS_CACHE_SIZE,
+    user_properties=None,
+):
+    """
+    Like mqtt_connection_builder.mtls_from_path, but connects with MQTT 5. The session is rejoined
+    on every connect, like clean_session=False, but the broker drops it once the client has been
+    gone for session_expiry seconds. The broker sends at most receive_maximum QoS 1 messages
+    without waiting for their acknowledgements, and the client likewise never has more unacked
+    publishes in flight than the broker's own receive maximum. user_properties is a dict sent with
+    CONNECT, and not with the messages published through the returned connection.
+    """
+    client = mqtt5_client_builder.mtls_from_path(
+        endpoint=endpoint,
+        port=port,
+        cert_filepath=cert_filepath,
+        pri_key_filepath=pri_key_filepath,
+        ca_bytes=ca_bytes,
+        ca_filepath=ca_filepath,
+        client_id=client_id,
+        keep_alive_interval_sec=keep_alive_secs,
+        session_behavior=mqtt5.ClientSessionBehaviorType.REJOIN_ALWAYS,
+        session_expiry_interval_sec=session_expiry,
+        receive_maximum=receive_maximum,
+        topic_aliasing_options=topic_aliasing_options(topic_alias_cache_size),
+        user_properties=[
+            mqtt5.UserProperty(name=name, value=str(value))
+            for name, value in (user_properties or {}).items()
+        ],
+    )
+    return client.new_connection(
+        on_connection_interrupted=on_connection_interrupted,
+        on_connection_resumed=on_connection_resumed,
+    )
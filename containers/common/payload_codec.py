@@ -0,0 +1,80 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Payload encoding shared by the firmware, which encodes its telemetry, the update agent, which
+# decodes the firmware's messages to verify its version, and the telemetry decoder Lambda function.
+# It is copied into both images from the "common" build context, and into the function when the
+# CDK stack bundles it. cbor2 and msgpack are optional: only the codec in use needs its package.
+#
+# "json" payloads are plain JSON text, as before. Binary payloads start with a two byte header:
+# the codec id, with COMPRESSED_FLAG set when the rest is zlib compressed, and the schema version.
+# JSON text never starts with one of these bytes, so decode() tells the two apart.
+
+import json
+import zlib
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+SCHEMA_VERSION = 1
+CODEC_IDS = {"cbor": 0x01, "msgpack": 0x02}
+CODEC_NAMES = {codec_id: name for name, codec_id in CODEC_IDS.items()}
+COMPRESSED_FLAG = 0x10
+CODECS = ("json", *CODEC_IDS)
+
+
+class PayloadError(Exception):
+    pass
+
+
+def check_codec(codec):
+    # Fails early, e.g. when a node starts, rather than on the first message
+    if codec not in CODECS:
+        raise PayloadError(f"Unknown payload codec {codec}, expected one of {', '.join(CODECS)}")
+    if codec == "cbor" and cbor2 is None:
+        raise PayloadError("The cbor payload codec needs the cbor2 package")
+    if codec == "msgpack" and msgpack is None:
+        raise PayloadError("The msgpack payload codec needs the msgpack package")
+
+
+def encode(message, codec="json", compress=False):
+    if codec == "json":
+        return json.dumps(message, separators=(",", ":"))
+    if codec == "cbor":
+        body = cbor2.dumps(message)
+    elif codec == "msgpack":
+        body = msgpack.packb(message)
+    else:
+        raise PayloadError(f"Unknown payload codec {codec}")
+    codec_id = CODEC_IDS[codec]
+    if compress:
+        body = zlib.compress(body)
+        codec_id |= COMPRESSED_FLAG
+    return bytes((codec_id, SCHEMA_VERSION)) + body
+
+
+def decode(payload):
+    # Returns the message of a payload in any of the codecs
+    if isinstance(payload, str):
+        return json.loads(payload)
+    payload = bytes(payload)
+    if not payload:
+        raise PayloadError("Empty payload")
+    codec = CODEC_NAMES.get(payload[0] & ~COMPRESSED_FLAG)
+    if codec is None:
+        return json.loads(payload)
+    if len(payload) < 2 or payload[1] > SCHEMA_VERSION:
+        raise PayloadError(f"Unsupported {codec} payload schema")
+    body = payload[2:]
+    if payload[0] & COMPRESSED_FLAG:
+        body = zlib.decompress(body)
+    check_codec(codec)
+    if codec == "cbor":
+        return cbor2.loads(body)
+    return msgpack.unpackb(body)
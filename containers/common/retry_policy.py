@@ -0,0 +1,142 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Retry policy shared by the update agent and the firmware. It is copied into both images from
+# the "common" build context, so it must only depend on the standard library.
+
+import random
+import threading
+import time
+
+
+class RetryBudgetExhausted(Exception):
+    pass
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class RetryPolicy:
+    """
+    Retries a callable with decorrelated jitter backoff: each delay is drawn uniformly between
+    base_delay and three times the previous delay, capped at max_delay. Clients that fail
+    together therefore spread out instead of retrying in lockstep.
+
+    Retrying stops once max_attempts calls have been made or budget_seconds have elapsed (None
+    means no limit). After failure_threshold consecutive failures the circuit opens: callers wait
+    for reset_timeout before a single trial call is let through, and the circuit closes again on
+    the first success. A policy can be shared by several callers, which then share the circuit.
+    """
+
+    def __init__(
+        self,
+        name,
+        base_delay=1.0,
+        max_delay=60.0,
+        max_attempts=None,
+        budget_seconds=None,
+        failure_threshold=5,
+        reset_timeout=30.0,
+        log=print,
+    ):
+        self.name = name
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.budget_seconds = budget_seconds
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.log = log
+        self.lock = threading.Lock()
+        self.consecutive_failures = 0
+        self.circuit_opened_at = None
+        self.counters = {
+            "calls": 0,
+            "attempts": 0,
+            "failures": 0,
+            "retries": 0,
+            "circuit_opened": 0,
+            "wait_seconds": 0.0,
+        }
+
+    def next_delay(self, previous_delay):
+        delay = random.uniform(self.base_delay, max(self.base_delay, previous_delay * 3))
+        return min(self.max_delay, delay)
+
+    def circuit_wait_time(self):
+        # How long until the circuit lets a call through, 0 if it is closed or half-open
+        with self.lock:
+            if self.circuit_opened_at is None:
+                return 0
+            return max(0, self.circuit_opened_at + self.reset_timeout - time.monotonic())
+
+    def record_success(self):
+        with self.lock:
+            self.consecutive_failures = 0
+            self.circuit_opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.counters["failures"] += 1
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= self.failure_threshold:
+                if self.circuit_opened_at is None:
+                    self.counters["circuit_opened"] += 1
+                # Opening again after a failed trial call restarts the reset timeout
+                self.circuit_opened_at = time.monotonic()
+
+    def wait(self, seconds):
+        with self.lock:
+            self.counters["wait_seconds"] += seconds
+        time.sleep(seconds)
+
+    def call(self, fn, *args, **kwargs):
+        with self.lock:
+            self.counters["calls"] += 1
+        start = time.monotonic()
+        attempt = 0
+        delay = self.base_delay
+        while True:
+            circuit_wait = self.circuit_wait_time()
+            if circuit_wait:
+                if self.is_over_budget(start, circuit_wait):
+                    raise CircuitOpenError(f"{self.name}: circuit open")
+                self.log(f"{self.name}: circuit open, waiting {circuit_wait:.1f}s")
+                self.wait(circuit_wait)
+
+            attempt += 1
+            with self.lock:
+                self.counters["attempts"] += 1
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                self.record_failure()
+                if self.max_attempts is not None and attempt >= self.max_attempts:
+                    raise RetryBudgetExhausted(
+                        f"{self.name}: giving up after {attempt} attempts"
+                    ) from e
+                delay = self.next_delay(delay)
+                if self.is_over_budget(start, delay):
+                    raise RetryBudgetExhausted(
+                        f"{self.name}: giving up after {time.monotonic() - start:.1f}s"
+                    ) from e
+                self.log(f"{self.name}: attempt {attempt} failed ({e}), retrying in {delay:.1f}s")
+                with self.lock:
+                    self.counters["retries"] += 1
+                self.wait(delay)
+                continue
+
+            self.record_success()
+            return result
+
+    def is_over_budget(self, start, next_wait):
+        if self.budget_seconds is None:
+            return False
+        return time.monotonic() - start + next_wait > self.budget_seconds
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            counters["circuit_open"] = self.circuit_opened_at is not None
+        return counters
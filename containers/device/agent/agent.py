@@ -2,145 +2,706 @@
 # SPDX-License-Identifier: Apache-2.0.
 
 from job_handler import JobHandler
+from job_journal import CONTAINER_STARTED, IMAGE_PRESENT, open_journal
+from job_progress import default_stall_timeout
+from async_job_handler import AsyncJobHandler
 from discover_gg_connection import get_mqtt_connection
+from docker_runtime import DockerRuntime
+from firmware_monitor import FirmwareMonitor
+from metrics import metrics
+from retention import RetentionManager
+from retry_policy import RetryPolicy
+from structured_logging import setup_logging
+from concurrent.futures import Future, ThreadPoolExecutor
+import asyncio
+import contextlib
+import logging
+import threading
 import time
 import os
 import docker
 
-
-registry = "registry:5000"
-device_name = os.environ.get("DEVICE_NAME")
-agent_thing_name = f"{device_name}-agent"
-firmware_thing_name = f"{device_name}-firmware"
-firmware_cert_mount_path = f"/certs/{firmware_thing_name}"
+# Registry the firmware images are pulled from, normally the layer cache in front of the registry
+registry = os.environ.get("REGISTRY", "registry:5000")
+image = "firmware"
+# A single device, or a comma separated list of devices served by this agent
+device_names = [
+    name.strip()
+    for name in os.environ.get("DEVICE_NAMES", os.environ.get("DEVICE_NAME", "")).split(",")
+    if name.strip()
+]
 network = "host"
 
-key = f"/certs/{agent_thing_name}/private.pem.key"
-cert = f"/certs/{agent_thing_name}/device.pem.crt"
+logger = logging.getLogger("agent")
+
 root_ca = f"/certs/AmazonRootCA1.pem"
 region = "us-east-1"
 
+# "stop-start" stops the running firmware before starting the new version. "blue-green" starts the
+# new version next to the running one and only stops the old one once the new one is ready.
+cutover_mode = os.environ.get("CUTOVER_MODE", "stop-start")
+readiness_timeout = int(os.environ.get("READINESS_TIMEOUT_SECONDS", "60"))
+# In "stop-start" mode, only report an update as succeeded once the new firmware has published a
+# message with its version, within the readiness timeout. "blue-green" mode always waits for it.
+verify_firmware = os.environ.get("VERIFY_FIRMWARE", "true").lower() == "true"
+# Payload codec of the firmware's telemetry, see payload_codec.py
+firmware_payload_codec = os.environ.get("FIRMWARE_PAYLOAD_CODEC", "json")
+
+
+def parse_ros_domain_ids(value):
+    # "device1:1,device2:2" -> {"device1": 1, "device2": 2}
+    domain_ids = {}
+    for pair in filter(None, (pair.strip() for pair in value.split(","))):
+        name, _, domain_id = pair.partition(":")
+        if not name.strip() or not domain_id.strip().isdigit():
+            raise ValueError(
+                f"Invalid ROS_DOMAIN_IDS entry {pair!r}, expected <device>:<domain id>"
+            )
+        if int(domain_id) in domain_ids.values():
+            raise ValueError(
+                f"ROS_DOMAIN_IDS gives domain id {int(domain_id)} to more than one device"
+            )
+        domain_ids[name.strip()] = int(domain_id)
+    return domain_ids
+
+
+# ROS_DOMAIN_ID of each device's firmware, as comma separated device:domain id pairs. The firmware
+# containers share the host network of their docker daemon, so devices served by one agent need
+# different domains, or their ROS graphs see each other's topics.
+ros_domain_ids = parse_ros_domain_ids(os.environ.get("ROS_DOMAIN_IDS", ""))
+# Bridge config file inside the firmware image, e.g. /config/bridge_config.json (empty: no bridge)
+firmware_bridge_config = os.environ.get("FIRMWARE_BRIDGE_CONFIG", "")
+# After a cutover the previous firmware is paused rather than stopped, for this long, and resumed
+# if the new firmware exits or turns unhealthy in the meantime. 0 stops it straight away.
+standby_window = int(os.environ.get("STANDBY_WINDOW_SECONDS", "30"))
+# "threaded" uses JobHandler, "asyncio" uses AsyncJobHandler
+job_engine = os.environ.get("JOB_ENGINE", "threaded")
+# Only used by the threaded engine, number of queued jobs to prepare while a job is running
+pipeline_depth = int(os.environ.get("PIPELINE_DEPTH", "0"))
+# Only used by the asyncio engine, 0 means no timeout
+job_timeout = int(os.environ.get("JOB_TIMEOUT_SECONDS", "0")) or None
+# With several devices, the number of MQTT connections their job handlers are spread over and the
+# number of threads their jobs run on
+mqtt_connection_count = int(os.environ.get("MQTT_CONNECTIONS", "1"))
+job_workers = int(os.environ.get("JOB_WORKERS", "4"))
+# Port of the Prometheus metrics endpoint (0 to disable), and how often a compact metrics message is
+# published over MQTT (0 to disable)
+metrics_port = int(os.environ.get("METRICS_PORT", "9100"))
+metrics_publish_interval = int(os.environ.get("METRICS_PUBLISH_INTERVAL_SECONDS", "0"))
+# Besides the running version, each device keeps this many previous versions (image and stopped
+# container) for rollback. Older versions are removed, least recently used first, until the images
+# and containers fit in the disk budget, or all of them when the budget is 0.
+retain_versions = int(os.environ.get("RETAIN_VERSIONS", "2"))
+disk_budget_mb = int(os.environ.get("DISK_BUDGET_MB", "0"))
+retention_sweep_interval = int(os.environ.get("RETENTION_SWEEP_INTERVAL_SECONDS", "3600"))
 
-def start_container(version, fallback_container):
-    image = "firmware"
-    docker_client = docker.from_env()
+# Shared docker client and container/image index, started in main
+runtime = DockerRuntime()
+# Shared by every connection made by this agent, so they all back off together when the core is down
+connection_retry_policy = RetryPolicy(
+    "mqtt connection",
+    base_delay=float(os.environ.get("CONNECT_RETRY_BASE_DELAY_SECONDS", "1")),
+    max_delay=float(os.environ.get("CONNECT_RETRY_MAX_DELAY_SECONDS", "60")),
+    log=logger.warning,
+)
 
-    container_name = f"{device_name}-firmware-{version}"
-    labels = {"device": device_name}
-    volumes = {}
-    volumes[firmware_cert_mount_path] = {"bind": "/certs", "mode": "ro"}
+# In-flight and completed image pulls keyed by image reference, so that a job waits on the pull
+# started by the prefetch rather than pulling the same image again.
+image_pulls = {}
+# Progress callbacks of everyone waiting on a pull that is still in flight, by image reference
+image_pull_listeners = {}
+image_pulls_lock = threading.Lock()
 
-    environment = {
-        "THING_NAME": firmware_thing_name,
-        "TOPIC": f"clients/{firmware_thing_name}/hello/world",
-        "TIMER_PERIOD": "5",
-    }
 
-    print("Environment", environment)
-    print("Labels", labels)
-    print("Volumes", volumes)
-    print("Network", network)
+def is_firmware_image(image_ref):
+    # Matches the firmware images of any registry, including one the agent no longer pulls from
+    repository, _ = docker.utils.parse_repository_tag(image_ref)
+    return repository.rsplit("/", 1)[-1] == image
 
-    try:
-        container = docker_client.containers.get(container_name)
-        print(f"Container {container_name} already exists, restarting")
-        container.restart()
+
+def forget_image_pull(image_ref):
+    # Called before an image is removed. An image that is being pulled is kept, and a finished
+    # pull is forgotten so that the next job that needs the image pulls it again.
+    with image_pulls_lock:
+        pull_future = image_pulls.get(image_ref)
+        if pull_future and not pull_future.done():
+            return False
+        image_pulls.pop(image_ref, None)
         return True
 
-    except docker.errors.NotFound:
-        print(f"Contain {container_name} does not exist. Creating.")
-
-    print(f"Starting {container_name}...")
-    try:
-        print(f"Pulling image {registry}/{image}:{version}")
-        docker_client.images.pull(f"{registry}/{image}:{version}")
-        print(f"Starting container with image {registry}/{image}:{version}")
-
-        container = docker_client.containers.run(
-            f"{registry}/{image}:{version}",
-            detach=True,
-            name=container_name,
-            labels=labels,
-            volumes=volumes,
-            environment=environment,
-            network=network,
+
+retention = RetentionManager(
+    runtime,
+    is_firmware_image,
+    keep_versions=retain_versions,
+    disk_budget=disk_budget_mb * 1024 * 1024,
+    sweep_interval=retention_sweep_interval,
+    can_remove_image=forget_image_pull,
+)
+
+
+def report_pull_progress(image_ref, *progress):
+    with image_pulls_lock:
+        listeners = list(image_pull_listeners.get(image_ref, ()))
+    for listener in listeners:
+        listener(*progress)
+
+
+def ensure_image(version, on_progress=None):
+    # on_progress(layers_done, layers_total, bytes_done, bytes_total) is called as the image is
+    # pulled, whether this call or an earlier one started the pull
+    image_ref = f"{registry}/{image}:{version}"
+    retention.touch(image_ref)
+    with image_pulls_lock:
+        pull_future = image_pulls.get(image_ref)
+        is_owner = pull_future is None
+        if is_owner:
+            pull_future = Future()
+            image_pulls[image_ref] = pull_future
+            image_pull_listeners[image_ref] = []
+        if on_progress and image_ref in image_pull_listeners:
+            image_pull_listeners[image_ref].append(on_progress)
+
+    if is_owner:
+        try:
+            if runtime.has_image(image_ref):
+                logger.info("Image %s already present", image_ref)
+            else:
+                logger.info("Pulling image %s", image_ref)
+                pull_start = time.monotonic()
+                runtime.pull_image(
+                    image_ref,
+                    on_progress=lambda *progress: report_pull_progress(image_ref, *progress),
+                )
+                metrics.observe("image_pull", time.monotonic() - pull_start)
+                logger.info("Pulled image %s in %.2fs", image_ref, time.monotonic() - pull_start)
+            with image_pulls_lock:
+                del image_pull_listeners[image_ref]
+            pull_future.set_result(image_ref)
+        except Exception as e:
+            # Forget the failed pull so that a later job can retry it
+            with image_pulls_lock:
+                del image_pulls[image_ref]
+                del image_pull_listeners[image_ref]
+            pull_future.set_exception(e)
+    else:
+        logger.info("Waiting for pull of image %s", image_ref)
+
+    return pull_future.result()
+
+
+class FirmwareAgent:
+    # Installs firmware versions for one device
+    def __init__(self, device_name):
+        self.device_name = device_name
+        self.agent_thing_name = f"{device_name}-agent"
+        self.firmware_thing_name = f"{device_name}-firmware"
+        self.firmware_cert_mount_path = f"/certs/{self.firmware_thing_name}"
+        self.firmware_topic = f"clients/{self.firmware_thing_name}/hello/world"
+        # Watches the firmware's own messages to tell when a new version is up
+        self.firmware_monitor = None
+        # Phases of the jobs of this device, so that a job interrupted by a restart is resumed
+        self.journal = open_journal(self.agent_thing_name)
+
+    def start(self, mqtt_connection):
+        if cutover_mode == "blue-green" or verify_firmware:
+            self.firmware_monitor = FirmwareMonitor(mqtt_connection, self.firmware_topic)
+            self.firmware_monitor.start()
+
+    def start_container(self, version, fallback_container):
+        container_name = f"{self.device_name}-firmware-{version}"
+        labels = {"device": self.device_name}
+        volumes = {}
+        volumes[self.firmware_cert_mount_path] = {"bind": "/certs", "mode": "ro"}
+
+        environment = {
+            "THING_NAME": self.firmware_thing_name,
+            "TOPIC": self.firmware_topic,
+            "TIMER_PERIOD": "5",
+            "PAYLOAD_CODEC": firmware_payload_codec,
+        }
+        if firmware_bridge_config:
+            environment["BRIDGE_CONFIG"] = firmware_bridge_config
+        if self.device_name in ros_domain_ids:
+            environment["ROS_DOMAIN_ID"] = str(ros_domain_ids[self.device_name])
+
+        logger.debug(
+            "Container configuration",
+            extra={
+                "container_name": container_name,
+                "environment": environment,
+                "labels": labels,
+                "volumes": volumes,
+                "network": network,
+            },
         )
-        print(f"Container {container_name} started with id {container.id}")
-        return True
-    except docker.errors.APIError:
-        print(f"Image {image}:{version} not found")
-        if fallback_container:
-            print(f"Falling back to {fallback_container.name}")
-            fallback_container.restart()
-        else:
-            print(f"Image {image}:{version} not found and no fallback container available")
+
+        container = runtime.get_container(container_name)
+        if container:
+            logger.info("Container %s already exists, restarting", container_name)
+            with metrics.timer("container_start"):
+                runtime.restart_container(container)
+            return True
+
+        logger.info("Container %s does not exist. Creating.", container_name)
+        try:
+            logger.info("Starting %s with image %s/%s:%s", container_name, registry, image, version)
+
+            with metrics.timer("container_start"):
+                container = runtime.run_container(
+                    f"{registry}/{image}:{version}",
+                    container_name,
+                    labels,
+                    detach=True,
+                    volumes=volumes,
+                    environment=environment,
+                    network=network,
+                )
+            logger.info("Container %s started with id %s", container_name, container.id)
+            return True
+        except docker.errors.APIError:
+            logger.error("Image %s:%s not found", image, version)
+            if fallback_container:
+                logger.warning("Falling back to %s", fallback_container.name)
+                runtime.resume_container(fallback_container)
+            else:
+                logger.error("No fallback container available for %s", self.device_name)
+            return False
+        except Exception as e:
+            logger.exception("Error starting container %s", container_name)
+            return False
+
+    def stop_container(self):
+        containers = runtime.list_device_containers(self.device_name)
+        if not containers:
+            logger.info("No containers found for device %s", self.device_name)
+            return None
+        # Really we should only have one container running per device. If ever we have more than one,
+        # stop all of them and (arbitrarily) pick the first one as the fallback.
+        self.retire_containers(containers)
+        return containers[0]
+
+    def retire_containers(self, containers):
+        # Within a standby window the previous firmware is only paused, so that it can be resumed
+        # in well under a second instead of going through a cold start
+        for container in containers:
+            if standby_window:
+                logger.info("Pausing %s as standby", container.name)
+                with metrics.timer("container_pause"):
+                    runtime.pause_container(container)
+            else:
+                logger.info("Stopping %s", container.name)
+                with metrics.timer("container_stop"):
+                    runtime.stop_container(container)
+
+    def stop_standbys(self):
+        for container in runtime.list_device_containers(self.device_name, status="paused"):
+            logger.info("Stopping standby %s", container.name)
+            with metrics.timer("container_stop"):
+                runtime.stop_container(container)
+
+    def previous_containers(self, replaced):
+        # What to roll back to after a restart: the containers the new firmware replaced, as
+        # recorded in the journal. Journals written before those were recorded only have the
+        # paused standbys to go on, which are left by the cutover that was interrupted.
+        if replaced is None:
+            return runtime.list_device_containers(self.device_name, status="paused")
+        containers = [runtime.get_container(name) for name in replaced]
+        return [container for container in containers if container]
+
+    def watch_new_firmware(self, version, progress):
+        # Keeps the paused previous firmware for the standby window. If the new firmware exits or
+        # turns unhealthy in that time, the previous firmware is resumed and the update fails.
+        container_name = f"{self.device_name}-firmware-{version}"
+        standbys = runtime.list_device_containers(self.device_name, status="paused")
+        if not standbys:
+            return True
+        progress.update(
+            "watching", version=version, stall_timeout=standby_window + default_stall_timeout
+        )
+        failure = runtime.wait_for_failure(container_name, standby_window)
+        if failure is None and progress.is_cancelled():
+            failure = "cancelled"
+        if failure is None:
+            self.stop_standbys()
+            return True
+
+        logger.error("%s %s within the standby window", container_name, failure)
+        self.roll_back(version, failure, progress, standbys)
         return False
-    except Exception as e:
-        print(f"Error starting container: {e}")
+
+    def verify_new_firmware(self, version, waiter, progress, previous_containers):
+        # The update only succeeds once the new firmware has connected and published a message
+        # with its version. waiter was registered before the firmware was started.
+        container_name = f"{self.device_name}-firmware-{version}"
+        progress.update(
+            "verifying", version=version, stall_timeout=readiness_timeout + default_stall_timeout
+        )
+        if waiter.wait(readiness_timeout):
+            metrics.observe("time_to_first_message", waiter.time_to_first_message())
+            logger.info(
+                "%s published its first message after %.2fs",
+                container_name,
+                waiter.time_to_first_message(),
+            )
+            return True
+
+        logger.error("%s did not publish within %ss", container_name, readiness_timeout)
+        self.roll_back(version, "no_message", progress, previous_containers)
         return False
 
+    def roll_back(self, version, reason, progress, previous_containers):
+        # Brings back the first of the previous containers, paused or stopped, and stops the new
+        # firmware. With nothing to go back to, the new firmware is left running.
+        container_name = f"{self.device_name}-firmware-{version}"
+        progress.update("rolling_back", version=version, reason=reason)
+        metrics.increment("rollbacks")
+        if not previous_containers:
+            logger.warning("No previous firmware to roll back to for %s", self.device_name)
+            return
+        logger.info("Rolling back to %s", previous_containers[0].name)
+        rollback_start = time.monotonic()
+        runtime.resume_container(previous_containers[0])
+        metrics.observe("rollback", time.monotonic() - rollback_start)
+        logger.info(
+            "Resumed %s in %.3fs", previous_containers[0].name, time.monotonic() - rollback_start
+        )
+        new_container = runtime.get_container(container_name)
+        if new_container and runtime.is_running(container_name):
+            runtime.stop_container(new_container)
+        for container in previous_containers[1:]:
+            runtime.stop_container(container)
 
-def stop_container():
-    docker_client = docker.from_env()
-    containers = docker_client.containers.list(filters={"label": [f"device={device_name}"]})
-    if not containers:
-        print("No containers found for this device")
-        return None
-    # Really we should only have one container running per device. If ever we have more than one,
-    # stop all of them and (arbitrarily) pick the first one as the fallback.
-    for container in containers:
-        print(f"Stopping {container.name}")
-        container.stop()
-    return containers[0]
-
-
-def job_handler_callback_start_firmware_update(job_id, job_document):
-    print("job_handler_callback_start_firmware_update job_id: " + str(job_id))
-    print("job_handler_callback_start_firmware_update job_document: " + str(job_document))
-    success_status = False
-    if "version" in job_document:
-        version = job_document["version"]
-        fallback_container = stop_container()
-        success_status = start_container(version, fallback_container)
-    else:
-        print("job_handler_callback_start_firmware_update missing version")
-    print(f"job_handler_callback_start_firmware_update complete with status {success_status}")
-    return success_status
-
-
-def job_handler_callback(job_id, job_document):
-    print("job_handler_callback job_id: " + str(job_id))
-    print("job_handler_callback job_document: " + str(job_document))
-    success_status = False
-    if "operation" in job_document:
-        operation = job_document["operation"]
-        if operation == "Deploy-ROS-Firmware":
-            success_status = job_handler_callback_start_firmware_update(job_id, job_document)
+    def blue_green_cutover(self, version, progress):
+        container_name = f"{self.device_name}-firmware-{version}"
+        old_containers = [
+            container
+            for container in runtime.list_device_containers(self.device_name)
+            if container.name != container_name
+        ]
+        if runtime.is_running(container_name):
+            logger.info("Container %s is already running", container_name)
+            for container in old_containers:
+                logger.info("Stopping %s", container.name)
+                runtime.stop_container(container)
+            self.stop_standbys()
+            return True
+
+        # Both firmware versions use the same client id, so the broker will bounce the old one while
+        # they overlap. That is fine: the new one only has to publish once to be considered ready.
+        waiter = self.firmware_monitor.expect_version(version)
+        try:
+            cutover_start = time.monotonic()
+            progress.update("starting", version=version)
+            if not self.start_container(version, None):
+                logger.error("Could not start %s, leaving current firmware running", container_name)
+                return False
+
+            logger.info(
+                "Waiting up to %ss for %s to become ready...", readiness_timeout, container_name
+            )
+            # The wait gives up by itself after the readiness timeout
+            progress.update(
+                "verifying",
+                version=version,
+                stall_timeout=readiness_timeout + default_stall_timeout,
+            )
+            if not waiter.wait(readiness_timeout):
+                logger.error("%s did not become ready in time, rolling back", container_name)
+                new_container = runtime.get_container(container_name)
+                if new_container:
+                    runtime.stop_container(new_container)
+                for container in old_containers:
+                    if not runtime.is_running(container.name):
+                        runtime.restart_container(container)
+                return False
+
+            metrics.observe("time_to_first_message", waiter.time_to_first_message())
+            logger.info("%s ready after %.2fs", container_name, waiter.time_to_first_message())
+            if progress.is_cancelled():
+                logger.warning("Job cancelled, stopping %s", container_name)
+                new_container = runtime.get_container(container_name)
+                if new_container:
+                    runtime.stop_container(new_container)
+                return False
+            downtime_start = time.monotonic()
+            self.retire_containers(old_containers)
+            logger.info(
+                "Blue/green cutover took %.2fs, old firmware stopped in %.2fs",
+                time.monotonic() - cutover_start,
+                time.monotonic() - downtime_start,
+            )
+            return True
+        finally:
+            self.firmware_monitor.forget(waiter)
+
+    def stop_start_cutover(self, job_id, version, progress):
+        switch_over_start = time.monotonic()
+        progress.update("stopping", version=version)
+        fallback_container = self.stop_container()
+        if progress.is_cancelled():
+            logger.warning("Job cancelled, not starting %s", version, extra={"job_id": job_id})
+            if fallback_container:
+                runtime.resume_container(fallback_container)
+            return False
+        # Registered before the start, so that the first message of the new firmware is not missed
+        expecting = (
+            self.firmware_monitor.expecting(version)
+            if verify_firmware
+            else contextlib.nullcontext()
+        )
+        with expecting as waiter:
+            progress.update("starting", version=version)
+            success_status = self.start_container(version, fallback_container)
+            logger.info(
+                "Firmware switch-over took %.2fs",
+                time.monotonic() - switch_over_start,
+                extra={"job_id": job_id},
+            )
+            previous_containers = [fallback_container] if fallback_container else []
+            if success_status and waiter:
+                success_status = self.verify_new_firmware(
+                    version, waiter, progress, previous_containers
+                )
+        if success_status and progress.is_cancelled():
+            logger.warning(
+                "Job cancelled after the cutover, rolling back", extra={"job_id": job_id}
+            )
+            self.roll_back(version, "cancelled", progress, previous_containers)
+            return False
+        return success_status
+
+    def job_handler_callback_start_firmware_update(self, job_id, job_document, progress):
+        logger.info(
+            "Starting firmware update",
+            extra={
+                "job_id": job_id,
+                "device": self.device_name,
+                "version": job_document.get("version"),
+            },
+        )
+        success_status = False
+        if "version" in job_document:
+            version = job_document["version"]
+            container_name = f"{self.device_name}-firmware-{version}"
+            phases = self.journal.phases(job_id)
+            if CONTAINER_STARTED in phases and runtime.is_running(container_name):
+                # The agent restarted after the cutover, so only verifying and watching the new
+                # firmware is left
+                logger.info(
+                    "Resuming job, %s is already running", container_name, extra={"job_id": job_id}
+                )
+                previous_containers = self.previous_containers(
+                    phases[CONTAINER_STARTED].get("replaced")
+                )
+                if self.firmware_monitor:
+                    # It still has to be publishing, as it would have been verified before the
+                    # restart
+                    with self.firmware_monitor.expecting(version) as waiter:
+                        if not self.verify_new_firmware(
+                            version, waiter, progress, previous_containers
+                        ):
+                            return False
+                return self.watch_new_firmware(version, progress)
+
+            def on_pull_progress(layers_done, layers_total, bytes_done, bytes_total):
+                progress.update(
+                    "pulling",
+                    version=version,
+                    layers=f"{layers_done}/{layers_total}",
+                    bytes=f"{bytes_done}/{bytes_total}",
+                )
+
+            # Make sure the new image is local before stopping anything, so the current firmware keeps
+            # running for the whole pull (and keeps running if the pull fails).
+            progress.update("pulling", version=version)
+            try:
+                ensure_image(version, on_progress=on_pull_progress)
+            except Exception as e:
+                logger.error(
+                    "Image %s:%s could not be pulled (%s), keeping current firmware",
+                    image,
+                    version,
+                    e,
+                    extra={"job_id": job_id},
+                )
+                return False
+            if IMAGE_PRESENT not in phases:
+                self.journal.record(job_id, IMAGE_PRESENT, version=version)
+            if progress.is_cancelled():
+                logger.warning(
+                    "Job cancelled after the pull, keeping current firmware",
+                    extra={"job_id": job_id},
+                )
+                return False
+            # Standbys left behind by an update that was interrupted
+            self.stop_standbys()
+            replaced = [
+                container.name
+                for container in runtime.list_device_containers(self.device_name)
+                if container.name != container_name
+            ]
+            if cutover_mode == "blue-green":
+                success_status = self.blue_green_cutover(version, progress)
+            else:
+                success_status = self.stop_start_cutover(job_id, version, progress)
+            if success_status:
+                # Recorded before the standby window, so that a restart within it still rolls
+                # back to the firmware that was replaced
+                self.journal.record(
+                    job_id, CONTAINER_STARTED, container=container_name, replaced=replaced
+                )
+                success_status = self.watch_new_firmware(version, progress)
         else:
-            print("job_handler_callback unknown operation: " + operation)
+            logger.error("Job document has no version", extra={"job_id": job_id})
+        logger.info(
+            "Firmware update complete with status %s", success_status, extra={"job_id": job_id}
+        )
+        return success_status
+
+    def job_prefetch_callback(self, job_id, job_document):
+        if job_document.get("operation") == "Deploy-ROS-Firmware" and "version" in job_document:
+            logger.info(
+                "Prefetching firmware version %s",
+                job_document["version"],
+                extra={"job_id": job_id},
+            )
+            ensure_image(job_document["version"])
 
-    print(f"job_handler_callback complete with status {success_status}")
-    return success_status
+    def job_handler_callback(self, job_id, job_document, progress):
+        # progress is the job's JobProgress, updated with the phase of the update as it goes
+        logger.debug("Received job", extra={"job_id": job_id, "job_document": job_document})
+        success_status = False
+        if "operation" in job_document:
+            operation = job_document["operation"]
+            if operation == "Deploy-ROS-Firmware":
+                # Old versions are only removed while no job is running
+                with retention.job():
+                    success_status = self.job_handler_callback_start_firmware_update(
+                        job_id, job_document, progress
+                    )
+            else:
+                logger.error("Unknown operation %s", operation, extra={"job_id": job_id})
+
+        logger.info("Job complete with status %s", success_status, extra={"job_id": job_id})
+        return success_status
 
 
 def get_mqtt_connection_with_retry(thing_name, key, cert, region):
-    while True:
-        try:
-            return get_mqtt_connection(thing_name, key, cert, region)
-        except Exception as e:
-            print(f"Connection failed with exception {e}. Retrying in 10 seconds...")
-            time.sleep(10)
+    mqtt_connection = connection_retry_policy.call(
+        get_mqtt_connection, thing_name, key, cert, region
+    )
+    logger.info("Connection retry stats", extra=connection_retry_policy.snapshot())
+    return mqtt_connection
 
 
-if __name__ == "__main__":
-    if not device_name:
-        print("DEVICE_NAME environment variable not set")
-        exit(1)
+def get_agent_mqtt_connection(device_name):
+    agent_thing_name = f"{device_name}-agent"
+    key = f"/certs/{agent_thing_name}/private.pem.key"
+    cert = f"/certs/{agent_thing_name}/device.pem.crt"
+    return get_mqtt_connection_with_retry(agent_thing_name, key, cert, region)
+
+
+def start_metrics(mqtt_connection, agent_thing_name):
+    if metrics_port:
+        metrics.start_http_server(metrics_port)
+    if metrics_publish_interval:
+        metrics.start_mqtt_publisher(
+            mqtt_connection, f"clients/{agent_thing_name}/metrics", metrics_publish_interval
+        )
+
+
+def run_single_device(device_name):
+    agent = FirmwareAgent(device_name)
+    logger.info(
+        "Starting agent", extra={"device": device_name, "thing_name": agent.agent_thing_name}
+    )
 
-    print(f"DEVICE_NAME {device_name}")
-    print(f"thing_name {agent_thing_name}")
+    mqtt_connection = get_agent_mqtt_connection(device_name)
+    start_metrics(mqtt_connection, agent.agent_thing_name)
 
-    mqtt_connection = get_mqtt_connection_with_retry(agent_thing_name, key, cert, region)
+    runtime.start()
+    retention.start()
+    agent.start(mqtt_connection)
 
-    job_handler = JobHandler(agent_thing_name, mqtt_connection, job_handler_callback)
+    if job_engine == "asyncio":
+        job_handler = AsyncJobHandler(
+            agent.agent_thing_name,
+            mqtt_connection,
+            agent.job_handler_callback,
+            agent.job_prefetch_callback,
+            job_timeout=job_timeout,
+            journal=agent.journal,
+        )
+    else:
+        job_handler = JobHandler(
+            agent.agent_thing_name,
+            mqtt_connection,
+            agent.job_handler_callback,
+            agent.job_prefetch_callback,
+            pipeline_depth=pipeline_depth,
+            journal=agent.journal,
+        )
     job_handler.run()
+
+
+def run_multiple_devices(device_names):
+    # One process serves every device: a single docker runtime, a few MQTT connections (made as
+    # the agent things of the first devices) shared by all devices, and one asyncio job handler
+    # per agent thing, all on the same event loop and thread pool. The Greengrass client device
+    # policy allows publishing and subscribing to the jobs topics of other things, so a connection
+    # can carry the jobs of any number of devices.
+    logger.info("Starting agent", extra={"devices": device_names})
+    if any(device_name not in ros_domain_ids for device_name in device_names):
+        logger.warning(
+            "Give every device its own ROS domain with ROS_DOMAIN_IDS, or their firmware will "
+            "see each other's ROS topics",
+            extra={"ros_domain_ids": ros_domain_ids},
+        )
+    connection_count = max(1, min(mqtt_connection_count, len(device_names)))
+    mqtt_connections = [
+        get_agent_mqtt_connection(device_name) for device_name in device_names[:connection_count]
+    ]
+
+    start_metrics(mqtt_connections[0], f"{device_names[0]}-agent")
+    runtime.start()
+    retention.start()
+
+    executor = ThreadPoolExecutor(max_workers=job_workers, thread_name_prefix="job_worker")
+    job_handlers = []
+    for index, device_name in enumerate(device_names):
+        mqtt_connection = mqtt_connections[index % connection_count]
+        agent = FirmwareAgent(device_name)
+        agent.start(mqtt_connection)
+        job_handlers.append(
+            AsyncJobHandler(
+                agent.agent_thing_name,
+                mqtt_connection,
+                agent.job_handler_callback,
+                agent.job_prefetch_callback,
+                executor=executor,
+                job_timeout=job_timeout,
+                owns_connection=False,
+                journal=agent.journal,
+            )
+        )
+
+    async def run_job_handlers():
+        await asyncio.gather(*(job_handler.run_async() for job_handler in job_handlers))
+        for mqtt_connection in mqtt_connections:
+            await asyncio.wrap_future(mqtt_connection.disconnect())
+
+    asyncio.run(run_job_handlers())
+    executor.shutdown(wait=False)
+
+
+if __name__ == "__main__":
+    setup_logging()
+    if not device_names:
+        logger.critical("DEVICE_NAME environment variable not set")
+        exit(1)
+
+    if len(device_names) == 1:
+        run_single_device(device_names[0])
+    else:
+        run_multiple_devices(device_names)
@@ -0,0 +1,603 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0.
+
+import asyncio
+import enum
+import functools
+import logging
+import time
+import uuid
+from awscrt import mqtt
+from awsiot import iotjobs
+from concurrent.futures import ThreadPoolExecutor
+from job_journal import ACCEPTED, COMPLETED, STATUS_PUBLISHED
+from job_progress import JobProgress, step_timeout_minutes
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_WORKERS = 2
+DEFAULT_REQUEST_TIMEOUT = 30
+UPDATE_ATTEMPTS = 3
+
+
+class JobState(enum.Enum):
+    IDLE = "idle"
+    REQUESTING = "requesting"
+    RUNNING = "running"
+    REPORTING = "reporting"
+    STOPPED = "stopped"
+
+
+class RequestRejected(Exception):
+    def __init__(self, error):
+        super().__init__(f"{error.code}: {error.message}")
+        self.error = error
+
+
+def is_timed_out(task):
+    return (
+        task.done() and not task.cancelled() and isinstance(task.exception(), asyncio.TimeoutError)
+    )
+
+
+class AsyncJobHandler:
+    # Same jobs protocol as JobHandler, driven by a single asyncio event loop. awscrt callbacks
+    # only hand events over to the loop, job callbacks run on a bounded executor (which can be
+    # shared between handlers), and every request and job is subject to a timeout.
+    def __init__(
+        self,
+        thing_name,
+        mqtt_connection,
+        job_handler_callback,
+        job_prefetch_callback=None,
+        executor=None,
+        job_timeout=None,
+        request_timeout=DEFAULT_REQUEST_TIMEOUT,
+        owns_connection=True,
+        journal=None,
+    ):
+        self.thing_name = thing_name
+        self.job_handler_callback = job_handler_callback
+        self.job_prefetch_callback = job_prefetch_callback
+        self.mqtt_connection = mqtt_connection
+        # A connection shared with other handlers is left connected when this handler stops
+        self.owns_connection = owns_connection
+        # With a JobJournal, job phases are recorded so that the job can be resumed after a restart
+        self.journal = journal
+        self.jobs_client = iotjobs.IotJobsClient(self.mqtt_connection)
+        self.owns_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(
+            max_workers=DEFAULT_MAX_WORKERS, thread_name_prefix="job_worker"
+        )
+        self.job_timeout = job_timeout
+        self.request_timeout = request_timeout
+        self.available_jobs = []
+        self.state = JobState.IDLE
+        self.current_job_id = None
+        self.current_job_task = None
+        # The callback of a timed out job, which the next job waits for once the timeout is reported
+        self.timed_out_work = None
+        # Requests awaiting an accepted/rejected response, keyed by client token
+        self.pending_requests = {}
+        self.loop = None
+        self.job_waiting = None
+        self.stopped = None
+
+    def set_state(self, state):
+        if state != self.state:
+            logger.debug(
+                "Job state %s -> %s",
+                self.state.value,
+                state.value,
+                extra={"thing_name": self.thing_name},
+            )
+            self.state = state
+
+    # awscrt invokes callbacks on its own threads, so all they do is schedule work on the loop
+    def call_in_loop(self, fn, *args):
+        self.loop.call_soon_threadsafe(fn, *args)
+
+    def on_response(self, response):
+        if response is not None:
+            self.call_in_loop(self.resolve_request, response.client_token, response, None)
+
+    def on_rejected(self, error):
+        if error is not None:
+            self.call_in_loop(
+                self.resolve_request, error.client_token, None, RequestRejected(error)
+            )
+
+    def resolve_request(self, client_token, response, error):
+        future = self.pending_requests.pop(client_token, None)
+        if future is None or future.done():
+            return
+        if error:
+            future.set_exception(error)
+        else:
+            future.set_result(response)
+
+    async def await_crt_future(self, crt_future):
+        await asyncio.wait_for(asyncio.wrap_future(crt_future), self.request_timeout)
+
+    async def subscribe(self, subscribe_fn, request, callback):
+        subscribed_future, _ = subscribe_fn(
+            request=request, qos=mqtt.QoS.AT_LEAST_ONCE, callback=callback
+        )
+        await self.await_crt_future(subscribed_future)
+
+    async def request(self, publish_fn, request):
+        client_token = str(uuid.uuid4())
+        request.client_token = client_token
+        response_future = self.loop.create_future()
+        self.pending_requests[client_token] = response_future
+        try:
+            await self.await_crt_future(publish_fn(request, mqtt.QoS.AT_LEAST_ONCE))
+            return await asyncio.wait_for(response_future, self.request_timeout)
+        finally:
+            self.pending_requests.pop(client_token, None)
+
+    def on_get_pending_job_executions_accepted(self, response):
+        # type: (iotjobs.GetPendingJobExecutionsResponse) -> None
+        if response is None:
+            return
+        jobs = response.in_progress_jobs + response.queued_jobs
+        if jobs:
+            logger.info(
+                "Pending jobs",
+                extra={
+                    "thing_name": self.thing_name,
+                    "in_progress": [job.job_id for job in response.in_progress_jobs],
+                    "queued": [job.job_id for job in response.queued_jobs],
+                },
+            )
+        else:
+            logger.info("No pending or queued jobs found!", extra={"thing_name": self.thing_name})
+        self.available_jobs = jobs
+
+        # The pending jobs summary does not include the job document, so describe each job
+        # to be able to prefetch it.
+        if self.job_prefetch_callback:
+            for job in jobs:
+                request = iotjobs.DescribeJobExecutionRequest(
+                    thing_name=self.thing_name, job_id=job.job_id, include_job_document=True
+                )
+                self.jobs_client.publish_describe_job_execution(request, mqtt.QoS.AT_LEAST_ONCE)
+
+    def on_job_described(self, response):
+        # type: (iotjobs.DescribeJobExecutionResponse) -> None
+        execution = response.execution if response else None
+        if execution and execution.job_document:
+            self.prefetch_job(execution.job_id, execution.job_document)
+
+    def on_next_job_execution_changed(self, event):
+        # type: (iotjobs.NextJobExecutionChangedEvent) -> None
+        execution = event.execution if event else None
+        if execution:
+            logger.info(
+                "Received Next Job Execution Changed event",
+                extra={"thing_name": self.thing_name, "job_id": execution.job_id},
+            )
+            logger.debug(
+                "Job document",
+                extra={
+                    "thing_name": self.thing_name,
+                    "job_id": execution.job_id,
+                    "job_document": execution.job_document,
+                },
+            )
+            self.prefetch_job(execution.job_id, execution.job_document)
+        else:
+            logger.info(
+                "Received Next Job Execution Changed event: None. Waiting for further jobs...",
+                extra={"thing_name": self.thing_name},
+            )
+
+        # While a job is in progress it stays the next job, so any change means it was cancelled
+        # (or timed out) in the cloud.
+        if self.state == JobState.RUNNING and (
+            execution is None or execution.job_id != self.current_job_id
+        ):
+            logger.warning(
+                "Job is no longer pending, cancelling it",
+                extra={"thing_name": self.thing_name, "job_id": self.current_job_id},
+            )
+            self.cancel_job(self.current_job_id)
+
+        if execution:
+            self.job_waiting.set()
+
+    async def record(self, job_id, phase, **fields):
+        # Journal writes are fsynced, so keep them off the event loop
+        if self.journal:
+            await self.loop.run_in_executor(
+                None, functools.partial(self.journal.record, job_id, phase, **fields)
+            )
+
+    async def replay_unpublished_statuses(self):
+        # Sends the final statuses recorded before a restart that the cloud never confirmed, so
+        # that those jobs are not started again
+        for job_id, completed in self.journal.unpublished():
+            logger.info(
+                "Replaying final status %s",
+                completed["status"],
+                extra={"thing_name": self.thing_name, "job_id": job_id},
+            )
+            request = iotjobs.UpdateJobExecutionRequest(
+                thing_name=self.thing_name,
+                job_id=job_id,
+                status=completed["status"],
+                status_details=completed.get("status_details"),
+            )
+            try:
+                await self.request(self.jobs_client.publish_update_job_execution, request)
+            except asyncio.TimeoutError:
+                # Tried again on the next start
+                logger.warning(
+                    "Timed out replaying final status",
+                    extra={"thing_name": self.thing_name, "job_id": job_id},
+                )
+                continue
+            except RequestRejected as e:
+                # Most likely the status did reach the cloud before the restart
+                logger.info(
+                    "Replayed final status rejected: %s",
+                    e,
+                    extra={"thing_name": self.thing_name, "job_id": job_id},
+                )
+            await self.record(job_id, STATUS_PUBLISHED)
+
+    def cancel_job(self, job_id):
+        if self.current_job_id == job_id and self.current_job_task:
+            self.current_job_task.cancel()
+
+    def send_progress_update(self, request):
+        # Called from the progress thread of the running job
+        return asyncio.run_coroutine_threadsafe(
+            self.request(self.jobs_client.publish_update_job_execution, request), self.loop
+        )
+
+    def prefetch_job(self, job_id, job_document):
+        if not self.job_prefetch_callback:
+            return
+
+        def prefetch_fn():
+            try:
+                self.job_prefetch_callback(job_id, job_document)
+            except Exception as e:
+                logger.warning(
+                    "Prefetching job failed: %s",
+                    e,
+                    extra={"thing_name": self.thing_name, "job_id": job_id},
+                )
+
+        self.loop.run_in_executor(self.executor, prefetch_fn)
+
+    async def start_next_job(self):
+        self.set_state(JobState.REQUESTING)
+        logger.info(
+            "Publishing request to start next job...", extra={"thing_name": self.thing_name}
+        )
+        request = iotjobs.StartNextPendingJobExecutionRequest(
+            thing_name=self.thing_name, step_timeout_in_minutes=step_timeout_minutes
+        )
+        with metrics.timer("start_next_round_trip"):
+            response = await self.request(
+                self.jobs_client.publish_start_next_pending_job_execution, request
+            )
+        return response.execution
+
+    async def run_job(self, execution):
+        # Returns the job status to report with its status details and expected version. The
+        # status is None if there is nothing left to report, because the job was cancelled or
+        # was already reported as FAILED when it stalled.
+        self.set_state(JobState.RUNNING)
+        self.current_job_id = execution.job_id
+        logger.info(
+            "Starting local work on job...",
+            extra={"thing_name": self.thing_name, "job_id": execution.job_id},
+        )
+        submitted_at = time.monotonic()
+        progress = JobProgress(
+            execution.job_id,
+            self.thing_name,
+            execution.version_number,
+            self.send_progress_update,
+            on_stalled=lambda: self.call_in_loop(self.cancel_job, execution.job_id),
+        )
+
+        def work_fn():
+            # The executor may be busy with other devices' jobs
+            metrics.observe("job_queue", time.monotonic() - submitted_at)
+            with metrics.timer("job"):
+                return self.job_handler_callback(execution.job_id, execution.job_document, progress)
+
+        progress.start()
+        work = self.loop.run_in_executor(self.executor, work_fn)
+        # Cancelling the task or timing it out only stops the wait, the callback itself is shielded
+        self.current_job_task = asyncio.ensure_future(
+            asyncio.wait_for(asyncio.shield(work), self.job_timeout)
+        )
+        try:
+            await asyncio.wait({self.current_job_task})
+        finally:
+            if not self.current_job_task.done():
+                self.current_job_task.cancel()
+            if not work.done():
+                # The callback is told to stop at its next phase, and the next job only starts
+                # once it has returned, so that two jobs never change the device's containers at
+                # the same time. A timed out job is reported as FAILED first, as the callback may
+                # be stuck in a pull or a container start.
+                progress.cancel()
+                if is_timed_out(self.current_job_task):
+                    self.timed_out_work = work
+                else:
+                    await self.wait_for_callback(execution.job_id, work)
+            self.current_job_id = None
+            # Waits for an IN_PROGRESS update that is still in flight
+            expected_version = await self.loop.run_in_executor(None, progress.stop)
+        status_details = progress.status_details()
+
+        task = self.current_job_task
+        if progress.stalled:
+            metrics.increment("jobs_stalled")
+            return None, None, None
+        if task.cancelled() or progress.rejected:
+            logger.warning(
+                "Job was cancelled.",
+                extra={"thing_name": self.thing_name, "job_id": execution.job_id},
+            )
+            metrics.increment("jobs_cancelled")
+            return None, None, None
+        if is_timed_out(task):
+            logger.error(
+                "Job timed out after %ss",
+                self.job_timeout,
+                extra={"thing_name": self.thing_name, "job_id": execution.job_id},
+            )
+            status_details["reason"] = "timeout"
+            return iotjobs.JobStatus.FAILED, status_details, expected_version
+        if task.exception():
+            logger.error(
+                "Job failed with exception",
+                exc_info=task.exception(),
+                extra={"thing_name": self.thing_name, "job_id": execution.job_id},
+            )
+            status_details["reason"] = "error"
+            return iotjobs.JobStatus.FAILED, status_details, expected_version
+        logger.info(
+            "Done working on job.",
+            extra={"thing_name": self.thing_name, "job_id": execution.job_id},
+        )
+        if task.result():
+            return iotjobs.JobStatus.SUCCEEDED, status_details, expected_version
+        return iotjobs.JobStatus.FAILED, status_details, expected_version
+
+    async def wait_for_callback(self, job_id, work):
+        logger.info(
+            "Waiting for the job callback to stop...",
+            extra={"thing_name": self.thing_name, "job_id": job_id},
+        )
+        await asyncio.wait({work})
+
+    async def update_job(self, job_id, status, status_details, expected_version):
+        self.set_state(JobState.REPORTING)
+        for attempt in range(UPDATE_ATTEMPTS):
+            logger.info(
+                "Publishing request to update job status to %s",
+                status,
+                extra={"thing_name": self.thing_name, "job_id": job_id},
+            )
+            request = iotjobs.UpdateJobExecutionRequest(
+                thing_name=self.thing_name,
+                job_id=job_id,
+                status=status,
+                status_details=status_details,
+                # A timed out attempt may have been applied, which changed the version
+                expected_version=expected_version if attempt == 0 else None,
+            )
+            try:
+                with metrics.timer("update_job_round_trip"):
+                    await self.request(self.jobs_client.publish_update_job_execution, request)
+                logger.info(
+                    "Request to update job was accepted.",
+                    extra={"thing_name": self.thing_name, "job_id": job_id},
+                )
+                await self.record(job_id, STATUS_PUBLISHED)
+                return
+            except asyncio.TimeoutError:
+                logger.warning(
+                    "Timed out updating job status (attempt %d/%d)",
+                    attempt + 1,
+                    UPDATE_ATTEMPTS,
+                    extra={"thing_name": self.thing_name, "job_id": job_id},
+                )
+            except RequestRejected as e:
+                logger.error(
+                    "Request to update job status was rejected. %s",
+                    e,
+                    extra={"thing_name": self.thing_name, "job_id": job_id},
+                )
+                await self.record(job_id, STATUS_PUBLISHED)
+                return
+        # Left unpublished in the journal, and replayed on the next start
+
+    async def job_loop(self):
+        while True:
+            await self.job_waiting.wait()
+            self.job_waiting.clear()
+            try:
+                execution = await self.start_next_job()
+            except asyncio.TimeoutError:
+                logger.warning(
+                    "Timed out waiting for the next job, retrying...",
+                    extra={"thing_name": self.thing_name},
+                )
+                self.job_waiting.set()
+                continue
+
+            if not execution:
+                logger.info(
+                    "Request to start next job was accepted, but there are no jobs to be done. Waiting for further jobs...",
+                    extra={"thing_name": self.thing_name},
+                )
+                self.set_state(JobState.IDLE)
+                continue
+
+            logger.info(
+                "Request to start next job was accepted",
+                extra={"thing_name": self.thing_name, "job_id": execution.job_id},
+            )
+            logger.debug(
+                "Job document",
+                extra={
+                    "thing_name": self.thing_name,
+                    "job_id": execution.job_id,
+                    "job_document": execution.job_document,
+                },
+            )
+            await self.record(execution.job_id, ACCEPTED)
+            status, status_details, expected_version = await self.run_job(execution)
+            if status:
+                metrics.increment(f"jobs_{status.lower()}")
+                await self.record(
+                    execution.job_id, COMPLETED, status=status, status_details=status_details
+                )
+                await self.update_job(execution.job_id, status, status_details, expected_version)
+            else:
+                # Cancelled, or already reported as FAILED when it stalled
+                await self.record(execution.job_id, STATUS_PUBLISHED)
+            if self.timed_out_work:
+                await self.wait_for_callback(execution.job_id, self.timed_out_work)
+                self.timed_out_work = None
+            self.set_state(JobState.IDLE)
+
+    async def subscribe_all(self):
+        thing_name = self.thing_name
+        logger.info(
+            "Subscribing to GetPendingJobExecutions responses...", extra={"thing_name": thing_name}
+        )
+        get_jobs_request = iotjobs.GetPendingJobExecutionsSubscriptionRequest(thing_name=thing_name)
+        await self.subscribe(
+            self.jobs_client.subscribe_to_get_pending_job_executions_accepted,
+            get_jobs_request,
+            lambda response: self.call_in_loop(
+                self.on_get_pending_job_executions_accepted, response
+            ),
+        )
+        await self.subscribe(
+            self.jobs_client.subscribe_to_get_pending_job_executions_rejected,
+            get_jobs_request,
+            lambda error: self.call_in_loop(
+                self.exit, f"Get pending jobs request rejected: {error}"
+            ),
+        )
+
+        if self.job_prefetch_callback:
+            logger.info(
+                "Subscribing to DescribeJobExecution responses...", extra={"thing_name": thing_name}
+            )
+            describe_request = iotjobs.DescribeJobExecutionSubscriptionRequest(
+                thing_name=thing_name, job_id="+"
+            )
+            await self.subscribe(
+                self.jobs_client.subscribe_to_describe_job_execution_accepted,
+                describe_request,
+                lambda response: self.call_in_loop(self.on_job_described, response),
+            )
+
+        logger.info("Subscribing to Next Changed events...", extra={"thing_name": thing_name})
+        await self.subscribe(
+            self.jobs_client.subscribe_to_next_job_execution_changed_events,
+            iotjobs.NextJobExecutionChangedSubscriptionRequest(thing_name=thing_name),
+            lambda event: self.call_in_loop(self.on_next_job_execution_changed, event),
+        )
+
+        logger.info("Subscribing to Start responses...", extra={"thing_name": thing_name})
+        start_request = iotjobs.StartNextPendingJobExecutionSubscriptionRequest(
+            thing_name=thing_name
+        )
+        await self.subscribe(
+            self.jobs_client.subscribe_to_start_next_pending_job_execution_accepted,
+            start_request,
+            self.on_response,
+        )
+        await self.subscribe(
+            self.jobs_client.subscribe_to_start_next_pending_job_execution_rejected,
+            start_request,
+            self.on_rejected,
+        )
+
+        logger.info("Subscribing to Update responses...", extra={"thing_name": thing_name})
+        # Note that we subscribe to "+", the MQTT wildcard, to receive
+        # responses about any job-ID.
+        update_request = iotjobs.UpdateJobExecutionSubscriptionRequest(
+            thing_name=thing_name, job_id="+"
+        )
+        await self.subscribe(
+            self.jobs_client.subscribe_to_update_job_execution_accepted,
+            update_request,
+            self.on_response,
+        )
+        await self.subscribe(
+            self.jobs_client.subscribe_to_update_job_execution_rejected,
+            update_request,
+            self.on_rejected,
+        )
+
+    # Function for gracefully quitting. Must be called on the event loop, use call_in_loop from
+    # other threads.
+    def exit(self, msg_or_exception):
+        if isinstance(msg_or_exception, Exception):
+            logger.error(
+                "Exiting due to exception.",
+                exc_info=msg_or_exception,
+                extra={"thing_name": self.thing_name},
+            )
+        else:
+            logger.error("Exiting: %s", msg_or_exception, extra={"thing_name": self.thing_name})
+        self.stopped.set()
+
+    async def run_async(self):
+        self.loop = asyncio.get_running_loop()
+        self.job_waiting = asyncio.Event()
+        self.stopped = asyncio.Event()
+
+        job_loop_task = None
+        try:
+            with metrics.timer("subscription_setup"):
+                await self.subscribe_all()
+            if self.journal:
+                await self.replay_unpublished_statuses()
+
+            # List the jobs queued and pending
+            get_jobs_request = iotjobs.GetPendingJobExecutionsRequest(thing_name=self.thing_name)
+            await self.await_crt_future(
+                self.jobs_client.publish_get_pending_job_executions(
+                    request=get_jobs_request, qos=mqtt.QoS.AT_LEAST_ONCE
+                )
+            )
+
+            # Make initial attempt to start next job
+            self.job_waiting.set()
+            job_loop_task = asyncio.create_task(self.job_loop())
+            job_loop_task.add_done_callback(
+                lambda task: task.cancelled() or self.exit(task.exception() or "Job loop ended")
+            )
+            await self.stopped.wait()
+        except Exception as e:
+            self.exit(e)
+        finally:
+            self.set_state(JobState.STOPPED)
+            if job_loop_task:
+                job_loop_task.cancel()
+            if self.owns_executor:
+                self.executor.shutdown(wait=False)
+
+        if self.owns_connection:
+            logger.info("Disconnecting...", extra={"thing_name": self.thing_name})
+            await asyncio.wrap_future(self.mqtt_connection.disconnect())
+            logger.info("Disconnected.", extra={"thing_name": self.thing_name})
+
+    def run(self):
+        asyncio.run(self.run_async())
@@ -1,68 +1,308 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
+import json
+import logging
+import os
+import socket
+import time
 from awscrt import io
-from awsiot.greengrass_discovery import DiscoveryClient
+from awsiot.greengrass_discovery import DiscoveryClient, DiscoverResponse
 from awsiot import mqtt_connection_builder
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from metrics import metrics
+import mqtt5_connection
 
+logger = logging.getLogger(__name__)
+
+# Discovery responses are cached on disk so that a restart can reconnect without a cloud round trip
+discovery_cache_dir = os.environ.get("DISCOVERY_CACHE_DIR", "/var/cache/agent/discovery")
+discovery_cache_ttl = int(os.environ.get("DISCOVERY_CACHE_TTL_SECONDS", "86400"))
+# How long to wait for a TCP connection when checking which core endpoints are reachable
+probe_timeout = float(os.environ.get("DISCOVERY_PROBE_TIMEOUT_SECONDS", "3"))
+# MQTT 5 aliases the long jobs and telemetry topics, applies flow control and expires the session
+mqtt_version = int(os.environ.get("MQTT_VERSION", "3"))
+mqtt5_connection.check_mqtt_version(mqtt_version)
+session_expiry = int(
+    os.environ.get(
+        "MQTT_SESSION_EXPIRY_SECONDS", str(mqtt5_connection.DEFAULT_SESSION_EXPIRY_SECONDS)
+    )
+)
+receive_maximum = int(
+    os.environ.get("MQTT_RECEIVE_MAXIMUM", str(mqtt5_connection.DEFAULT_RECEIVE_MAXIMUM))
+)
+topic_alias_cache_size = int(
+    os.environ.get(
+        "MQTT_TOPIC_ALIAS_CACHE_SIZE", str(mqtt5_connection.DEFAULT_TOPIC_ALIAS_CACHE_SIZE)
+    )
+)
+
+
+def discover_response_to_payload(discover_response):
+    # Inverse of DiscoverResponse.from_payload
+    return {
+        "GGGroups": [
+            {
+                "GGGroupId": gg_group.gg_group_id,
+                "Cores": [
+                    {
+                        "thingArn": gg_core.thing_arn,
+                        "Connectivity": [
+                            {
+                                "Id": connectivity_info.id,
+                                "HostAddress": connectivity_info.host_address,
+                                "PortNumber": connectivity_info.port,
+                                "Metadata": connectivity_info.metadata,
+                            }
+                            for connectivity_info in gg_core.connectivity
+                        ],
+                    }
+                    for gg_core in gg_group.cores
+                ],
+                "CAs": gg_group.certificate_authorities,
+            }
+            for gg_group in discover_response.gg_groups
+        ]
+    }
+
+
+def get_cache_path(thing_name):
+    return os.path.join(discovery_cache_dir, f"{thing_name}.json")
+
+
+def load_cached_discovery(thing_name):
+    # Returns None unless the cache has the layout written by save_cached_discovery, so that a
+    # hand-edited or older cache file falls back to discovering again
+    try:
+        with open(get_cache_path(thing_name)) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    try:
+        if not isinstance(cached["discovered_at"], (int, float)):
+            raise TypeError("discovered_at is not a timestamp")
+        DiscoverResponse.from_payload(cached["response"])
+        last_good = cached.get("last_good")
+        if last_good is not None and not (
+            isinstance(last_good, dict) and {"host", "port"} <= last_good.keys()
+        ):
+            raise ValueError("last_good is not an endpoint")
+    except (KeyError, TypeError, ValueError, AttributeError) as e:
+        logger.warning("Ignoring discovery cache with an unexpected layout: %r", e)
+        return None
+    cached.setdefault("last_good", None)
+    return cached
 
-def get_mqtt_connection(thing_name, key, cert, region):
-    tls_options = io.TlsContextOptions.create_client_with_mtls_from_path(cert, key)
-    tls_context = io.ClientTlsContext(tls_options)
 
-    socket_options = io.SocketOptions()
+def save_cached_discovery(thing_name, cached):
+    try:
+        os.makedirs(discovery_cache_dir, exist_ok=True)
+        cache_path = get_cache_path(thing_name)
+        with open(cache_path + ".tmp", "w") as f:
+            json.dump(cached, f)
+        os.replace(cache_path + ".tmp", cache_path)
+    except OSError as e:
+        logger.warning("Could not write discovery cache: %s", e)
 
-    proxy_options = None
 
-    print("Performing greengrass discovery...")
+def discover(thing_name, tls_context, region):
+    logger.info("Performing greengrass discovery...", extra={"thing_name": thing_name})
     discovery_client = DiscoveryClient(
         io.ClientBootstrap.get_or_create_static_default(),
-        socket_options,
+        io.SocketOptions(),
         tls_context,
         region,
         None,
-        proxy_options,
+        None,
     )
-    resp_future = discovery_client.discover(thing_name)
-    discover_response = resp_future.result()
+    with metrics.timer("discovery"):
+        resp_future = discovery_client.discover(thing_name)
+        return resp_future.result()
+
+
+def probe_endpoint(host, port):
+    start = time.monotonic()
+    with socket.create_connection((host, port), timeout=probe_timeout):
+        return time.monotonic() - start
+
+
+def get_endpoints(discover_response):
+    return [
+        (gg_group, gg_core, connectivity_info)
+        for gg_group in discover_response.gg_groups
+        for gg_core in gg_group.cores
+        for connectivity_info in gg_core.connectivity
+    ]
+
+
+def is_same_endpoint(connectivity_info, last_good):
+    return (
+        last_good is not None
+        and connectivity_info.host_address == last_good["host"]
+        and connectivity_info.port == last_good["port"]
+    )
+
+
+def race_endpoints(endpoints):
+    # Probe every endpoint concurrently and yield them as they turn out to be reachable, so that
+    # unreachable addresses cost one probe timeout in total rather than one connect timeout each.
+    # Only the TCP connection is raced: MQTT connections would share the client id and kick each
+    # other off any core reachable through several addresses.
+    if not endpoints:
+        return
+    executor = ThreadPoolExecutor(max_workers=len(endpoints), thread_name_prefix="probe")
+    try:
+        probes = {
+            executor.submit(probe_endpoint, endpoint[2].host_address, endpoint[2].port): endpoint
+            for endpoint in endpoints
+        }
+        for probe in as_completed(probes):
+            endpoint = probes[probe]
+            try:
+                latency = probe.result()
+            except OSError as e:
+                logger.info(
+                    "Host %s port %s unreachable: %s",
+                    endpoint[2].host_address,
+                    endpoint[2].port,
+                    e,
+                )
+                continue
+            logger.info(
+                "Host %s port %s reachable in %.0fms",
+                endpoint[2].host_address,
+                endpoint[2].port,
+                latency * 1000,
+            )
+            yield endpoint
+    finally:
+        # Don't wait for the slower probes once a connection has been made
+        executor.shutdown(wait=False)
 
+
+def connect_to_endpoint(thing_name, key, cert, gg_group, gg_core, connectivity_info):
     def on_connection_interupted(connection, error, **kwargs):
-        print("connection interrupted with error {}".format(error))
+        logger.warning("Connection interrupted with error %s", error)
+        metrics.increment("mqtt_connection_interrupted")
 
     def on_connection_resumed(connection, return_code, session_present, **kwargs):
-        print(
-            "connection resumed with return code {}, session present {}".format(
-                return_code, session_present
-            )
+        metrics.increment("mqtt_connection_resumed")
+        logger.info(
+            "Connection resumed with return code %s, session present %s",
+            return_code,
+            session_present,
+        )
+
+    logger.info(
+        "Trying core %s at host %s port %s",
+        gg_core.thing_arn,
+        connectivity_info.host_address,
+        connectivity_info.port,
+    )
+    if mqtt_version == 5:
+        connection_id = mqtt5_connection.new_connection_id()
+        logger.info(
+            "Connecting with MQTT 5, connection id %s",
+            connection_id,
+            extra={"thing_name": thing_name},
+        )
+        mqtt_connection = mqtt5_connection.mtls_from_path(
+            endpoint=connectivity_info.host_address,
+            port=connectivity_info.port,
+            cert_filepath=cert,
+            pri_key_filepath=key,
+            ca_bytes=gg_group.certificate_authorities[0].encode("utf-8"),
+            on_connection_interrupted=on_connection_interupted,
+            on_connection_resumed=on_connection_resumed,
+            client_id=thing_name,
+            keep_alive_secs=30,
+            session_expiry=session_expiry,
+            receive_maximum=receive_maximum,
+            topic_alias_cache_size=topic_alias_cache_size,
+            user_properties={"thing-name": thing_name, "connection-id": connection_id},
         )
+    else:
+        mqtt_connection = mqtt_connection_builder.mtls_from_path(
+            endpoint=connectivity_info.host_address,
+            port=connectivity_info.port,
+            cert_filepath=cert,
+            pri_key_filepath=key,
+            ca_bytes=gg_group.certificate_authorities[0].encode("utf-8"),
+            on_connection_interrupted=on_connection_interupted,
+            on_connection_resumed=on_connection_resumed,
+            client_id=thing_name,
+            clean_session=False,
+            keep_alive_secs=30,
+        )
+
+    with metrics.timer("mqtt_connect"):
+        connect_future = mqtt_connection.connect()
+        connect_future.result()
+    logger.info("Connected!", extra={"thing_name": thing_name})
+    return mqtt_connection
+
+
+def connect_to_cores(thing_name, key, cert, discover_response, last_good):
+    # Returns the connection and the endpoint it was made to, or (None, None)
+    endpoints = get_endpoints(discover_response)
+
+    # The endpoint that worked last time is tried straight away, without waiting for any probes
+    for endpoint in endpoints:
+        if is_same_endpoint(endpoint[2], last_good):
+            endpoints.remove(endpoint)
+            try:
+                return connect_to_endpoint(thing_name, key, cert, *endpoint), endpoint[2]
+            except Exception as e:
+                logger.warning("Connection failed with exception %s", e)
+            break
+
+    for endpoint in race_endpoints(endpoints):
+        try:
+            return connect_to_endpoint(thing_name, key, cert, *endpoint), endpoint[2]
+        except Exception as e:
+            logger.warning("Connection failed with exception %s", e)
+            continue
+
+    return None, None
+
+
+def get_mqtt_connection(thing_name, key, cert, region):
+    tls_options = io.TlsContextOptions.create_client_with_mtls_from_path(cert, key)
+    tls_context = io.ClientTlsContext(tls_options)
+
+    cached = load_cached_discovery(thing_name)
+    if cached and time.time() - cached["discovered_at"] < discovery_cache_ttl:
+        logger.info("Using cached greengrass discovery response...")
+        discover_response = DiscoverResponse.from_payload(cached["response"])
+        mqtt_connection, endpoint = connect_to_cores(
+            thing_name, key, cert, discover_response, cached.get("last_good")
+        )
+        if mqtt_connection:
+            cached["last_good"] = {"host": endpoint.host_address, "port": endpoint.port}
+            save_cached_discovery(thing_name, cached)
+            return mqtt_connection
+        logger.warning("No core in the cached discovery response is reachable, rediscovering")
+
+    try:
+        discover_response = discover(thing_name, tls_context, region)
+        cached = {
+            "discovered_at": time.time(),
+            "response": discover_response_to_payload(discover_response),
+            "last_good": cached.get("last_good") if cached else None,
+        }
+    except Exception as e:
+        # Without the cloud, an expired cache is still better than nothing
+        if not cached:
+            raise
+        logger.warning("Discovery failed with exception %s, falling back to the expired cache", e)
+        discover_response = DiscoverResponse.from_payload(cached["response"])
+
+    mqtt_connection, endpoint = connect_to_cores(
+        thing_name, key, cert, discover_response, cached["last_good"]
+    )
+    if not mqtt_connection:
+        raise RuntimeError("All connection attempts failed")
 
-    for gg_group in discover_response.gg_groups:
-        for gg_core in gg_group.cores:
-            for connectivity_info in gg_core.connectivity:
-                try:
-                    print(
-                        f"Trying core {gg_core.thing_arn} at host {connectivity_info.host_address} port {connectivity_info.port}"
-                    )
-                    mqtt_connection = mqtt_connection_builder.mtls_from_path(
-                        endpoint=connectivity_info.host_address,
-                        port=connectivity_info.port,
-                        cert_filepath=cert,
-                        pri_key_filepath=key,
-                        ca_bytes=gg_group.certificate_authorities[0].encode("utf-8"),
-                        on_connection_interrupted=on_connection_interupted,
-                        on_connection_resumed=on_connection_resumed,
-                        client_id=thing_name,
-                        clean_session=False,
-                        keep_alive_secs=30,
-                    )
-
-                    connect_future = mqtt_connection.connect()
-                    connect_future.result()
-                    print("Connected!")
-                    return mqtt_connection
-
-                except Exception as e:
-                    print("Connection failed with exception {}".format(e))
-                    continue
-
-    raise RuntimeError("All connection attempts failed")
+    cached["last_good"] = {"host": endpoint.host_address, "port": endpoint.port}
+    save_cached_discovery(thing_name, cached)
+    return mqtt_connection
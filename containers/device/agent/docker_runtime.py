@@ -0,0 +1,352 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import logging
+import threading
+import time
+import docker
+
+logger = logging.getLogger(__name__)
+
+DEVICE_LABEL = "device"
+EVENT_STREAM_RETRY_SECONDS = 5
+# Statuses of the pull progress messages that are about a single layer
+LAYER_PULL_STATUSES = {
+    "Pulling fs layer",
+    "Waiting",
+    "Downloading",
+    "Verifying Checksum",
+    "Download complete",
+    "Extracting",
+    "Pull complete",
+    "Already exists",
+}
+
+
+class ContainerState:
+    def __init__(self, container_id, name, device, status, image=None):
+        self.id = container_id
+        self.name = name
+        self.device = device
+        self.status = status
+        # Image reference the container was created from
+        self.image = image
+        # Result of the image's HEALTHCHECK, None if it has none or has not reported yet
+        self.health = None
+
+
+# Maps docker container event actions to the resulting container status
+CONTAINER_EVENT_STATUS = {
+    "create": "created",
+    "start": "running",
+    "restart": "running",
+    "unpause": "running",
+    "pause": "paused",
+    "die": "exited",
+    "stop": "exited",
+    "kill": "exited",
+}
+
+
+class DockerRuntime:
+    # Long-lived docker client for the agent. Keeps an in-memory index of the firmware containers
+    # (anything with a "device" label) and of the local image tags, seeded once and then kept
+    # current from the docker events stream, so jobs can read state without calling the daemon.
+    def __init__(self, client_factory=docker.from_env):
+        self.client_factory = client_factory
+        self.client = None
+        self.lock = threading.Lock()
+        # Notified whenever the state of a container changes
+        self.container_changed = threading.Condition(self.lock)
+        self.containers = {}  # container name -> ContainerState
+        self.images = {}  # image tag -> image id
+        self.events_stream = None
+        self.events_thread = None
+        self.is_stopping = False
+
+    def start(self, connect_timeout=60):
+        deadline = time.monotonic() + connect_timeout
+        while True:
+            try:
+                self.client = self.client_factory()
+                self.client.ping()
+                break
+            except Exception as e:
+                # dockerd is started alongside the agent and may not be up yet
+                if time.monotonic() > deadline:
+                    raise
+                logger.info("Waiting for docker daemon: %s", e)
+                time.sleep(1)
+
+        self.open_events_stream()
+        self.resync()
+        self.events_thread = threading.Thread(
+            target=self.events_thread_fn, name="docker_events_thread", daemon=True
+        )
+        self.events_thread.start()
+
+    def stop(self):
+        self.is_stopping = True
+        if self.events_stream:
+            self.events_stream.close()
+
+    def open_events_stream(self):
+        # The stream is opened before the index is seeded so that no change is missed in between
+        self.events_stream = self.client.events(
+            decode=True, filters={"type": ["container", "image"]}
+        )
+
+    def resync(self):
+        containers = {}
+        for container in self.client.containers.list(
+            all=True, sparse=True, filters={"label": [DEVICE_LABEL]}
+        ):
+            attrs = container.attrs
+            name = attrs["Names"][0].lstrip("/")
+            containers[name] = ContainerState(
+                attrs["Id"],
+                name,
+                attrs["Labels"].get(DEVICE_LABEL),
+                attrs["State"],
+                attrs.get("Image"),
+            )
+        images = {}
+        for image in self.client.api.images():
+            for tag in image.get("RepoTags") or []:
+                images[tag] = image["Id"]
+
+        with self.lock:
+            self.containers = containers
+            self.images = images
+        logger.info(
+            "Docker state synced: %d containers, %d image tags", len(containers), len(images)
+        )
+
+    def events_thread_fn(self):
+        while not self.is_stopping:
+            try:
+                for event in self.events_stream:
+                    self.on_event(event)
+            except Exception as e:
+                if self.is_stopping:
+                    break
+                logger.warning("Docker events stream failed: %s", e)
+
+            if self.is_stopping:
+                break
+            # The stream ended (e.g. the daemon restarted), so reopen it and rebuild the index
+            time.sleep(EVENT_STREAM_RETRY_SECONDS)
+            try:
+                self.open_events_stream()
+                self.resync()
+            except Exception as e:
+                logger.warning("Failed to reopen docker events stream: %s", e)
+
+    def on_event(self, event):
+        event_type = event.get("Type")
+        action = event.get("Action", "")
+        actor = event.get("Actor", {})
+        attributes = actor.get("Attributes", {})
+
+        if event_type == "container":
+            device = attributes.get(DEVICE_LABEL)
+            name = attributes.get("name")
+            if not device or not name:
+                return
+            # Health status events come through as e.g. "health_status: healthy"
+            action, _, health = action.partition(":")
+            with self.lock:
+                self.container_changed.notify_all()
+                if action == "destroy":
+                    self.containers.pop(name, None)
+                elif action == "rename":
+                    old_name = attributes.get("oldName", "").lstrip("/")
+                    self.containers.pop(old_name, None)
+                    self.containers[name] = ContainerState(
+                        actor["ID"], name, device, "exited", attributes.get("image")
+                    )
+                elif action in CONTAINER_EVENT_STATUS:
+                    container = self.containers.get(name)
+                    if container is None or container.id != actor["ID"]:
+                        container = ContainerState(
+                            actor["ID"], name, device, "created", attributes.get("image")
+                        )
+                        self.containers[name] = container
+                    elif action == "create":
+                        # Arrived after run_container already recorded the container as running
+                        return
+                    container.status = CONTAINER_EVENT_STATUS[action]
+                    if action in ("start", "restart"):
+                        container.health = None
+                elif action == "health_status" and name in self.containers:
+                    self.containers[name].health = health.strip()
+
+        elif event_type == "image":
+            if action == "pull":
+                # Pull events carry the pulled reference, e.g. registry:5000/firmware:3, as their
+                # id, and the repository without the tag as their name
+                self.on_image_pulled(actor.get("ID"))
+            elif action == "tag" and attributes.get("name"):
+                with self.lock:
+                    self.images[attributes["name"]] = actor.get("ID")
+            elif action in ("untag", "delete"):
+                # These events only carry the image id, so drop every tag pointing at it
+                image_id = actor.get("ID")
+                with self.lock:
+                    for tag in [tag for tag, tag_id in self.images.items() if tag_id == image_id]:
+                        del self.images[tag]
+
+    def on_image_pulled(self, image_ref):
+        try:
+            image_id = self.client.api.inspect_image(image_ref)["Id"]
+        except docker.errors.APIError as e:
+            # Removed again already, the untag event takes care of the index
+            logger.debug("Could not inspect pulled image %s: %s", image_ref, e)
+            return
+        with self.lock:
+            self.images[image_ref] = image_id
+
+    def has_image(self, image_ref):
+        with self.lock:
+            return image_ref in self.images
+
+    def pull_image(self, image_ref, on_progress=None):
+        # Streams the pull so that on_progress(layers_done, layers_total, bytes_done, bytes_total)
+        # can be called as layers are downloaded
+        repository, tag = docker.utils.parse_repository_tag(image_ref)
+        layers = {}  # layer id -> [bytes downloaded, size, pulled]
+        for event in self.client.api.pull(repository, tag, stream=True, decode=True):
+            if "error" in event:
+                raise docker.errors.APIError(event["error"])
+            status = event.get("status")
+            if status not in LAYER_PULL_STATUSES:
+                continue
+            layer = layers.setdefault(event["id"], [0, 0, False])
+            if status == "Downloading":
+                detail = event.get("progressDetail") or {}
+                layer[0] = detail.get("current", layer[0])
+                layer[1] = detail.get("total", layer[1])
+            elif status == "Download complete":
+                layer[0] = layer[1]
+            elif status in ("Pull complete", "Already exists"):
+                layer[2] = True
+            if on_progress:
+                on_progress(
+                    sum(1 for layer in layers.values() if layer[2]),
+                    len(layers),
+                    sum(layer[0] for layer in layers.values()),
+                    sum(layer[1] for layer in layers.values()),
+                )
+        image = self.client.images.get(image_ref)
+        with self.lock:
+            self.images[image_ref] = image.id
+        return image
+
+    def get_container(self, name):
+        with self.lock:
+            state = self.containers.get(name)
+        if state is None:
+            return None
+        return self.container_model(state)
+
+    def is_running(self, name):
+        with self.lock:
+            state = self.containers.get(name)
+            return state is not None and state.status == "running"
+
+    def list_device_containers(self, device_name, status="running"):
+        with self.lock:
+            states = [
+                state
+                for state in self.containers.values()
+                if state.device == device_name and (status is None or state.status == status)
+            ]
+        return [self.container_model(state) for state in states]
+
+    def container_states(self):
+        with self.lock:
+            return [
+                ContainerState(state.id, state.name, state.device, state.status, state.image)
+                for state in self.containers.values()
+            ]
+
+    def container_model(self, state):
+        # Build the container object from the cached state rather than inspecting it
+        return self.client.containers.prepare_model({"Id": state.id, "Name": state.name})
+
+    def set_container_status(self, container, status):
+        with self.lock:
+            state = self.containers.get(container.name)
+            if state and state.id == container.id:
+                state.status = status
+                self.container_changed.notify_all()
+
+    def is_paused(self, name):
+        with self.lock:
+            state = self.containers.get(name)
+            return state is not None and state.status == "paused"
+
+    def wait_for_failure(self, name, timeout):
+        # Waits up to timeout for the container to stop running or turn unhealthy. Returns
+        # "exited" or "unhealthy", or None if it kept running.
+        deadline = time.monotonic() + timeout
+        with self.container_changed:
+            while True:
+                state = self.containers.get(name)
+                if state is None or state.status != "running":
+                    return "exited"
+                if state.health == "unhealthy":
+                    return "unhealthy"
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.container_changed.wait(remaining)
+
+    def run_container(self, image_ref, name, labels, **kwargs):
+        container = self.client.containers.run(image_ref, name=name, labels=labels, **kwargs)
+        with self.lock:
+            self.containers[name] = ContainerState(
+                container.id, name, labels.get(DEVICE_LABEL), "running", image_ref
+            )
+        return container
+
+    def restart_container(self, container):
+        if self.is_paused(container.name):
+            container.unpause()
+        container.restart()
+        self.set_container_status(container, "running")
+
+    def stop_container(self, container):
+        if self.is_paused(container.name):
+            container.unpause()
+        container.stop()
+        self.set_container_status(container, "exited")
+
+    def pause_container(self, container):
+        container.pause()
+        self.set_container_status(container, "paused")
+
+    def resume_container(self, container):
+        # Unpausing a standby is almost instant, a stopped container has to start from scratch
+        if self.is_paused(container.name):
+            container.unpause()
+            self.set_container_status(container, "running")
+        else:
+            self.restart_container(container)
+
+    def remove_container(self, container):
+        container.remove()
+        with self.lock:
+            state = self.containers.get(container.name)
+            if state and state.id == container.id:
+                del self.containers[container.name]
+
+    def remove_image(self, image_ref):
+        # Removes the tag, the image itself goes once no tag or container refers to it
+        self.client.images.remove(image_ref)
+        with self.lock:
+            self.images.pop(image_ref, None)
+
+    def disk_usage(self):
+        # Sizes of the images and containers, as reported by "docker system df -v"
+        return self.client.df()
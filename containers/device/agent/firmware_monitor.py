@@ -0,0 +1,81 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import logging
+import threading
+import time
+import payload_codec
+from awscrt import mqtt
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class VersionWaiter:
+    def __init__(self, version):
+        self.version = str(version)
+        self.created_at = time.monotonic()
+        self.first_message_at = None
+        self.event = threading.Event()
+
+    def wait(self, timeout):
+        return self.event.wait(timeout)
+
+    def set(self):
+        if not self.event.is_set():
+            self.first_message_at = time.monotonic()
+            self.event.set()
+
+    def time_to_first_message(self):
+        if self.first_message_at is None:
+            return None
+        return self.first_message_at - self.created_at
+
+
+class FirmwareMonitor:
+    # Watches the messages published by the firmware (see MqttPublisher.timer_callback) so that
+    # the agent can tell when a given firmware version is up and talking to the broker.
+    def __init__(self, mqtt_connection, topic):
+        self.mqtt_connection = mqtt_connection
+        self.topic = topic
+        self.lock = threading.Lock()
+        self.waiters = []
+
+    def start(self):
+        logger.info("Subscribing to firmware messages on %s...", self.topic)
+        subscribe_future, _ = self.mqtt_connection.subscribe(
+            topic=self.topic, qos=mqtt.QoS.AT_LEAST_ONCE, callback=self.on_message
+        )
+        subscribe_future.result()
+
+    def on_message(self, topic, payload, **kwargs):
+        try:
+            message = payload_codec.decode(payload)
+        except Exception:
+            logger.warning("Ignoring malformed firmware message on %s", topic)
+            return
+        version = str(message.get("version"))
+        with self.lock:
+            for waiter in self.waiters:
+                if waiter.version == version:
+                    waiter.set()
+
+    def expect_version(self, version):
+        # Register before starting the firmware, so that its first message cannot be missed
+        waiter = VersionWaiter(version)
+        with self.lock:
+            self.waiters.append(waiter)
+        return waiter
+
+    def forget(self, waiter):
+        with self.lock:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+
+    @contextmanager
+    def expecting(self, version):
+        waiter = self.expect_version(version)
+        try:
+            yield waiter
+        finally:
+            self.forget(waiter)
@@ -3,14 +3,25 @@
 
 import time
 import json
-import sys
-import traceback
+import logging
 import threading
 from awscrt import io, http, mqtt
 from awscrt.mqtt import QoS
 from awsiot.greengrass_discovery import DiscoveryClient
 from awsiot import iotjobs, mqtt_connection_builder
-from concurrent.futures import Future
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from job_journal import ACCEPTED, COMPLETED, STATUS_PUBLISHED
+from job_progress import (
+    PROGRESS_REQUEST_TIMEOUT,
+    JobProgress,
+    is_progress_token,
+    new_progress_token,
+    step_timeout_minutes,
+)
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
 
 
 class LockedData:
@@ -23,53 +34,141 @@ class LockedData:
 
 
 class JobHandler:
-    def __init__(self, thing_name, mqtt_connection, job_handler_callback):
+    def __init__(
+        self,
+        thing_name,
+        mqtt_connection,
+        job_handler_callback,
+        job_prefetch_callback=None,
+        pipeline_depth=0,
+        journal=None,
+    ):
         self.thing_name = thing_name
         self.job_handler_callback = job_handler_callback
+        # Optional callback invoked (on its own thread) as soon as a job is seen, so that slow
+        # preparation such as pulling the image can start before the job is actually started.
+        self.job_prefetch_callback = job_prefetch_callback
+        # With a pipeline depth, the list of pending jobs is kept up to date and the prefetch
+        # callback is run for up to that many jobs queued behind the current one (on that many
+        # threads), so their preparation overlaps with the running job. Jobs still run in order.
+        self.pipeline_depth = pipeline_depth
+        self.prefetch_executor = None
+        if pipeline_depth:
+            self.prefetch_executor = ThreadPoolExecutor(
+                max_workers=pipeline_depth, thread_name_prefix="prefetch_thread"
+            )
         self.mqtt_connection = mqtt_connection
         self.jobs_client = iotjobs.IotJobsClient(self.mqtt_connection)
         self.available_jobs = []
+        self.prefetched_job_ids = set()
         self.locked_data = LockedData()
         self.is_sample_done = threading.Event()
+        # When the outstanding StartNext and UpdateJobExecution requests were published
+        self.start_next_requested_at = None
+        self.update_requested_at = None
+        # IN_PROGRESS and replayed updates awaiting a response, by client token. The final update
+        # of a job is sent without a client token and handled by the update accepted callback.
+        self.progress_requests = {}
+        # With a JobJournal, job phases are recorded so that the job can be resumed after a restart
+        self.journal = journal
+        # Job whose final update is in flight
+        self.reporting_job_id = None
 
     def on_get_pending_job_executions_accepted_closure(self):
         def on_get_pending_job_executions_accepted(response):
             # type: (iotjobs.GetPendingJobExecutionsResponse) -> None
             with self.locked_data.lock:
                 if len(response.queued_jobs) > 0 or len(response.in_progress_jobs) > 0:
-                    print("Pending Jobs:")
                     for job in response.in_progress_jobs:
                         self.available_jobs.append(job)
-                        print(f"  In Progress: {job.job_id} @ {job.last_updated_at}")
                     for job in response.queued_jobs:
                         self.available_jobs.append(job)
-                        print(f"  {job.job_id} @ {job.last_updated_at}")
+                    logger.info(
+                        "Pending jobs",
+                        extra={
+                            "thing_name": self.thing_name,
+                            "in_progress": [job.job_id for job in response.in_progress_jobs],
+                            "queued": [job.job_id for job in response.queued_jobs],
+                        },
+                    )
                 else:
-                    print("No pending or queued jobs found!")
+                    logger.info("No pending or queued jobs found!")
                 self.locked_data.got_job_response = True
 
+            self.prefetch_pending_jobs()
+
         return on_get_pending_job_executions_accepted
 
     def on_get_pending_job_executions_rejected_closure(self):
         def on_get_pending_job_executions_rejected(error):
             # type: (iotjobs.RejectedError) -> None
-            print(f"Request rejected: {error.code}: {error.message}")
+            logger.error("Request rejected: %s: %s", error.code, error.message)
             self.exit("Get pending jobs request rejected!")
 
         return on_get_pending_job_executions_rejected
 
+    def on_job_executions_changed_closure(self):
+        def on_job_executions_changed(event):
+            # type: (iotjobs.JobExecutionsChangedEvent) -> None
+            try:
+                jobs = event.jobs or {}
+                in_progress_jobs = jobs.get(iotjobs.JobStatus.IN_PROGRESS, [])
+                queued_jobs = sorted(
+                    jobs.get(iotjobs.JobStatus.QUEUED, []),
+                    key=lambda job: job.queued_at.timestamp() if job.queued_at else 0,
+                )
+                with self.locked_data.lock:
+                    self.available_jobs = in_progress_jobs + queued_jobs
+                    # Forget jobs that are no longer pending
+                    self.prefetched_job_ids.intersection_update(
+                        job.job_id for job in self.available_jobs
+                    )
+                logger.info("Job executions changed, %d pending", len(self.available_jobs))
+                self.prefetch_pending_jobs()
+            except Exception as e:
+                self.exit(e)
+
+        return on_job_executions_changed
+
+    def on_describe_job_execution_accepted_closure(self):
+        def on_describe_job_execution_accepted(response):
+            # type: (iotjobs.DescribeJobExecutionResponse) -> None
+            try:
+                execution = response.execution
+                if execution and execution.job_document:
+                    self.prefetch_job(execution.job_id, execution.job_document)
+            except Exception as e:
+                self.exit(e)
+
+        return on_describe_job_execution_accepted
+
+    def on_describe_job_execution_rejected_closure(self):
+        def on_describe_job_execution_rejected(rejected):
+            # type: (iotjobs.RejectedError) -> None
+            # Prefetching is only an optimisation, so carry on without it
+            logger.warning(
+                "Request to describe job rejected: %s: %s", rejected.code, rejected.message
+            )
+
+        return on_describe_job_execution_rejected
+
     def on_next_job_execution_changed_closure(self):
         def on_next_job_execution_changed(event):
             # type: (iotjobs.NextJobExecutionChangedEvent) -> None
             try:
                 execution = event.execution
                 if execution:
-                    print(
-                        "Received Next Job Execution Changed event. job_id:{} job_document:{}".format(
-                            execution.job_id, execution.job_document
-                        )
+                    logger.info(
+                        "Received Next Job Execution Changed event",
+                        extra={"job_id": execution.job_id},
+                    )
+                    logger.debug(
+                        "Job document",
+                        extra={"job_id": execution.job_id, "job_document": execution.job_document},
                     )
 
+                    self.prefetch_job(execution.job_id, execution.job_document)
+
                     # Start job now, or remember to start it when current job is done
                     start_job_now = False
                     with self.locked_data.lock:
@@ -82,7 +181,7 @@ class JobHandler:
                         self.try_start_next_job()
 
                 else:
-                    print(
+                    logger.info(
                         "Received Next Job Execution Changed event: None. Waiting for further jobs..."
                     )
 
@@ -95,22 +194,37 @@ class JobHandler:
         def on_start_next_pending_job_execution_accepted(response):
             # type: (iotjobs.StartNextJobExecutionResponse) -> None
             try:
+                accepted_at = time.monotonic()
+                if self.start_next_requested_at is not None:
+                    metrics.observe(
+                        "start_next_round_trip", accepted_at - self.start_next_requested_at
+                    )
+                    self.start_next_requested_at = None
                 if response.execution:
                     execution = response.execution
-                    print(
-                        "Request to start next job was accepted. job_id:{} job_document:{}".format(
-                            execution.job_id, execution.job_document
-                        )
+                    logger.info(
+                        "Request to start next job was accepted", extra={"job_id": execution.job_id}
+                    )
+                    logger.debug(
+                        "Job document",
+                        extra={"job_id": execution.job_id, "job_document": execution.job_document},
                     )
+                    if self.journal:
+                        self.journal.record(execution.job_id, ACCEPTED)
 
                     # To emulate working on a job, spawn a thread that sleeps for a few seconds
                     job_thread = threading.Thread(
-                        target=lambda: self.job_thread_fn(execution.job_id, execution.job_document),
+                        target=lambda: self.job_thread_fn(
+                            execution.job_id,
+                            execution.job_document,
+                            accepted_at,
+                            execution.version_number,
+                        ),
                         name="job_thread",
                     )
                     job_thread.start()
                 else:
-                    print(
+                    logger.info(
                         "Request to start next job was accepted, but there are no jobs to be done. Waiting for further jobs..."
                     )
                     self.done_working_on_job()
@@ -135,7 +249,18 @@ class JobHandler:
         def on_update_job_execution_accepted(response):
             # type: (iotjobs.UpdateJobExecutionResponse) -> None
             try:
-                print("Request to update job was accepted.")
+                if is_progress_token(response.client_token):
+                    self.resolve_progress_request(response.client_token, response, None)
+                    return
+                logger.info("Request to update job was accepted.")
+                if self.journal and self.reporting_job_id:
+                    self.journal.record(self.reporting_job_id, STATUS_PUBLISHED)
+                    self.reporting_job_id = None
+                if self.update_requested_at is not None:
+                    metrics.observe(
+                        "update_job_round_trip", time.monotonic() - self.update_requested_at
+                    )
+                    self.update_requested_at = None
                 self.done_working_on_job()
             except Exception as e:
                 self.exit(e)
@@ -145,6 +270,13 @@ class JobHandler:
     def on_update_job_execution_rejected_closure(self):
         def on_update_job_execution_rejected(rejected):
             # type: (iotjobs.RejectedError) -> None
+            if is_progress_token(rejected.client_token):
+                self.resolve_progress_request(
+                    rejected.client_token,
+                    None,
+                    RuntimeError(f"{rejected.code}: {rejected.message}"),
+                )
+                return
             self.exit(
                 "Request to update job status was rejected. code:'{}' message:'{}'.".format(
                     rejected.code, rejected.message
@@ -158,7 +290,7 @@ class JobHandler:
             try:
                 future.result()  # raises exception if publish failed
 
-                print("Published request to start the next job.")
+                logger.debug("Published request to start the next job.")
 
             except Exception as e:
                 self.exit(e)
@@ -170,7 +302,7 @@ class JobHandler:
             # type: (Future) -> None
             try:
                 future.result()  # raises exception if publish failed
-                print("Published request to update job.")
+                logger.debug("Published request to update job.")
 
             except Exception as e:
                 self.exit(e)
@@ -180,36 +312,136 @@ class JobHandler:
     # Function for gracefully quitting this sample
     def exit(self, msg_or_exception):
         if isinstance(msg_or_exception, Exception):
-            print("Exiting Sample due to exception.")
-            traceback.print_exception(
-                msg_or_exception.__class__, msg_or_exception, sys.exc_info()[2]
-            )
+            logger.error("Exiting Sample due to exception.", exc_info=msg_or_exception)
         else:
-            print("Exiting Sample:", msg_or_exception)
+            logger.error("Exiting Sample: %s", msg_or_exception)
 
         with self.locked_data.lock:
             if not self.locked_data.disconnect_called:
-                print("Disconnecting...")
+                logger.info("Disconnecting...")
                 self.locked_data.disconnect_called = True
                 future = self.mqtt_connection.disconnect()
                 future.add_done_callback(self.on_disconnected_closure())
 
+    def send_tracked_update(self, request):
+        future = Future()
+        with self.locked_data.lock:
+            self.progress_requests[request.client_token] = future
+        self.jobs_client.publish_update_job_execution(request, mqtt.QoS.AT_LEAST_ONCE)
+        return future
+
+    def resolve_progress_request(self, client_token, response, error):
+        with self.locked_data.lock:
+            future = self.progress_requests.pop(client_token, None)
+        if future is None or future.done():
+            return
+        if error:
+            future.set_exception(error)
+        else:
+            future.set_result(response)
+
+    def replay_unpublished_statuses(self):
+        # Sends the final statuses recorded before a restart that the cloud never confirmed, so
+        # that those jobs are not started again
+        for job_id, completed in self.journal.unpublished():
+            logger.info("Replaying final status %s", completed["status"], extra={"job_id": job_id})
+            request = iotjobs.UpdateJobExecutionRequest(
+                thing_name=self.thing_name,
+                job_id=job_id,
+                status=completed["status"],
+                status_details=completed.get("status_details"),
+                client_token=new_progress_token(),
+            )
+            try:
+                self.send_tracked_update(request).result(timeout=PROGRESS_REQUEST_TIMEOUT)
+            except FutureTimeoutError:
+                # Tried again on the next start
+                logger.warning("Timed out replaying final status", extra={"job_id": job_id})
+                continue
+            except Exception as e:
+                # Most likely the status did reach the cloud before the restart
+                logger.info("Replayed final status rejected: %s", e, extra={"job_id": job_id})
+            self.journal.record(job_id, STATUS_PUBLISHED)
+
+    def request_job_description(self, job_id):
+        request = iotjobs.DescribeJobExecutionRequest(
+            thing_name=self.thing_name, job_id=job_id, include_job_document=True
+        )
+        publish_future = self.jobs_client.publish_describe_job_execution(
+            request, mqtt.QoS.AT_LEAST_ONCE
+        )
+        publish_future.add_done_callback(self.on_publish_describe_job_execution_closure())
+
+    def on_publish_describe_job_execution_closure(self):
+        def on_publish_describe_job_execution(future):
+            # type: (Future) -> None
+            try:
+                future.result()  # raises exception if publish failed
+                logger.debug("Published request to describe job.")
+
+            except Exception as e:
+                logger.warning("Failed to publish request to describe job: %s", e)
+
+        return on_publish_describe_job_execution
+
+    def prefetch_pending_jobs(self):
+        if not self.job_prefetch_callback:
+            return
+
+        # The pending jobs summary does not include the job document, so describe the jobs to be
+        # able to prefetch them. Without a pipeline depth every pending job is prefetched.
+        with self.locked_data.lock:
+            pending_jobs = self.available_jobs
+            if self.pipeline_depth:
+                pending_jobs = pending_jobs[: self.pipeline_depth + 1]
+            job_ids = [
+                job.job_id for job in pending_jobs if job.job_id not in self.prefetched_job_ids
+            ]
+
+        for job_id in job_ids:
+            self.request_job_description(job_id)
+
+    def prefetch_job(self, job_id, job_document):
+        if not self.job_prefetch_callback:
+            return
+
+        with self.locked_data.lock:
+            if job_id in self.prefetched_job_ids:
+                return
+            self.prefetched_job_ids.add(job_id)
+
+        def prefetch_thread_fn():
+            try:
+                self.job_prefetch_callback(job_id, job_document)
+            except Exception as e:
+                logger.warning("Prefetching job failed: %s", e, extra={"job_id": job_id})
+
+        # Prefetching can be slow, so keep it off the MQTT callback thread
+        if self.prefetch_executor:
+            self.prefetch_executor.submit(prefetch_thread_fn)
+        else:
+            prefetch_thread = threading.Thread(target=prefetch_thread_fn, name="prefetch_thread")
+            prefetch_thread.start()
+
     def try_start_next_job(self):
-        print("Trying to start the next job...")
+        logger.debug("Trying to start the next job...")
         with self.locked_data.lock:
             if self.locked_data.is_working_on_job:
-                print("Nevermind, already working on a job.")
+                logger.debug("Nevermind, already working on a job.")
                 return
 
             if self.locked_data.disconnect_called:
-                print("Nevermind, sample is disconnecting.")
+                logger.debug("Nevermind, sample is disconnecting.")
                 return
 
             self.locked_data.is_working_on_job = True
             self.locked_data.is_next_job_waiting = False
 
-        print("Publishing request to start next job...")
-        request = iotjobs.StartNextPendingJobExecutionRequest(thing_name=self.thing_name)
+        logger.info("Publishing request to start next job...")
+        self.start_next_requested_at = time.monotonic()
+        request = iotjobs.StartNextPendingJobExecutionRequest(
+            thing_name=self.thing_name, step_timeout_in_minutes=step_timeout_minutes
+        )
         publish_future = self.jobs_client.publish_start_next_pending_job_execution(
             request, mqtt.QoS.AT_LEAST_ONCE
         )
@@ -223,19 +455,57 @@ class JobHandler:
         if try_again:
             self.try_start_next_job()
 
-    def job_thread_fn(self, job_id, job_document):
+    def job_thread_fn(self, job_id, job_document, accepted_at, version_number):
         try:
-            print("Starting local work on job...")
-            # time.sleep(self.input_job_time)
-            success_status = self.job_handler_callback(job_id, job_document)
-            print("Done working on job.")
+            metrics.observe("job_queue", time.monotonic() - accepted_at)
+            logger.info("Starting local work on job...", extra={"job_id": job_id})
+            # A stalled job was already reported as FAILED, so the callback stops at its next
+            # phase and rolls back a cutover it has already made
+            progress = JobProgress(
+                job_id,
+                self.thing_name,
+                version_number,
+                self.send_tracked_update,
+                on_stalled=lambda: progress.cancel(),
+            )
+            progress.start()
+            try:
+                with metrics.timer("job"):
+                    success_status = self.job_handler_callback(job_id, job_document, progress)
+            finally:
+                expected_version = progress.stop()
+                with self.locked_data.lock:
+                    self.progress_requests.clear()
+            logger.info("Done working on job.", extra={"job_id": job_id})
+
+            if progress.stalled or progress.rejected:
+                # A stalled job was already reported as FAILED, and a rejected progress update
+                # means the job was cancelled or timed out in the cloud. Either way there is
+                # nothing left to report, but the next job only starts now that this one returned.
+                metrics.increment("jobs_stalled" if progress.stalled else "jobs_cancelled")
+                if self.journal:
+                    self.journal.record(job_id, STATUS_PUBLISHED)
+                self.done_working_on_job()
+                return
 
             status = iotjobs.JobStatus.FAILED
             if success_status:
                 status = iotjobs.JobStatus.SUCCEEDED
-            print(f"Publishing request to update job status to {status}")
+            metrics.increment(f"jobs_{status.lower()}")
+            logger.info(
+                "Publishing request to update job status to %s", status, extra={"job_id": job_id}
+            )
+            status_details = progress.status_details()
+            if self.journal:
+                self.journal.record(job_id, COMPLETED, status=status, status_details=status_details)
+            self.reporting_job_id = job_id
+            self.update_requested_at = time.monotonic()
             request = iotjobs.UpdateJobExecutionRequest(
-                thing_name=self.thing_name, job_id=job_id, status=status
+                thing_name=self.thing_name,
+                job_id=job_id,
+                status=status,
+                status_details=status_details,
+                expected_version=expected_version,
             )
             publish_future = self.jobs_client.publish_update_job_execution(
                 request, mqtt.QoS.AT_LEAST_ONCE
@@ -248,7 +518,7 @@ class JobHandler:
     def on_disconnected_closure(self):
         def on_disconnected(disconnect_future):
             # type: (Future) -> None
-            print("Disconnected.")
+            logger.info("Disconnected.")
 
             # Signal that sample is finished
             self.is_sample_done.set()
@@ -256,9 +526,10 @@ class JobHandler:
         return on_disconnected
 
     def run(self):
+        subscription_setup_start = time.monotonic()
         try:
             # List the jobs queued and pending
-            print("Subscribing to GetPendingJobExecutions responses...")
+            logger.info("Subscribing to GetPendingJobExecutions responses...")
             get_jobs_request = iotjobs.GetPendingJobExecutionsRequest(thing_name=self.thing_name)
             jobs_request_future_accepted, _ = (
                 self.jobs_client.subscribe_to_get_pending_job_executions_accepted(
@@ -280,6 +551,46 @@ class JobHandler:
             # Wait for the subscription to succeed
             jobs_request_future_rejected.result()
 
+            if self.job_prefetch_callback:
+                # Subscribe to describe responses for any job-ID, so pending jobs can be prefetched
+                logger.info("Subscribing to DescribeJobExecution responses...")
+                describe_subscription_request = iotjobs.DescribeJobExecutionSubscriptionRequest(
+                    thing_name=self.thing_name, job_id="+"
+                )
+                describe_future_accepted, _ = (
+                    self.jobs_client.subscribe_to_describe_job_execution_accepted(
+                        request=describe_subscription_request,
+                        qos=mqtt.QoS.AT_LEAST_ONCE,
+                        callback=self.on_describe_job_execution_accepted_closure(),
+                    )
+                )
+                describe_future_rejected, _ = (
+                    self.jobs_client.subscribe_to_describe_job_execution_rejected(
+                        request=describe_subscription_request,
+                        qos=mqtt.QoS.AT_LEAST_ONCE,
+                        callback=self.on_describe_job_execution_rejected_closure(),
+                    )
+                )
+                # Wait for the subscriptions to succeed
+                describe_future_accepted.result()
+                describe_future_rejected.result()
+
+            if self.job_prefetch_callback and self.pipeline_depth:
+                # Keep track of jobs queued behind the current one, which are not announced by
+                # the Next Changed events
+                logger.info("Subscribing to Job Executions Changed events...")
+                executions_changed_future, _ = (
+                    self.jobs_client.subscribe_to_job_executions_changed_events(
+                        request=iotjobs.JobExecutionsChangedSubscriptionRequest(
+                            thing_name=self.thing_name
+                        ),
+                        qos=mqtt.QoS.AT_LEAST_ONCE,
+                        callback=self.on_job_executions_changed_closure(),
+                    )
+                )
+                # Wait for the subscription to succeed
+                executions_changed_future.result()
+
             # Get a list of all the jobs
             get_jobs_request_future = self.jobs_client.publish_get_pending_job_executions(
                 request=get_jobs_request, qos=mqtt.QoS.AT_LEAST_ONCE
@@ -293,7 +604,7 @@ class JobHandler:
             # Subscribe to necessary topics.
             # Note that is **is** important to wait for "accepted/rejected" subscriptions
             # to succeed before publishing the corresponding "request".
-            print("Subscribing to Next Changed events...")
+            logger.info("Subscribing to Next Changed events...")
             changed_subscription_request = iotjobs.NextJobExecutionChangedSubscriptionRequest(
                 thing_name=self.thing_name
             )
@@ -307,7 +618,7 @@ class JobHandler:
             # Wait for subscription to succeed
             subscribed_future.result()
 
-            print("Subscribing to Start responses...")
+            logger.info("Subscribing to Start responses...")
             start_subscription_request = iotjobs.StartNextPendingJobExecutionSubscriptionRequest(
                 thing_name=self.thing_name
             )
@@ -331,7 +642,7 @@ class JobHandler:
             subscribed_accepted_future.result()
             subscribed_rejected_future.result()
 
-            print("Subscribing to Update responses...")
+            logger.info("Subscribing to Update responses...")
             # Note that we subscribe to "+", the MQTT wildcard, to receive
             # responses about any job-ID.
             update_subscription_request = iotjobs.UpdateJobExecutionSubscriptionRequest(
@@ -357,11 +668,14 @@ class JobHandler:
             # Wait for subscriptions to succeed
             subscribed_accepted_future.result()
             subscribed_rejected_future.result()
+            metrics.observe("subscription_setup", time.monotonic() - subscription_setup_start)
 
             # Make initial attempt to start next job. The service should reply with
             # an "accepted" response, even if no jobs are pending. The response
             # will contain data about the next job, if there is one.
             # (Will do nothing if we are in CI)
+            if self.journal:
+                self.replay_unpublished_statuses()
             self.try_start_next_job()
 
         except Exception as e:
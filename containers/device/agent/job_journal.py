@@ -0,0 +1,114 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Where each agent thing keeps its journal. The directory must survive agent restarts.
+job_journal_dir = os.environ.get("JOB_JOURNAL_DIR", "/var/lib/agent/journal")
+# Jobs that were never finished, for example because they were cancelled while the agent was
+# down, are forgotten after this long
+JOURNAL_RETENTION_SECONDS = 7 * 24 * 3600
+
+# Phases of a job, in the order they are recorded
+ACCEPTED = "accepted"
+IMAGE_PRESENT = "image_present"
+CONTAINER_STARTED = "container_started"
+# The job finished locally with the recorded status, which may not have reached the cloud yet
+COMPLETED = "completed"
+# The cloud confirmed the final status, or there is no final status left to send
+STATUS_PUBLISHED = "status_published"
+
+
+class JobJournal:
+    """
+    Append-only record of the phases each job went through, one JSON object per line. Every
+    record is flushed and fsynced before record() returns, so after a crash or power cycle the
+    journal holds every phase that was completed. A line torn by a crash is ignored on load.
+
+    The journal is compacted when it is opened: jobs whose final status was published are dropped,
+    so it only ever holds the jobs that were in flight plus those finished since the last start.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.jobs = {}  # job id -> {phase: fields}, in the order jobs were first recorded
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.load()
+        self.compact()
+        self.file = open(self.path, "a")
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return
+        for line in lines:
+            try:
+                entry = json.loads(line)
+                job_id = entry.pop("job_id")
+                phase = entry.pop("phase")
+            except (ValueError, KeyError):
+                logger.warning("Ignoring corrupt job journal line in %s", self.path)
+                continue
+            self.jobs.setdefault(job_id, {})[phase] = entry
+
+    def compact(self):
+        now = time.time()
+        self.jobs = {
+            job_id: phases
+            for job_id, phases in self.jobs.items()
+            if STATUS_PUBLISHED not in phases
+            and now - max(fields["time"] for fields in phases.values()) < JOURNAL_RETENTION_SECONDS
+        }
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            for job_id, phases in self.jobs.items():
+                for phase, fields in phases.items():
+                    f.write(json.dumps(dict(fields, job_id=job_id, phase=phase)) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+        self.sync_directory()
+
+    def sync_directory(self):
+        # Makes the rename itself durable
+        fd = os.open(os.path.dirname(self.path), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def record(self, job_id, phase, **fields):
+        fields["time"] = time.time()
+        line = json.dumps(dict(fields, job_id=job_id, phase=phase)) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.jobs.setdefault(job_id, {})[phase] = fields
+
+    def phases(self, job_id):
+        with self.lock:
+            return dict(self.jobs.get(job_id, {}))
+
+    def unpublished(self):
+        # (job id, fields of the completed phase) of every job whose final status may not have
+        # reached the cloud
+        with self.lock:
+            return [
+                (job_id, phases[COMPLETED])
+                for job_id, phases in self.jobs.items()
+                if COMPLETED in phases and STATUS_PUBLISHED not in phases
+            ]
+
+
+def open_journal(thing_name):
+    return JobJournal(os.path.join(job_journal_dir, f"{thing_name}.jsonl"))
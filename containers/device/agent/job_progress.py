@@ -0,0 +1,178 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import asyncio
+import logging
+import os
+import threading
+import time
+import uuid
+from awsiot import iotjobs
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+logger = logging.getLogger(__name__)
+
+# Progress changes are coalesced into at most one IN_PROGRESS update per interval
+progress_interval = float(os.environ.get("PROGRESS_INTERVAL_SECONDS", "2"))
+# An IN_PROGRESS update is sent at least this often, even without any progress, to renew the step
+# timeout
+heartbeat_interval = float(os.environ.get("PROGRESS_HEARTBEAT_SECONDS", "20"))
+# Step timeout set by every update. If the agent stops sending updates, for example because it
+# crashed, the cloud times the job out after this long (1 minute is the shortest IoT Jobs allows).
+step_timeout_minutes = int(os.environ.get("STEP_TIMEOUT_MINUTES", "1"))
+# A job whose phase makes no progress for this long is reported as FAILED straight away. Phases
+# that are expected to take longer (such as waiting for readiness) set their own stall timeout.
+default_stall_timeout = float(os.environ.get("PROGRESS_STALL_TIMEOUT_SECONDS", "30"))
+
+PROGRESS_TOKEN_PREFIX = "progress-"
+PROGRESS_REQUEST_TIMEOUT = 10
+
+
+def new_progress_token():
+    return f"{PROGRESS_TOKEN_PREFIX}{uuid.uuid4()}"
+
+
+def is_progress_token(client_token):
+    return bool(client_token) and client_token.startswith(PROGRESS_TOKEN_PREFIX)
+
+
+class JobProgress:
+    """
+    Reports the progress of one job as IN_PROGRESS status details. The job callback calls update()
+    as often as it likes, from any thread, and a background thread sends the latest details at
+    most every progress_interval, and at least every heartbeat_interval. Only one update is in
+    flight at a time, and each one carries the expected version of the job execution, so stop()
+    can hand the version over to the final update.
+
+    send_update(request) publishes an UpdateJobExecutionRequest and returns a
+    concurrent.futures.Future of the response, which fails if the update is rejected. If the
+    current phase makes no progress before its stall timeout, the job is reported as FAILED and
+    on_stalled() is called, without waiting for the job callback to return.
+
+    The job handler calls cancel() when the job should stop early, and the job callback checks
+    is_cancelled() between the phases of the job.
+    """
+
+    def __init__(self, job_id, thing_name, version_number, send_update, on_stalled=None):
+        self.job_id = job_id
+        self.thing_name = thing_name
+        self.version_number = version_number
+        self.send_update = send_update
+        self.on_stalled = on_stalled
+        self.condition = threading.Condition()
+        self.details = {}
+        self.changed = False
+        self.stall_deadline = None
+        self.sent_at = time.monotonic()
+        self.stopped = False
+        # Set when the cloud rejects an update, e.g. because the job was cancelled or timed out
+        self.rejected = False
+        self.stalled = False
+        # Set when the job was cancelled or timed out, and the callback should stop
+        self.cancel_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.update("started")
+        self.thread = threading.Thread(target=self.thread_fn, name="progress_thread", daemon=True)
+        self.thread.start()
+
+    def update(self, phase, stall_timeout=None, **details):
+        # Status details values must be strings
+        details = {key: str(value) for key, value in details.items()}
+        with self.condition:
+            details["phase"] = phase
+            if details != self.details:
+                self.details = details
+                self.changed = True
+                self.stall_deadline = time.monotonic() + (stall_timeout or default_stall_timeout)
+                self.condition.notify_all()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def is_cancelled(self):
+        return self.cancel_event.is_set()
+
+    def stop(self):
+        # Returns the version to send the final update with, or None if it is not known
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        if self.thread:
+            self.thread.join()
+        return None if self.rejected else self.version_number
+
+    def status_details(self):
+        with self.condition:
+            return dict(self.details)
+
+    def next_wakeup(self, now):
+        # Called with the condition held
+        send_at = self.sent_at + (progress_interval if self.changed else heartbeat_interval)
+        return min(send_at, self.stall_deadline) - now
+
+    def thread_fn(self):
+        while True:
+            with self.condition:
+                while not self.stopped and self.next_wakeup(time.monotonic()) > 0:
+                    self.condition.wait(self.next_wakeup(time.monotonic()))
+                if self.stopped:
+                    return
+                if time.monotonic() >= self.stall_deadline:
+                    self.stalled = True
+                    status_details = dict(self.details, reason="stalled")
+                else:
+                    status_details = dict(self.details)
+                self.changed = False
+                self.sent_at = time.monotonic()
+
+            if self.stalled:
+                logger.error(
+                    "Job made no progress in phase %s, failing it",
+                    status_details["phase"],
+                    extra={"job_id": self.job_id, "thing_name": self.thing_name},
+                )
+                self.send(status_details, iotjobs.JobStatus.FAILED)
+                if self.on_stalled:
+                    self.on_stalled()
+                return
+            if not self.send(status_details, iotjobs.JobStatus.IN_PROGRESS):
+                return
+
+    def send(self, status_details, status):
+        request = iotjobs.UpdateJobExecutionRequest(
+            thing_name=self.thing_name,
+            job_id=self.job_id,
+            status=status,
+            status_details=status_details,
+            expected_version=self.version_number,
+            step_timeout_in_minutes=(
+                step_timeout_minutes if status == iotjobs.JobStatus.IN_PROGRESS else None
+            ),
+            include_job_execution_state=True,
+            client_token=new_progress_token(),
+        )
+        try:
+            response = self.send_update(request).result(timeout=PROGRESS_REQUEST_TIMEOUT)
+        except (FutureTimeoutError, asyncio.TimeoutError):
+            # The update may or may not have been applied, so the next one is sent without an
+            # expected version and picks the current version up from the response
+            logger.warning("Progress update timed out", extra={"job_id": self.job_id})
+            self.version_number = None
+            return True
+        except Exception as e:
+            logger.warning(
+                "Progress update rejected, no longer reporting progress: %s",
+                e,
+                extra={"job_id": self.job_id, "thing_name": self.thing_name},
+            )
+            self.rejected = True
+            return False
+        if response.execution_state and response.execution_state.version_number:
+            self.version_number = response.execution_state.version_number
+        logger.debug(
+            "Progress update accepted",
+            extra={"job_id": self.job_id, "status_details": status_details},
+        )
+        return True
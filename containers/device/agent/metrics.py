@@ -0,0 +1,135 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import bisect
+import json
+import logging
+import threading
+import time
+from awscrt import mqtt
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds, from MQTT round trips on a local network up to slow image pulls
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one counts values above every bucket
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    # Process-wide timing histograms and counters. Recording only takes a lock and a bisect, so it
+    # is cheap enough to leave on, and nothing is exported unless the endpoint or publisher is on.
+    def __init__(self, prefix="agent"):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.http_server = None
+
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    @contextmanager
+    def timer(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start)
+
+    def render_prometheus(self):
+        lines = []
+        with self.lock:
+            for name, value in sorted(self.counters.items()):
+                metric = f"{self.prefix}_{name}_total"
+                lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+            for name, histogram in sorted(self.histograms.items()):
+                metric = f"{self.prefix}_{name}_seconds"
+                lines.append(f"# TYPE {metric} histogram")
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_bucket{{le="+Inf"}} {histogram.count}')
+                lines.append(f"{metric}_sum {histogram.sum}")
+                lines.append(f"{metric}_count {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        # Compact form for the MQTT metrics message: counters, and count/sum per histogram
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "timings": {
+                    name: [histogram.count, round(histogram.sum, 4)]
+                    for name, histogram in self.histograms.items()
+                },
+            }
+
+    def start_http_server(self, port, host="0.0.0.0"):
+        metrics = self
+
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Scrapes are too frequent to log
+                pass
+
+        self.http_server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+        self.http_server.daemon_threads = True
+        thread = threading.Thread(
+            target=self.http_server.serve_forever, name="metrics_http_thread", daemon=True
+        )
+        thread.start()
+        logger.info("Serving metrics on port %s", port)
+
+    def start_mqtt_publisher(self, mqtt_connection, topic, interval):
+        def publish_thread_fn():
+            while True:
+                time.sleep(interval)
+                try:
+                    mqtt_connection.publish(
+                        topic=topic,
+                        payload=json.dumps(self.snapshot(), separators=(",", ":")),
+                        qos=mqtt.QoS.AT_MOST_ONCE,
+                    )
+                except Exception as e:
+                    logger.warning("Failed to publish metrics: %s", e)
+
+        thread = threading.Thread(target=publish_thread_fn, name="metrics_mqtt_thread", daemon=True)
+        thread.start()
+        logger.info("Publishing metrics to %s every %ss", topic, interval)
+
+
+metrics = Metrics()
@@ -0,0 +1,172 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import logging
+import threading
+import time
+import docker
+from contextlib import contextmanager
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Containers in these states hold the version their device is running
+IN_USE_STATUSES = ("running", "paused", "restarting")
+MB = 1024 * 1024
+
+
+class RetentionManager:
+    """
+    Removes old firmware versions: the image and the stopped containers created from it. The
+    versions the devices run, and the keep_versions they used most recently before that, are always
+    kept so that rolling back to them needs no pull. Older versions are removed least recently used
+    first, until the images and containers fit in disk_budget bytes, or all of them when there is
+    no budget.
+
+    Sweeps run on a background thread after every job, and every sweep_interval, but only while no
+    job is running, so they never slow an update down. A sweep stops as soon as a job starts. Each
+    removal holds removal_lock, which a starting job also takes, so a job waits for the removal in
+    progress rather than racing it for the same image.
+    """
+
+    def __init__(
+        self,
+        runtime,
+        is_firmware_image,
+        keep_versions,
+        disk_budget,
+        sweep_interval,
+        can_remove_image=None,
+    ):
+        self.runtime = runtime
+        self.is_firmware_image = is_firmware_image
+        self.keep_versions = keep_versions
+        self.disk_budget = disk_budget
+        self.sweep_interval = sweep_interval
+        # Called with an image reference before the image is removed, returns False to keep it
+        self.can_remove_image = can_remove_image
+        self.condition = threading.Condition()
+        self.removal_lock = threading.Lock()
+        self.active_jobs = 0
+        # Counts the jobs started, so a sweep notices one that started and ended since it began
+        self.jobs_started = 0
+        self.sweep_requested = True
+        self.last_used = {}  # image reference -> time it was last pulled or started
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.thread_fn, name="retention_thread", daemon=True)
+        self.thread.start()
+
+    def touch(self, image_ref):
+        with self.condition:
+            self.last_used[image_ref] = time.time()
+
+    @contextmanager
+    def job(self):
+        with self.condition:
+            self.active_jobs += 1
+            self.jobs_started += 1
+        # Stops the sweep before its next removal, and waits for the removal in progress
+        with self.removal_lock:
+            pass
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.active_jobs -= 1
+                self.sweep_requested = True
+                self.condition.notify_all()
+
+    def thread_fn(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.sweep_requested, self.sweep_interval)
+                self.condition.wait_for(lambda: self.active_jobs == 0)
+                self.sweep_requested = False
+            try:
+                with metrics.timer("retention_sweep"):
+                    self.sweep()
+            except Exception as e:
+                logger.warning("Retention sweep failed: %s", e)
+
+    def sweep(self):
+        usage = self.runtime.disk_usage()
+        images = {}  # firmware image reference -> its "docker system df" entry
+        for entry in usage.get("Images") or []:
+            for tag in entry.get("RepoTags") or []:
+                if self.is_firmware_image(tag):
+                    images[tag] = entry
+        container_sizes = {
+            container["Names"][0].lstrip("/"): container.get("SizeRw") or 0
+            for container in usage.get("Containers") or []
+        }
+        used = usage.get("LayersSize", 0) + sum(container_sizes.values())
+        states = self.runtime.container_states()
+        with self.condition:
+            last_used = dict(self.last_used)
+            jobs_started = self.jobs_started
+
+        def last_used_at(image_ref):
+            # Images the agent has not used since it started are ranked by when they were built
+            return last_used.get(image_ref) or images.get(image_ref, {}).get("Created", 0)
+
+        in_use = {state.image for state in states if state.status in IN_USE_STATUSES}
+        keep = set(in_use)
+        # The rollback versions of every device, and the most recently used versions overall,
+        # which include an image prefetched for a job that has not started yet
+        for device in {state.device for state in states}:
+            used_by_device = {state.image for state in states if state.device == device} - in_use
+            keep.update(
+                sorted(used_by_device, key=last_used_at, reverse=True)[: self.keep_versions]
+            )
+        keep.update(
+            sorted(set(images) - in_use, key=last_used_at, reverse=True)[: self.keep_versions]
+        )
+
+        for image_ref in sorted(set(images) - keep, key=last_used_at):
+            if self.disk_budget and used <= self.disk_budget:
+                return
+            with self.removal_lock:
+                # The containers and versions the sweep started from are out of date once a job
+                # has run, so it starts over after the job
+                with self.condition:
+                    if self.active_jobs or self.jobs_started != jobs_started:
+                        logger.info("A job started, pausing the retention sweep")
+                        self.sweep_requested = True
+                        return
+                if self.can_remove_image and not self.can_remove_image(image_ref):
+                    continue
+                try:
+                    freed = self.remove_version(image_ref, states, container_sizes)
+                except docker.errors.APIError as e:
+                    logger.warning("Could not remove firmware image %s: %s", image_ref, e)
+                    continue
+            # The layers are only freed once the image has no tag left
+            entry = images[image_ref]
+            entry["RepoTags"].remove(image_ref)
+            if not entry["RepoTags"]:
+                freed += entry.get("Size", 0) - max(entry.get("SharedSize", 0), 0)
+            used -= freed
+            metrics.increment("images_evicted")
+            logger.info("Removed firmware image %s, freeing %.1f MB", image_ref, freed / MB)
+
+        if self.disk_budget and used > self.disk_budget:
+            logger.warning(
+                "Firmware images use %.1f MB, over the %.1f MB budget, but every remaining version "
+                "is kept for rollback",
+                used / MB,
+                self.disk_budget / MB,
+            )
+
+    def remove_version(self, image_ref, states, container_sizes):
+        # Removes the containers created from the image, then the image. Returns the bytes the
+        # containers freed.
+        freed = 0
+        for state in states:
+            container = state.image == image_ref and self.runtime.get_container(state.name)
+            if container:
+                self.runtime.remove_container(container)
+                freed += container_sizes.get(state.name, 0)
+        self.runtime.remove_image(image_ref)
+        return freed
@@ -3,22 +3,93 @@
 
 import boto3
 import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
 
+# The ID of the deployment found or created is cached on the greengrass volume, so that later
+# startups only have to confirm it still exists
+deployment_cache_file = os.environ.get("DEPLOYMENT_CACHE_FILE", "/greengrass/deployment-cache.json")
 
-def check_deployment(deployment_name, client):
-    try:
-        # List all deployments
-        response = client.list_deployments()
-        deployments = response["deployments"]
 
-        # Filter deployments by name
-        for deployment in deployments:
-            deployment_id = deployment["deploymentId"]
-            deployment_details = client.get_deployment(deploymentId=deployment_id)
-            if deployment_details.get("deploymentName") == deployment_name:
-                return True
+def log(message):
+    # stdout is read by greengrass-entrypoint.sh, so diagnostics go to stderr
+    print(message, file=sys.stderr)
+
 
+def load_cached_deployment_id(deployment_name, target_arn):
+    try:
+        with open(deployment_cache_file) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
         return None
+    if cached.get("deploymentName") != deployment_name or cached.get("targetArn") != target_arn:
+        return None
+    return cached.get("deploymentId")
+
+
+def save_cached_deployment_id(deployment_name, target_arn, deployment_id):
+    try:
+        with open(deployment_cache_file + ".tmp", "w") as f:
+            json.dump(
+                {
+                    "deploymentName": deployment_name,
+                    "targetArn": target_arn,
+                    "deploymentId": deployment_id,
+                },
+                f,
+            )
+        os.replace(deployment_cache_file + ".tmp", deployment_cache_file)
+    except OSError as e:
+        log(f"Could not write deployment cache: {e}")
+
+
+def is_cached_deployment(deployment_name, target_arn, client):
+    deployment_id = load_cached_deployment_id(deployment_name, target_arn)
+    if not deployment_id:
+        return False
+    try:
+        deployment = client.get_deployment(deploymentId=deployment_id)
+    except client.exceptions.ResourceNotFoundException:
+        log(f"Cached deployment {deployment_id} no longer exists")
+        return False
+    return deployment.get("deploymentName") == deployment_name
+
+
+def find_deployment_id(deployment_name, client, target_arn=None):
+    # Only the latest revision of the deployments to the target is listed, across every page
+    list_args = {"historyFilter": "LATEST_ONLY"}
+    if target_arn:
+        list_args["targetArn"] = target_arn
+    unnamed = []
+    for page in client.get_paginator("list_deployments").paginate(**list_args):
+        for deployment in page["deployments"]:
+            if "deploymentName" not in deployment:
+                unnamed.append(deployment["deploymentId"])
+            elif deployment["deploymentName"] == deployment_name:
+                return deployment["deploymentId"]
+
+    # The list normally includes the names, fall back to looking the others up concurrently
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for deployment in executor.map(
+            lambda deployment_id: client.get_deployment(deploymentId=deployment_id), unnamed
+        ):
+            if deployment.get("deploymentName") == deployment_name:
+                return deployment["deploymentId"]
+    return None
+
+
+def check_deployment(deployment_name, client, target_arn=None):
+    try:
+        if target_arn and is_cached_deployment(deployment_name, target_arn, client):
+            return True
+
+        deployment_id = find_deployment_id(deployment_name, client, target_arn)
+        if not deployment_id:
+            return None
+        if target_arn:
+            save_cached_deployment_id(deployment_name, target_arn, deployment_id)
+        return True
     except client.exceptions.BadRequestException:
         print(f"No deployment '{deployment_name}' found.")
         return False
@@ -36,6 +107,17 @@ def get_account_info(client):
         return None
 
 
+def get_target_arn(deployment_template_file, region, account_id):
+    with open(deployment_template_file, "r") as f:
+        deployment_template = json.load(f)
+    # Replace placeholders with actual values
+    return (
+        deployment_template["targetArn"]
+        .replace("<REGION>", region)
+        .replace("<ACCOUNT>", account_id)
+    )
+
+
 def create_deployment(deployment_template_file, region, account_id):
     client = boto3.client("greengrassv2", region_name=region)
 
@@ -43,12 +125,7 @@ def create_deployment(deployment_template_file, region, account_id):
         with open(deployment_template_file, "r") as f:
             deployment_template = json.load(f)
 
-        # Replace placeholders with actual values
-        target_arn = (
-            deployment_template["targetArn"]
-            .replace("<REGION>", region)
-            .replace("<ACCOUNT>", account_id)
-        )
+        target_arn = get_target_arn(deployment_template_file, region, account_id)
         print("Target ARN for deployment", target_arn)
         deployment_template["targetArn"] = target_arn
 
@@ -63,6 +140,9 @@ def create_deployment(deployment_template_file, region, account_id):
             components=components,
             deploymentPolicies=deployment_policies,
         )
+        save_cached_deployment_id(
+            deployment_template["deploymentName"], target_arn, response["deploymentId"]
+        )
 
         return response
 
@@ -84,7 +164,8 @@ if __name__ == "__main__":
             "Failed to retrieve account information. So unable to check deployment. Check IoT Policy."
         )
     else:
-        deployment = check_deployment(specific_deployment_name, client)
+        target_arn = get_target_arn(deployment_template_file, region, account_id)
+        deployment = check_deployment(specific_deployment_name, client, target_arn)
 
         if deployment:
             # print(f"Found deployment: {specific_deployment_name}")
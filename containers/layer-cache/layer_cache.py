@@ -0,0 +1,266 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Pull-through cache for the firmware registry. Devices pull from this service instead of the
+# registry. Blobs are stored on disk by digest, and concurrent requests for a blob that is not
+# cached yet share a single upstream fetch: every client streams the blob from the cache file as
+# it is being downloaded. Tag manifests are always looked up upstream, since tags can move.
+
+import hashlib
+import logging
+import os
+import re
+import threading
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+upstream = os.environ.get("UPSTREAM", "http://registry:5000").rstrip("/")
+cache_dir = os.environ.get("CACHE_DIR", "/var/lib/layer-cache")
+port = int(os.environ.get("PORT", "5000"))
+upstream_timeout = int(os.environ.get("UPSTREAM_TIMEOUT_SECONDS", "30"))
+
+CHUNK_SIZE = 1024 * 1024
+BLOB_PATH = re.compile(r"^/v2/(?P<name>.+)/blobs/(?P<digest>sha256:[0-9a-f]{64})$")
+MANIFEST_PATH = re.compile(r"^/v2/(?P<name>.+)/manifests/(?P<reference>[^/]+)$")
+# Headers of upstream manifest responses that are passed on to clients
+MANIFEST_HEADERS = ("Content-Type", "Content-Length", "Docker-Content-Digest", "ETag")
+
+logger = logging.getLogger("layer_cache")
+
+
+class Fetch:
+    # One upstream download of a blob, followed by every client that asked for it meanwhile
+    def __init__(self, digest, temp_path):
+        self.digest = digest
+        self.temp_path = temp_path
+        self.size = None
+        self.written = 0
+        self.done = False
+        self.error = None
+        self.condition = threading.Condition()
+
+    def wait_for_size(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.size is not None or self.done)
+            if self.error:
+                raise self.error
+            return self.size
+
+    def wait_for(self, offset):
+        # Blocks until more than offset bytes were written or the fetch ended, returns how many
+        # bytes are available
+        with self.condition:
+            self.condition.wait_for(lambda: self.written > offset or self.done)
+            if self.error:
+                raise self.error
+            return self.written
+
+    def update(self, **fields):
+        with self.condition:
+            for key, value in fields.items():
+                setattr(self, key, value)
+            self.condition.notify_all()
+
+
+class LayerCache:
+    def __init__(self, upstream, cache_dir):
+        self.upstream = upstream
+        self.blob_dir = os.path.join(cache_dir, "blobs")
+        self.temp_dir = os.path.join(cache_dir, "tmp")
+        os.makedirs(self.blob_dir, exist_ok=True)
+        os.makedirs(self.temp_dir, exist_ok=True)
+        # Leftovers of downloads interrupted by a restart
+        for name in os.listdir(self.temp_dir):
+            os.remove(os.path.join(self.temp_dir, name))
+        self.lock = threading.Lock()
+        self.fetches = {}  # digest -> Fetch in progress
+        self.counters = {"hits": 0, "misses": 0, "coalesced": 0, "upstream_bytes": 0}
+
+    def blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest.replace(":", "_"))
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def open_blob(self, name, digest):
+        # Returns (file, size, fetch). fetch is None when the blob is served from the cache,
+        # otherwise the file is still being written and reads must follow fetch.written.
+        with self.lock:
+            path = self.blob_path(digest)
+            if os.path.exists(path):
+                self.counters["hits"] += 1
+                return open(path, "rb"), os.path.getsize(path), None
+            fetch = self.fetches.get(digest)
+            if fetch is None:
+                self.counters["misses"] += 1
+                fetch = Fetch(digest, os.path.join(self.temp_dir, digest.replace(":", "_")))
+                # The file exists before anyone tries to open it
+                open(fetch.temp_path, "wb").close()
+                self.fetches[digest] = fetch
+                threading.Thread(
+                    target=self.fetch_blob, args=(name, fetch), name="fetch_thread", daemon=True
+                ).start()
+            else:
+                self.counters["coalesced"] += 1
+            # Opened while the download is registered, so the temp file cannot have been renamed
+            # or removed yet. An open file keeps working once it is.
+            f = open(fetch.temp_path, "rb")
+        try:
+            return f, fetch.wait_for_size(), fetch
+        except Exception:
+            f.close()
+            raise
+
+    def blob_size(self, name, digest):
+        # For HEAD requests, which must not start a download: the size of the cached blob, or
+        # else the size upstream reports
+        try:
+            return os.path.getsize(self.blob_path(digest))
+        except OSError:
+            pass
+        request = urllib.request.Request(f"{self.upstream}/v2/{name}/blobs/{digest}", method="HEAD")
+        with urllib.request.urlopen(request, timeout=upstream_timeout) as response:
+            return int(response.headers["Content-Length"])
+
+    def fetch_blob(self, name, fetch):
+        # Runs on its own thread, so the download carries on if the client that started it leaves
+        try:
+            request = urllib.request.Request(f"{self.upstream}/v2/{name}/blobs/{fetch.digest}")
+            with urllib.request.urlopen(request, timeout=upstream_timeout) as response:
+                fetch.update(size=int(response.headers["Content-Length"]))
+                logger.info("Fetching %s (%d bytes) from upstream", fetch.digest, fetch.size)
+                sha256 = hashlib.sha256()
+                with open(fetch.temp_path, "wb") as f:
+                    while True:
+                        chunk = response.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        sha256.update(chunk)
+                        f.write(chunk)
+                        f.flush()
+                        self.count("upstream_bytes", len(chunk))
+                        fetch.update(written=fetch.written + len(chunk))
+            if f"sha256:{sha256.hexdigest()}" != fetch.digest or fetch.written != fetch.size:
+                raise ValueError(f"Blob {fetch.digest} failed verification")
+            with self.lock:
+                os.replace(fetch.temp_path, self.blob_path(fetch.digest))
+                del self.fetches[fetch.digest]
+            logger.info("Cached %s", fetch.digest)
+            fetch.update(done=True)
+        except Exception as e:
+            logger.warning("Fetching %s failed: %s", fetch.digest, e)
+            with self.lock:
+                os.remove(fetch.temp_path)
+                del self.fetches[fetch.digest]
+            fetch.update(error=e, done=True)
+
+
+class RegistryRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    cache = None
+
+    def do_GET(self):
+        self.handle_request(send_body=True)
+
+    def do_HEAD(self):
+        self.handle_request(send_body=False)
+
+    def handle_request(self, send_body):
+        try:
+            if self.path in ("/v2", "/v2/"):
+                self.send_response(200)
+                self.send_header("Docker-Distribution-API-Version", "registry/2.0")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+            elif self.path == "/stats":
+                self.send_stats()
+            elif match := BLOB_PATH.match(self.path):
+                self.send_blob(match["name"], match["digest"], send_body)
+            elif match := MANIFEST_PATH.match(self.path):
+                self.send_manifest(match["name"], match["reference"], send_body)
+            else:
+                self.send_error(404)
+        except urllib.error.HTTPError as e:
+            self.send_error(e.code)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def send_stats(self):
+        with self.cache.lock:
+            body = " ".join(f"{key}={value}" for key, value in self.cache.counters.items())
+        body = (body + "\n").encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_blob_headers(self, digest, size):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(size))
+        self.send_header("Docker-Content-Digest", digest)
+        self.end_headers()
+
+    def send_blob(self, name, digest, send_body):
+        try:
+            if send_body:
+                f, size, fetch = self.cache.open_blob(name, digest)
+            else:
+                size = self.cache.blob_size(name, digest)
+        except urllib.error.HTTPError:
+            raise
+        except Exception:
+            self.send_error(502)
+            return
+        if not send_body:
+            self.send_blob_headers(digest, size)
+            return
+        # A client that arrives mid-download is sent what is already on disk straight away, then
+        # follows the download
+        with f:
+            self.send_blob_headers(digest, size)
+            sent = 0
+            while sent < size:
+                try:
+                    available = fetch.wait_for(sent) if fetch else size
+                except Exception:
+                    available = sent
+                chunk = f.read(min(CHUNK_SIZE, available - sent))
+                if not chunk:
+                    # The download failed, the client sees a truncated blob and retries
+                    self.close_connection = True
+                    return
+                self.wfile.write(chunk)
+                sent += len(chunk)
+
+    def send_manifest(self, name, reference, send_body):
+        # Manifests are small and tags are mutable, so they are not cached
+        request = urllib.request.Request(
+            f"{self.cache.upstream}/v2/{name}/manifests/{reference}",
+            method="GET" if send_body else "HEAD",
+            # Docker sends one Accept header per media type it supports
+            headers={"Accept": ", ".join(self.headers.get_all("Accept") or ["*/*"])},
+        )
+        with urllib.request.urlopen(request, timeout=upstream_timeout) as response:
+            body = response.read() if send_body else b""
+            self.send_response(200)
+            for header in MANIFEST_HEADERS:
+                if header in response.headers:
+                    self.send_header(header, response.headers[header])
+            self.end_headers()
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    RegistryRequestHandler.cache = LayerCache(upstream, cache_dir)
+    server = ThreadingHTTPServer(("0.0.0.0", port), RegistryRequestHandler)
+    server.daemon_threads = True
+    logger.info("Caching %s on port %d", upstream, port)
+    server.serve_forever()
@@ -12,9 +12,19 @@ echo "THING_NAME $THING_NAME"
 echo "VERSION $VERSION"
 echo "HEALTH $HEALTH"
 echo "TIMER PERIOD $TIMER_PERIOD"
+echo "BATCH SIZE ${BATCH_SIZE:=1}"
+echo "BATCH INTERVAL MS ${BATCH_INTERVAL_MS:=0}"
+echo "PAYLOAD CODEC ${PAYLOAD_CODEC:=json}"
+echo "COMPRESS BATCHES ${COMPRESS_BATCHES:=false}"
+echo "BRIDGE CONFIG ${BRIDGE_CONFIG:-none}"
+# The topic bridge only runs when a config is given, e.g. /config/bridge_config.json
+BRIDGE_ARGS=""
+if [ -n "$BRIDGE_CONFIG" ]; then
+    BRIDGE_ARGS="--param bridge_config:=$BRIDGE_CONFIG"
+fi
 
 source /opt/ros/humble/setup.bash
 source /ros_ws/install/local_setup.bash
 export IOT_CONFIG_FILE=/config/iot_config.json
 
-ros2 run service service --ros-args --param path_for_config:=$IOT_CONFIG_FILE --param topic:=$TOPIC --param client_id:=$THING_NAME --param version:=\'$VERSION\' --param timer_period:=$TIMER_PERIOD --log-level debug
\ No newline at end of file
+ros2 run service service --ros-args --param path_for_config:=$IOT_CONFIG_FILE --param topic:=$TOPIC --param client_id:=$THING_NAME --param version:=\'$VERSION\' --param timer_period:=$TIMER_PERIOD --param batch_size:=$BATCH_SIZE --param batch_interval_ms:=$BATCH_INTERVAL_MS --param payload_codec:=$PAYLOAD_CODEC --param compress_batches:=$COMPRESS_BATCHES $BRIDGE_ARGS --log-level debug
\ No newline at end of file
@@ -6,7 +6,7 @@ VERSIONS=3
 for (( i=1; i <= $VERSIONS; ++i ))
 do
     echo "Building version $i"
-    docker build -t "firmware:$i" --build-arg "VERSION=$i" --build-arg "HEALTH=True" --build-arg "THING_NAME=$THING" --build-arg "TOPIC=clients/$THING/hello/world" .
+    docker build --build-context common=../common -t "firmware:$i" --build-arg "VERSION=$i" --build-arg "HEALTH=True" --build-arg "THING_NAME=$THING" --build-arg "TOPIC=clients/$THING/hello/world" .
     docker tag "firmware:$i" "$REGISTRY/firmware:$i"
     docker push "$REGISTRY/firmware:$i"
 done
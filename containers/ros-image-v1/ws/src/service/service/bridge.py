@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+import collections
+import json
+import os
+import threading
+import time
+import rclpy
+from awscrt import mqtt
+from rclpy.node import Node
+from rclpy.qos import QoSProfile, qos_profile_sensor_data
+from rosidl_runtime_py.convert import message_to_ordereddict
+from rosidl_runtime_py.utilities import get_message
+from service import payload_codec
+from service.connection_helper import ConnectionHelper
+
+# Messages a route serializes before the worker moves on to the next route, so that one busy topic
+# cannot starve the others
+ROUTE_BURST = 64
+DEFAULT_QUEUE_SIZE = 100
+DEFAULT_MAX_IN_FLIGHT = 100
+DEFAULT_STATS_INTERVAL_SECONDS = 10
+
+
+class Route:
+    # One ROS topic and the MQTT topic its messages are published to
+    def __init__(self, config, client_id):
+        self.ros_topic = config["ros_topic"]
+        self.message_type = get_message(config["type"])
+        self.mqtt_topic = config["mqtt_topic"].format(client_id=client_id)
+        self.qos = mqtt.QoS(config.get("qos", 0))
+        max_rate_hz = config.get("max_rate_hz", 0)
+        self.min_interval = 1.0 / max_rate_hz if max_rate_hz else 0.0
+        # Sensor data QoS (best effort, shallow history) suits high rate topics
+        self.ros_qos = (
+            qos_profile_sensor_data
+            if config.get("best_effort", False)
+            else QoSProfile(depth=config.get("ros_queue_depth", 10))
+        )
+        self.codec = config.get("codec", "json")
+        payload_codec.check_codec(self.codec)
+        # (received at, message), the oldest message is dropped when it is full
+        self.queue = collections.deque(maxlen=config.get("queue_size", DEFAULT_QUEUE_SIZE))
+        self.last_accepted = 0.0
+        # received, downsampled and dropped are only updated from the executor thread, the
+        # others from the worker and awscrt threads under the lock. Every key exists up front, so
+        # that a snapshot never sees the dict change size.
+        self.lock = threading.Lock()
+        self.counters = collections.Counter(
+            dict.fromkeys(("received", "downsampled", "dropped", "published", "failed"), 0)
+        )
+        self.latency_sum = 0.0
+        self.latency_count = 0
+        self.latency_max = 0.0
+
+    def on_published(self, received_at, future):
+        latency = time.monotonic() - received_at
+        with self.lock:
+            if future.exception():
+                self.counters["failed"] += 1
+                return
+            self.counters["published"] += 1
+            self.latency_sum += latency
+            self.latency_count += 1
+            self.latency_max = max(self.latency_max, latency)
+
+    def snapshot(self):
+        # Counters since start, latencies (from the ROS callback to the publish completing) since
+        # the previous snapshot
+        with self.lock:
+            stats = dict(self.counters, queued=len(self.queue))
+            if self.latency_count:
+                stats["latency_ms_avg"] = round(self.latency_sum / self.latency_count * 1000, 3)
+                stats["latency_ms_max"] = round(self.latency_max * 1000, 3)
+            self.latency_sum = 0.0
+            self.latency_count = 0
+            self.latency_max = 0.0
+        return stats
+
+
+class TopicBridge:
+    """
+    Subscribes to ROS 2 topics and publishes their messages to MQTT, as configured in a JSON file:
+
+        {
+            "stats_topic": "clients/{client_id}/bridge/stats",
+            "stats_interval": 10,
+            "max_in_flight": 100,
+            "routes": [
+                {"ros_topic": "/imu", "type": "sensor_msgs/msg/Imu",
+                 "mqtt_topic": "clients/{client_id}/imu", "qos": 0, "max_rate_hz": 50,
+                 "queue_size": 100, "best_effort": true, "codec": "cbor"}
+            ]
+        }
+
+    The subscription callbacks only downsample to max_rate_hz and queue the message, so rclpy.spin
+    keeps up with kHz topics. A worker thread serializes and publishes the queued messages. At
+    most max_in_flight publishes wait for completion at a time, beyond that the queues fill up and
+    their oldest messages are dropped. Per-topic counters and latencies are published to
+    stats_topic every stats_interval seconds.
+    """
+
+    def __init__(self, node, mqtt_conn, config_path, client_id):
+        self.node = node
+        self.logger = node.get_logger()
+        self.mqtt_conn = mqtt_conn
+        with open(config_path) as f:
+            config = json.load(f)
+        self.routes = [Route(route, client_id) for route in config.get("routes", [])]
+        stats_topic = config.get("stats_topic", "clients/{client_id}/bridge/stats")
+        self.stats_topic = stats_topic.format(client_id=client_id)
+        self.stats_interval = config.get("stats_interval", DEFAULT_STATS_INTERVAL_SECONDS)
+        self.in_flight = threading.BoundedSemaphore(
+            config.get("max_in_flight", DEFAULT_MAX_IN_FLIGHT)
+        )
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.worker_thread = None
+        self.subscriptions = []
+
+    def start(self):
+        for route in self.routes:
+            self.subscriptions.append(
+                self.node.create_subscription(
+                    route.message_type,
+                    route.ros_topic,
+                    lambda message, route=route: self.on_message(route, message),
+                    route.ros_qos,
+                )
+            )
+            self.logger.info(
+                f"Bridging {route.ros_topic} to {route.mqtt_topic} (QoS {route.qos.value})"
+            )
+        self.worker_thread = threading.Thread(
+            target=self.worker_fn, name="bridge_worker", daemon=True
+        )
+        self.worker_thread.start()
+        if self.stats_interval:
+            self.node.create_timer(self.stats_interval, self.publish_stats)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    def on_message(self, route, message):
+        # Runs on the executor thread, so it does no more than a time check and an append
+        now = time.monotonic()
+        route.counters["received"] += 1
+        if now - route.last_accepted < route.min_interval:
+            route.counters["downsampled"] += 1
+            return
+        route.last_accepted = now
+        if len(route.queue) == route.queue.maxlen:
+            route.counters["dropped"] += 1
+        route.queue.append((now, message))
+        with self.condition:
+            self.condition.notify()
+
+    def worker_fn(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(
+                    lambda: self.stopped or any(route.queue for route in self.routes)
+                )
+                if self.stopped:
+                    return
+            for route in self.routes:
+                for _ in range(ROUTE_BURST):
+                    try:
+                        received_at, message = route.queue.popleft()
+                    except IndexError:
+                        break
+                    self.publish(route, received_at, message)
+
+    def publish(self, route, received_at, message):
+        try:
+            payload = payload_codec.encode(message_to_ordereddict(message), route.codec)
+        except Exception as e:
+            self.logger.warning(f"Could not serialize message from {route.ros_topic}: {e}")
+            with route.lock:
+                route.counters["failed"] += 1
+            return
+        # Blocks while too many publishes are in flight, the route queues absorb the backlog
+        self.in_flight.acquire()
+        try:
+            publish_future, _ = self.mqtt_conn.publish(
+                topic=route.mqtt_topic, payload=payload, qos=route.qos
+            )
+        except Exception as e:
+            self.in_flight.release()
+            self.logger.warning(f"Publishing to {route.mqtt_topic} failed: {e}")
+            with route.lock:
+                route.counters["failed"] += 1
+            return
+
+        def on_done(future):
+            self.in_flight.release()
+            route.on_published(received_at, future)
+
+        publish_future.add_done_callback(on_done)
+
+    def publish_stats(self):
+        stats = {
+            "timestamp": time.time(),
+            "topics": {route.ros_topic: route.snapshot() for route in self.routes},
+        }
+        payload = json.dumps(stats, separators=(",", ":"))
+        self.logger.debug(f"Bridge stats {payload}")
+        try:
+            self.mqtt_conn.publish(
+                topic=self.stats_topic, payload=payload, qos=mqtt.QoS.AT_MOST_ONCE
+            )
+        except Exception as e:
+            self.logger.warning(f"Publishing bridge stats failed: {e}")
+
+
+class BridgeNode(Node):
+    # Runs the bridge on its own, with its own MQTT connection. MqttPublisher runs one on the
+    # firmware's connection when its bridge_config parameter is set. client_id must be a thing
+    # provisioned with the certificate in the config, and no other connection may use it at the
+    # same time, so a bridge next to the firmware needs a thing of its own.
+    def __init__(self):
+        super().__init__("bridge")
+        self.declare_parameter("path_for_config", "")
+        self.declare_parameter("client_id", os.environ.get("THING_NAME", ""))
+        self.declare_parameter("bridge_config", "")
+
+        path_for_config = self.get_parameter("path_for_config").get_parameter_value().string_value
+        client_id = self.get_parameter("client_id").get_parameter_value().string_value
+        bridge_config = self.get_parameter("bridge_config").get_parameter_value().string_value
+        if not client_id:
+            raise ValueError("Set the client_id parameter or THING_NAME to a provisioned thing")
+
+        self.connection_helper = ConnectionHelper(
+            self.get_logger(), path_for_config, client_id, True
+        )
+        self.bridge = TopicBridge(self, self.connection_helper.mqtt_conn, bridge_config, client_id)
+        self.bridge.start()
+
+
+def main(args=None):
+    rclpy.init(args=args)
+
+    bridge_node = BridgeNode()
+
+    rclpy.spin(bridge_node)
+
+    bridge_node.bridge.stop()
+    bridge_node.destroy_node()
+    rclpy.shutdown()
+
+
+if __name__ == "__main__":
+    main()
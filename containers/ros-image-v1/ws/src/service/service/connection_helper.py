@@ -18,30 +18,54 @@
 #
 
 import json
-import time
 from awscrt import io
 from awsiot import mqtt_connection_builder
 from awsiot.greengrass_discovery import DiscoveryClient
+from service import mqtt5_connection
+from service.retry_policy import RetryPolicy
 
 
 class ConnectionHelper:
-    def __init__(self, logger, path_for_config, client_id, discover_endpoints=False):
+    def __init__(
+        self,
+        logger,
+        path_for_config,
+        client_id,
+        discover_endpoints=False,
+        on_connection_interrupted=None,
+        on_connection_resumed=None,
+    ):
         self.path_for_config = path_for_config
         self.discover_endpoints = discover_endpoints
         self.logger = logger
         self.client_id = client_id
+        self.on_connection_interrupted = on_connection_interrupted
+        self.on_connection_resumed = on_connection_resumed
 
         with open(path_for_config) as f:
             cert_data = json.load(f)
 
         self.logger.info("Config we are loading is :\n{}".format(cert_data))
 
+        # Greengrass connections use MQTT 5 when mqttVersion is 5
+        self.mqtt_version = cert_data.get("mqttVersion", 3)
+        mqtt5_connection.check_mqtt_version(self.mqtt_version)
+
+        self.retry_policy = RetryPolicy(
+            "connection",
+            base_delay=cert_data["retryWaitTime"],
+            max_delay=cert_data.get("retryMaxWaitTime", 60),
+            max_attempts=cert_data["retryAttempts"],
+            log=self.logger.warning,
+        )
+
         if discover_endpoints:
             self.logger.info("Discovering endpoints for connection")
-            self.connect_using_discovery(cert_data)
+            self.retry_policy.call(self.connect_using_discovery, cert_data)
         else:
             self.logger.info("Connecting directly to endpoint")
-            self.connect_to_endpoint(cert_data)
+            self.retry_policy.call(self.connect_to_endpoint, cert_data)
+        self.logger.info(f"Connection retry stats: {self.retry_policy.snapshot()}")
 
     def connect_to_endpoint(self, cert_data):
         self.mqtt_conn = mqtt_connection_builder.mtls_from_path(
@@ -52,14 +76,14 @@ class ConnectionHelper:
             ca_filepath=cert_data["rootCAPath"],
             client_id=self.client_id,
             http_proxy_options=None,
+            on_connection_interrupted=self.on_connection_interrupted,
+            on_connection_resumed=self.on_connection_resumed,
         )
         connected_future = self.mqtt_conn.connect()
         connected_future.result()
         self.logger.info("Connected!")
 
     def connect_using_discovery(self, cert_data):
-        tries = 0
-
         tls_options = io.TlsContextOptions.create_client_with_mtls_from_path(
             cert_data["certificatePath"],
             cert_data["privateKeyPath"],
@@ -68,8 +92,6 @@ class ConnectionHelper:
         tls_context = io.ClientTlsContext(tls_options)
 
         region = cert_data["region"]
-        retry_attempts = cert_data["retryAttempts"]
-        retry_wait_time = cert_data["retryWaitTime"]
 
         discovery_client = DiscoveryClient(
             io.ClientBootstrap.get_or_create_static_default(),
@@ -81,40 +103,65 @@ class ConnectionHelper:
         discover_response = resp_future.result()
         self.logger.debug(f"Discovery response is: {discover_response}")
 
-        for tries in range(retry_attempts):
-            self.logger.info(f"Connection attempt: {tries}")
-            for gg_group in discover_response.gg_groups:
-                for gg_core in gg_group.cores:
-                    for connectivity_info in gg_core.connectivity:
-                        try:
-                            self.logger.debug(
-                                "Trying core {} as host {}:{}".format(
-                                    gg_core.thing_arn,
-                                    connectivity_info.host_address,
-                                    connectivity_info.port,
-                                )
-                            )
-                            self.mqtt_conn = self.build_greengrass_connection(
-                                gg_group, connectivity_info, cert_data
+        for gg_group in discover_response.gg_groups:
+            for gg_core in gg_group.cores:
+                for connectivity_info in gg_core.connectivity:
+                    try:
+                        self.logger.debug(
+                            "Trying core {} as host {}:{}".format(
+                                gg_core.thing_arn,
+                                connectivity_info.host_address,
+                                connectivity_info.port,
                             )
-                            return
-                        except Exception as e:
-                            self.logger.error(f"Connection failed with exception: {e}")
-                            continue
-            time.sleep(retry_wait_time)
+                        )
+                        self.mqtt_conn = self.build_greengrass_connection(
+                            gg_group, connectivity_info, cert_data
+                        )
+                        return
+                    except Exception as e:
+                        self.logger.error(f"Connection failed with exception: {e}")
+                        continue
+        # Discovery and all the cores are retried by the retry policy
         raise Exception("All connection attempts failed!")
 
     def build_greengrass_connection(self, gg_group, connectivity_info, cert_data):
-        conn = mqtt_connection_builder.mtls_from_path(
-            endpoint=connectivity_info.host_address,
-            port=connectivity_info.port,
-            cert_filepath=cert_data["certificatePath"],
-            pri_key_filepath=cert_data["privateKeyPath"],
-            ca_bytes=gg_group.certificate_authorities[0].encode("utf-8"),
-            client_id=self.client_id,
-            clean_session=False,
-            keep_alive_secs=30,
-        )
+        if self.mqtt_version == 5:
+            connection_id = mqtt5_connection.new_connection_id()
+            self.logger.info(f"Connecting with MQTT 5, connection id {connection_id}")
+            conn = mqtt5_connection.mtls_from_path(
+                endpoint=connectivity_info.host_address,
+                port=connectivity_info.port,
+                cert_filepath=cert_data["certificatePath"],
+                pri_key_filepath=cert_data["privateKeyPath"],
+                ca_bytes=gg_group.certificate_authorities[0].encode("utf-8"),
+                client_id=self.client_id,
+                keep_alive_secs=30,
+                session_expiry=cert_data.get(
+                    "sessionExpirySeconds", mqtt5_connection.DEFAULT_SESSION_EXPIRY_SECONDS
+                ),
+                receive_maximum=cert_data.get(
+                    "receiveMaximum", mqtt5_connection.DEFAULT_RECEIVE_MAXIMUM
+                ),
+                topic_alias_cache_size=cert_data.get(
+                    "topicAliasCacheSize", mqtt5_connection.DEFAULT_TOPIC_ALIAS_CACHE_SIZE
+                ),
+                user_properties={"client-id": self.client_id, "connection-id": connection_id},
+                on_connection_interrupted=self.on_connection_interrupted,
+                on_connection_resumed=self.on_connection_resumed,
+            )
+        else:
+            conn = mqtt_connection_builder.mtls_from_path(
+                endpoint=connectivity_info.host_address,
+                port=connectivity_info.port,
+                cert_filepath=cert_data["certificatePath"],
+                pri_key_filepath=cert_data["privateKeyPath"],
+                ca_bytes=gg_group.certificate_authorities[0].encode("utf-8"),
+                client_id=self.client_id,
+                clean_session=False,
+                keep_alive_secs=30,
+                on_connection_interrupted=self.on_connection_interrupted,
+                on_connection_resumed=self.on_connection_resumed,
+            )
         connect_future = conn.connect()
         connect_future.result()
         self.logger.info("Connected!")
@@ -19,11 +19,13 @@
 
 import json
 import datetime
+import time
 import rclpy
 from rclpy.node import Node
 from std_msgs.msg import String
-from awscrt import mqtt
 from service.connection_helper import ConnectionHelper
+from service.telemetry import TelemetryPipeline
+from service.bridge import TopicBridge
 
 RETRY_WAIT_TIME_SECONDS = 5
 
@@ -36,6 +38,17 @@ class MqttPublisher(Node):
         self.declare_parameter("topic", "clients/device-thing-0/hello/world")
         self.declare_parameter("client_id", "device-thing-0")
         self.declare_parameter("timer_period", 10)
+        # Telemetry batching: samples per message, and how often a partial batch is sent (0: never)
+        self.declare_parameter("batch_size", 1)
+        self.declare_parameter("batch_interval_ms", 0)
+        self.declare_parameter("buffer_size", 1000)
+        self.declare_parameter("spool_dir", "/var/spool/telemetry")
+        self.declare_parameter("spool_max_bytes", 10 * 1024 * 1024)
+        # "json", "cbor" or "msgpack". The binary codecs carry epoch millisecond timestamps.
+        self.declare_parameter("payload_codec", "json")
+        self.declare_parameter("compress_batches", False)
+        # JSON file of ROS topics to bridge to MQTT on this node's connection (empty: none)
+        self.declare_parameter("bridge_config", "")
 
         discover_endpoints = True
 
@@ -44,30 +57,66 @@ class MqttPublisher(Node):
         self.topic = self.get_parameter("topic").get_parameter_value().string_value
         self.timer_period = self.get_parameter("timer_period").get_parameter_value().integer_value
         self.client_id = self.get_parameter("client_id").get_parameter_value().string_value
+        batch_size = self.get_parameter("batch_size").get_parameter_value().integer_value
+        batch_interval_ms = (
+            self.get_parameter("batch_interval_ms").get_parameter_value().integer_value
+        )
+        buffer_size = self.get_parameter("buffer_size").get_parameter_value().integer_value
+        spool_dir = self.get_parameter("spool_dir").get_parameter_value().string_value
+        spool_max_bytes = self.get_parameter("spool_max_bytes").get_parameter_value().integer_value
+        bridge_config = self.get_parameter("bridge_config").get_parameter_value().string_value
+        self.payload_codec = self.get_parameter("payload_codec").get_parameter_value().string_value
+        compress_batches = self.get_parameter("compress_batches").get_parameter_value().bool_value
 
         self.get_logger().info(
             f"Initializing firmware version {self.version}. Publishing to {self.topic} as client id {self.client_id} every {self.timer_period} seconds"
         )
 
+        self.telemetry = TelemetryPipeline(
+            self.get_logger(),
+            self.topic,
+            self.version,
+            batch_size,
+            buffer_size,
+            spool_dir,
+            spool_max_bytes,
+            self.payload_codec,
+            compress_batches,
+        )
+
         self.connection_helper = ConnectionHelper(
-            self.get_logger(), path_for_config, self.client_id, discover_endpoints
+            self.get_logger(),
+            path_for_config,
+            self.client_id,
+            discover_endpoints,
+            on_connection_interrupted=self.telemetry.on_connection_interrupted,
+            on_connection_resumed=self.telemetry.on_connection_resumed,
         )
+        self.telemetry.start(self.connection_helper.mqtt_conn)
+
+        self.bridge = None
+        if bridge_config:
+            self.bridge = TopicBridge(
+                self, self.connection_helper.mqtt_conn, bridge_config, self.client_id
+            )
+            self.bridge.start()
 
         self.timer = self.create_timer(self.timer_period, self.timer_callback)
+        if batch_interval_ms > 0:
+            self.flush_timer = self.create_timer(batch_interval_ms / 1000, self.telemetry.flush)
 
     def timer_callback(self):
-        message_json = json.dumps(
-            {
-                "version": self.version,
-                "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
-            }
-        )
-        self.get_logger().info(
-            "Received data on ROS2 {}\nPublishing to AWS IoT".format(message_json)
-        )
-        self.connection_helper.mqtt_conn.publish(
-            topic=self.topic, payload=message_json, qos=mqtt.QoS.AT_LEAST_ONCE
-        )
+        if self.payload_codec == "json":
+            timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        else:
+            timestamp = time.time_ns() // 1_000_000
+        sample = {"version": self.version, "timestamp": timestamp}
+        if self.payload_codec == "json":
+            # Skipped for the binary codecs, which are chosen to save CPU
+            self.get_logger().info(
+                "Received data on ROS2 {}\nPublishing to AWS IoT".format(json.dumps(sample))
+            )
+        self.telemetry.add(sample)
 
 
 def main(args=None):
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+import collections
+import os
+import threading
+from awscrt import mqtt
+from service import payload_codec
+
+DRAIN_PUBLISH_TIMEOUT_SECONDS = 30
+SPOOL_SUFFIX = ".payload"
+
+
+class TelemetrySpool:
+    # Bounded on-disk queue of payloads that could not be published, oldest dropped first
+    def __init__(self, logger, spool_dir, max_bytes):
+        self.logger = logger
+        self.spool_dir = spool_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(spool_dir, exist_ok=True)
+        files = self.list_files()
+        self.next_sequence = int(files[-1].split(".")[0]) + 1 if files else 0
+
+    def list_files(self):
+        return sorted(name for name in os.listdir(self.spool_dir) if name.endswith(SPOOL_SUFFIX))
+
+    def append(self, payload):
+        with self.lock:
+            name = f"{self.next_sequence:012d}{SPOOL_SUFFIX}"
+            self.next_sequence += 1
+            path = os.path.join(self.spool_dir, name)
+            with open(path + ".tmp", "wb") as f:
+                f.write(payload.encode("utf-8") if isinstance(payload, str) else payload)
+            os.replace(path + ".tmp", path)
+            self.enforce_limit()
+
+    def enforce_limit(self):
+        files = self.list_files()
+        sizes = [os.path.getsize(os.path.join(self.spool_dir, name)) for name in files]
+        total = sum(sizes)
+        dropped = 0
+        while files and total > self.max_bytes:
+            total -= sizes.pop(0)
+            os.remove(os.path.join(self.spool_dir, files.pop(0)))
+            dropped += 1
+        if dropped:
+            self.logger.warning(f"Telemetry spool full, dropped {dropped} oldest batches")
+
+    def peek(self):
+        # Returns the name and payload of the oldest spooled batch, or (None, None)
+        with self.lock:
+            files = self.list_files()
+            if not files:
+                return None, None
+            with open(os.path.join(self.spool_dir, files[0]), "rb") as f:
+                return files[0], f.read()
+
+    def remove(self, name):
+        with self.lock:
+            try:
+                os.remove(os.path.join(self.spool_dir, name))
+            except FileNotFoundError:
+                pass
+
+
+class TelemetryPipeline:
+    """
+    Buffers samples in memory and publishes them in batches of batch_size samples (or whatever
+    is buffered when flush is called, e.g. from a timer). A batch of one sample is published as
+    is; larger batches are published as {"version": ..., "timestamp": <latest>, "samples": [...]}.
+    Payloads are encoded with payload_codec, and batches of more than one sample are compressed
+    when compress is set.
+
+    While the connection is interrupted, or when a publish fails, batches go to a bounded on-disk
+    spool which is drained in order once the connection resumes. If the in-memory buffer fills
+    up, the oldest samples are dropped.
+    """
+
+    def __init__(
+        self,
+        logger,
+        topic,
+        version,
+        batch_size,
+        buffer_size,
+        spool_dir,
+        spool_max_bytes,
+        codec="json",
+        compress=False,
+    ):
+        payload_codec.check_codec(codec)
+        self.logger = logger
+        self.topic = topic
+        self.version = version
+        self.codec = codec
+        self.compress = compress
+        self.batch_size = max(1, batch_size)
+        self.buffer = collections.deque(maxlen=buffer_size)
+        self.spool = TelemetrySpool(logger, spool_dir, spool_max_bytes)
+        self.lock = threading.Lock()
+        self.mqtt_conn = None
+        self.is_connected = False
+        self.drain_thread = None
+        self.counters = collections.Counter()
+
+    def start(self, mqtt_conn):
+        self.mqtt_conn = mqtt_conn
+        self.on_connection_resumed(mqtt_conn, None, None)
+
+    def on_connection_interrupted(self, connection, error, **kwargs):
+        self.logger.warning(f"Connection interrupted ({error}), spooling telemetry")
+        with self.lock:
+            self.is_connected = False
+
+    def on_connection_resumed(self, connection, return_code, session_present, **kwargs):
+        with self.lock:
+            self.is_connected = True
+            if self.drain_thread and self.drain_thread.is_alive():
+                return
+            # Don't drain from the awscrt callback thread, publishing waits for acknowledgements
+            self.drain_thread = threading.Thread(
+                target=self.drain_spool, name="telemetry_drain", daemon=True
+            )
+            self.drain_thread.start()
+
+    def add(self, sample):
+        with self.lock:
+            if len(self.buffer) == self.buffer.maxlen:
+                self.counters["dropped"] += 1
+            self.buffer.append(sample)
+            is_full = len(self.buffer) >= self.batch_size
+        if is_full:
+            self.flush()
+
+    def flush(self):
+        while True:
+            with self.lock:
+                if not self.buffer:
+                    return
+                count = min(self.batch_size, len(self.buffer))
+                samples = [self.buffer.popleft() for _ in range(count)]
+                is_connected = self.is_connected and self.mqtt_conn is not None
+            payload = self.encode(samples)
+            if is_connected:
+                self.publish(payload)
+            else:
+                self.spool.append(payload)
+                self.counters["spooled"] += 1
+
+    def encode(self, samples):
+        if len(samples) == 1:
+            return payload_codec.encode(samples[0], self.codec)
+        return payload_codec.encode(
+            {"version": self.version, "timestamp": samples[-1]["timestamp"], "samples": samples},
+            self.codec,
+            self.compress,
+        )
+
+    def publish(self, payload):
+        publish_future, _ = self.mqtt_conn.publish(
+            topic=self.topic, payload=payload, qos=mqtt.QoS.AT_LEAST_ONCE
+        )
+
+        def on_published(future):
+            if future.exception():
+                self.logger.warning(f"Telemetry publish failed ({future.exception()}), spooling")
+                self.spool.append(payload)
+                self.counters["spooled"] += 1
+            else:
+                self.counters["published"] += 1
+
+        publish_future.add_done_callback(on_published)
+
+    def drain_spool(self):
+        drained = 0
+        while True:
+            with self.lock:
+                if not self.is_connected:
+                    break
+            name, payload = self.spool.peek()
+            if name is None:
+                break
+            publish_future, _ = self.mqtt_conn.publish(
+                topic=self.topic, payload=payload, qos=mqtt.QoS.AT_LEAST_ONCE
+            )
+            try:
+                publish_future.result(DRAIN_PUBLISH_TIMEOUT_SECONDS)
+            except Exception as e:
+                self.logger.warning(f"Draining telemetry spool failed: {e}")
+                break
+            self.spool.remove(name)
+            drained += 1
+        if drained:
+            self.counters["drained"] += drained
+            self.logger.info(f"Drained {drained} spooled telemetry batches")
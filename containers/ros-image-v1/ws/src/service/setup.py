@@ -23,6 +23,7 @@ setup(
     entry_points={
         "console_scripts": [
             "service = service.service:main",
+            "bridge = service.bridge:main",
         ],
     },
 )
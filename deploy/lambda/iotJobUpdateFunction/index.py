@@ -2,12 +2,30 @@
 # SPDX-License-Identifier: MIT-0
 
 import boto3
+from botocore.config import Config
 from pydantic import BaseModel, PositiveInt
 from pprint import pprint
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import base64
 import json
+import os
+import threading
+import time
 
-iot_data_client = boto3.client("iot-data")
-iot_client = boto3.client("iot")
+# Shadow and registry writes of different things run concurrently on this many threads
+write_concurrency = int(os.environ.get("WRITE_CONCURRENCY", "8"))
+write_executor = ThreadPoolExecutor(max_workers=write_concurrency)
+
+client_config = Config(max_pool_connections=write_concurrency * 2)
+iot_data_client = boto3.client("iot-data", config=client_config)
+iot_client = boto3.client("iot", config=client_config)
+
+# Every device in a rollout reports on the same job, so job versions are cached for as long as the
+# execution environment stays warm. Job documents cannot change, the TTL only bounds staleness for
+# jobs that are deleted and recreated with the same id.
+job_version_cache_size = int(os.environ.get("JOB_VERSION_CACHE_SIZE", "1024"))
+job_version_cache_ttl = int(os.environ.get("JOB_VERSION_CACHE_TTL_SECONDS", "3600"))
 
 
 class JobExecution(BaseModel):
@@ -20,19 +38,60 @@ class JobExecution(BaseModel):
     status: str
 
 
-def get_job_version(jobId):
-    # Use describe_job_execution to get the job document
+class TtlLruCache:
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires at, value)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        value = load(key)
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return value
+
+
+job_version_cache = TtlLruCache(job_version_cache_size, job_version_cache_ttl)
+
+
+def load_job_version(jobId):
     response = iot_client.get_job_document(jobId=jobId)
-    # Pretty print response
-    operation = json.loads(response["document"]).get("operation")
+    document = json.loads(response["document"])
+    operation = document.get("operation")
     if operation != "Deploy-ROS-Firmware":
         print(f"Operation: {operation} not recognized")
         return None
-    version = json.loads(response["document"]).get("version")
+    version = document.get("version")
     print(f"Firmware version: {version}")
     return version
 
 
+def get_job_version(jobId):
+    return job_version_cache.get(jobId, load_job_version)
+
+
+def get_reported_version(thingName):
+    try:
+        response = iot_data_client.get_thing_shadow(thingName=thingName, shadowName="firmware")
+    except iot_data_client.exceptions.ResourceNotFoundException:
+        return None
+    shadow = json.loads(response["payload"].read())
+    return shadow.get("state", {}).get("reported", {}).get("firmwareVersion")
+
+
 def update_thing_shadow(thingName, version):
     payload = json.dumps({"state": {"reported": {"firmwareVersion": version}}})
     shadowName = "firmware"
@@ -53,16 +112,118 @@ def update_thing_attribute(thingName, version):
     print(response)
 
 
+def get_thing_name(parsedEvent):
+    return parsedEvent.thingArn.split("/")[-1]
+
+
+def sync_thing_versions(versions, check_shadow=True):
+    # Writes the shadow and the registry attribute of every thing concurrently, skipping things
+    # whose shadow already reports the version. Returns the names of the things that failed.
+    if check_shadow:
+        reported_futures = {
+            thingName: write_executor.submit(get_reported_version, thingName)
+            for thingName in versions
+        }
+        for thingName, reported_future in reported_futures.items():
+            try:
+                if reported_future.result() == versions[thingName]:
+                    print(f"Thing {thingName} already reports version {versions[thingName]}")
+                    del versions[thingName]
+            except Exception as e:
+                # Write anyway, the read is only an optimisation
+                print(f"Failed to read the shadow of {thingName}: {e}")
+
+    write_futures = {
+        thingName: [
+            write_executor.submit(update_thing_shadow, thingName, version),
+            write_executor.submit(update_thing_attribute, thingName, version),
+        ]
+        for thingName, version in versions.items()
+    }
+    failed = set()
+    for thingName, futures in write_futures.items():
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Failed to update {thingName}: {e}")
+                failed.add(thingName)
+    return failed
+
+
 def handler(event, context):
     print(event)
     print(context)
     parsedEvent = JobExecution(**event)
     print(parsedEvent)
-    print(f"JobId: {parsedEvent.jobId}")
-    print(f"Status: {parsedEvent.status}")
-    print(f"ThingArn: {parsedEvent.thingArn}")
     version = get_job_version(parsedEvent.jobId)
     if version:
-        thingName = parsedEvent.thingArn.split("/")[-1]
-        update_thing_shadow(thingName, version)
-        update_thing_attribute(thingName, version)
+        thingName = get_thing_name(parsedEvent)
+        if sync_thing_versions({thingName: version}, check_shadow=False):
+            raise RuntimeError(f"Failed to update {thingName}")
+
+
+def get_item_identifier(record):
+    if "kinesis" in record:
+        return record["kinesis"]["sequenceNumber"]
+    return record["messageId"]
+
+
+def parse_record(record):
+    # Returns the job execution event carried by an SQS or Kinesis record
+    if "kinesis" in record:
+        return json.loads(base64.b64decode(record["kinesis"]["data"]))
+    return json.loads(record["body"])
+
+
+def batch_handler(event, context):
+    # Entry point for SQS and Kinesis event sources with partial batch responses enabled: only
+    # the records listed in batchItemFailures are retried.
+    records = event.get("Records", [])
+    print(f"Processing batch of {len(records)} job execution events")
+    failed_items = []
+    parsed = []  # (item identifier, parsed event)
+    is_retry = False
+    for record in records:
+        item_identifier = get_item_identifier(record)
+        try:
+            parsed.append((item_identifier, JobExecution(**parse_record(record))))
+        except Exception as e:
+            print(f"Failed to parse record {item_identifier}: {e}")
+            failed_items.append(item_identifier)
+            continue
+        # A shadow can report a version whose registry write failed, so retried events are
+        # always written. Kinesis records carry no delivery count.
+        if int(record.get("attributes", {}).get("ApproximateReceiveCount", "1")) > 1:
+            is_retry = True
+
+    # Only the most recent firmware version of each thing is written
+    latest = {}  # thing name -> (event timestamp, version)
+    items_by_thing = {}
+    for item_identifier, parsedEvent in parsed:
+        print(parsedEvent)
+        try:
+            version = get_job_version(parsedEvent.jobId)
+        except Exception as e:
+            print(f"Failed to get the version of job {parsedEvent.jobId}: {e}")
+            failed_items.append(item_identifier)
+            continue
+        thingName = get_thing_name(parsedEvent)
+        items_by_thing.setdefault(thingName, []).append(item_identifier)
+        if version and (thingName not in latest or parsedEvent.timestamp >= latest[thingName][0]):
+            latest[thingName] = (parsedEvent.timestamp, version)
+
+    versions = {thingName: version for thingName, (_, version) in latest.items()}
+    print(f"Coalesced {len(parsed)} events into {len(versions)} thing updates")
+    for thingName in sync_thing_versions(versions, check_shadow=not is_retry):
+        # Every event of the thing is retried, and coalesced again next time
+        failed_items.extend(items_by_thing[thingName])
+
+    print(
+        f"Job version cache: {job_version_cache.hits} hits, {job_version_cache.misses} misses, "
+        f"{len(failed_items)} failed records"
+    )
+    if "kinesis" in (records[0] if records else {}) and failed_items:
+        # Kinesis retries from the lowest reported sequence number onwards
+        failed_items = [min(failed_items, key=int)]
+    return {"batchItemFailures": [{"itemIdentifier": item} for item in failed_items]}
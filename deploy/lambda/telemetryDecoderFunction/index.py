@@ -0,0 +1,45 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import base64
+import datetime
+import json
+import os
+import boto3
+
+# containers/common/payload_codec.py, copied into the function when it is bundled
+import payload_codec
+
+iot_data_client = boto3.client("iot-data")
+
+# Decoded telemetry is republished as JSON under this prefix, e.g.
+# decoded/clients/device-thing-1-firmware/hello/world
+decoded_topic_prefix = os.environ.get("DECODED_TOPIC_PREFIX", "decoded/")
+
+
+def to_iso_timestamp(timestamp):
+    # The binary codecs carry epoch milliseconds, JSON payloads ISO 8601 strings
+    if isinstance(timestamp, int):
+        return datetime.datetime.fromtimestamp(timestamp / 1000, datetime.timezone.utc).isoformat()
+    return timestamp
+
+
+def normalize(message):
+    # Gives every payload the shape of the original JSON telemetry
+    if "timestamp" in message:
+        message["timestamp"] = to_iso_timestamp(message["timestamp"])
+    for sample in message.get("samples", []):
+        sample["timestamp"] = to_iso_timestamp(sample.get("timestamp"))
+    return message
+
+
+def handler(event, context):
+    # Invoked by the telemetry IoT rule with the raw payload in base64 and the topic it came on
+    try:
+        message = normalize(payload_codec.decode(base64.b64decode(event["payload"])))
+    except Exception as e:
+        print(f"Failed to decode payload on {event.get('topic')}: {e}")
+        return
+    iot_data_client.publish(
+        topic=f"{decoded_topic_prefix}{event['topic']}", qos=0, payload=json.dumps(message)
+    )
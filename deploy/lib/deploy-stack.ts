@@ -4,6 +4,7 @@
 import * as cdk from 'aws-cdk-lib';
 import { Construct } from 'constructs';
 import { IotJobRuleConstruct } from './iotJobRuleConstruct';
+import { TelemetryRuleConstruct } from './telemetryRuleConstruct';
 
 export class DeployStack extends cdk.Stack {
   constructor(scope: Construct, id: string, props?: cdk.StackProps) {
@@ -15,5 +16,6 @@ export class DeployStack extends cdk.Stack {
     });
 
     const iotJobRuleConstruct = new IotJobRuleConstruct(this, 'IotJobRuleConstruct', {});
+    const telemetryRuleConstruct = new TelemetryRuleConstruct(this, 'TelemetryRuleConstruct', {});
   }
 }
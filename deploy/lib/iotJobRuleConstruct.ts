@@ -13,30 +13,49 @@ interface IotJobRuleConstructProps extends cdk.StackProps {
 export class IotJobRuleConstruct extends Construct {
     constructor(scope: Construct, id: string, props: IotJobRuleConstructProps) {
         super(scope, id);
-        // Create a python lambda function
+        // Create a python lambda function, fed with batches of job execution events from a queue
         const iotJobUpdateFunction = new pythonlambda.PythonFunction(this, 'iotJobUpdateFunction', {
         entry: 'lambda/iotJobUpdateFunction',
         runtime: cdk.aws_lambda.Runtime.PYTHON_3_12,
+        handler: 'batch_handler',
+        timeout: cdk.Duration.seconds(60),
         });
 
-        // Create an IoT rule that acccepts messages from '$aws/events/jobExecution/#' and triggers a python lambda function
+        // Events that keep failing end up in a dead letter queue
+        const jobExecutionDeadLetterQueue = new cdk.aws_sqs.Queue(this, 'jobExecutionDeadLetterQueue', {
+        retentionPeriod: cdk.Duration.days(14),
+        });
+        const jobExecutionQueue = new cdk.aws_sqs.Queue(this, 'jobExecutionQueue', {
+        visibilityTimeout: cdk.Duration.seconds(360),
+        deadLetterQueue: { queue: jobExecutionDeadLetterQueue, maxReceiveCount: 5 },
+        });
+        // Only the failed events of a batch are retried
+        iotJobUpdateFunction.addEventSource(new cdk.aws_lambda_event_sources.SqsEventSource(jobExecutionQueue, {
+        batchSize: 100,
+        maxBatchingWindow: cdk.Duration.seconds(5),
+        reportBatchItemFailures: true,
+        }));
+
+        // Create an IoT rule that acccepts messages from '$aws/events/jobExecution/#' and sends them to the queue
+        const iotRuleRole = new cdk.aws_iam.Role(this, 'iotRuleRole', {
+        assumedBy: new cdk.aws_iam.ServicePrincipal('iot.amazonaws.com'),
+        });
+        jobExecutionQueue.grantSendMessages(iotRuleRole);
         const iotRule = new cdk.aws_iot.CfnTopicRule(this, 'iotRule', {
         ruleName: 'RosJobExecutionRule',
         topicRulePayload: {
-            actions: [{ lambda: { functionArn: iotJobUpdateFunction.functionArn } }],
+            actions: [{ sqs: { queueUrl: jobExecutionQueue.queueUrl, roleArn: iotRuleRole.roleArn } }],
             sql: "SELECT * FROM '$aws/events/jobExecution/#'",
             awsIotSqlVersion: '2015-10-08',
         }
         });
-        // Grant permissions for IoT rule to invoke the python lambda function
-        iotJobUpdateFunction.grantInvoke(new cdk.aws_iam.ServicePrincipal('iot.amazonaws.com'));
 
         iotJobUpdateFunction.addToRolePolicy(new cdk.aws_iam.PolicyStatement({
             actions: ['iot:GetJobDocument'],
             resources: ['*'], 
         }));
         iotJobUpdateFunction.addToRolePolicy(new cdk.aws_iam.PolicyStatement({
-            actions: ['iot:UpdateThingShadow', 'iot:UpdateThing'],
+            actions: ['iot:GetThingShadow', 'iot:UpdateThingShadow', 'iot:UpdateThing'],
             resources: [cdk.Arn.format({
                 service: 'iot',
                 resource: 'thing',
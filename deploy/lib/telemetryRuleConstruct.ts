@@ -0,0 +1,59 @@
+// Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+// SPDX-License-Identifier: MIT-0
+
+import * as cdk from 'aws-cdk-lib';
+import * as path from 'path';
+import { Construct } from 'constructs';
+import * as pythonlambda from '@aws-cdk/aws-lambda-python-alpha';
+
+interface TelemetryRuleConstructProps extends cdk.StackProps {
+
+}
+
+// Decodes the firmware telemetry, whatever its payload codec, and republishes it as JSON
+export class TelemetryRuleConstruct extends Construct {
+    constructor(scope: Construct, id: string, props: TelemetryRuleConstructProps) {
+        super(scope, id);
+        const telemetryDecoderFunction = new pythonlambda.PythonFunction(this, 'telemetryDecoderFunction', {
+        entry: 'lambda/telemetryDecoderFunction',
+        runtime: cdk.aws_lambda.Runtime.PYTHON_3_12,
+        handler: 'handler',
+        timeout: cdk.Duration.seconds(10),
+        // The payload format is defined once, in the module the device images also copy
+        bundling: {
+            volumes: [{
+                hostPath: path.join(__dirname, '../../containers/common'),
+                containerPath: '/common',
+            }],
+            commandHooks: {
+                beforeBundling: () => [],
+                afterBundling: (inputDir: string, outputDir: string) => [
+                    `cp /common/payload_codec.py ${outputDir}/`,
+                ],
+            },
+        },
+        });
+        telemetryDecoderFunction.addToRolePolicy(new cdk.aws_iam.PolicyStatement({
+            actions: ['iot:Publish'],
+            resources: [cdk.Arn.format({
+                service: 'iot',
+                resource: 'topic',
+                resourceName: 'decoded/*',
+            }, cdk.Stack.of(this))],
+        }));
+
+        // Binary payloads cannot be selected as JSON, so the rule hands them over in base64
+        const iotRule = new cdk.aws_iot.CfnTopicRule(this, 'iotRule', {
+        ruleName: 'RosTelemetryDecoderRule',
+        topicRulePayload: {
+            actions: [{ lambda: { functionArn: telemetryDecoderFunction.functionArn } }],
+            sql: "SELECT encode(*, 'base64') AS payload, topic() AS topic FROM 'clients/+/hello/world'",
+            awsIotSqlVersion: '2016-03-23',
+        }
+        });
+        telemetryDecoderFunction.addPermission('iotRuleInvoke', {
+            principal: new cdk.aws_iam.ServicePrincipal('iot.amazonaws.com'),
+            sourceArn: iotRule.attrArn,
+        });
+    }
+}
@@ -3,8 +3,52 @@
 
 import boto3
 import argparse
+import functools
 import json
+import threading
+import time
 import uuid
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Most targets a job can be created with
+MAX_TARGETS_PER_JOB = 100
+
+# Adaptive retries back off (and slow down) on throttling errors from the IoT API
+client_config = Config(retries={"max_attempts": 10, "mode": "adaptive"})
+
+
+@functools.lru_cache(maxsize=None)
+def get_client(service, region):
+    # boto3 clients are thread safe, so one client per service and region is shared by all calls
+    return boto3.client(service, region_name=region, config=client_config)
+
+
+@functools.lru_cache(maxsize=None)
+def get_account_id(region):
+    return get_client("sts", region).get_caller_identity().get("Account")
+
+
+class RateLimiter:
+    # Token bucket: allows bursts of up to burst calls, then rate calls per second on average
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
 
 
 def create_deployment_job(version, thing_name, job_id, account_id, region):
@@ -14,12 +58,12 @@ def create_deployment_job(version, thing_name, job_id, account_id, region):
         job_id = uuid.uuid4()
     if not account_id:
         # get the account id
-        account_id = boto3.client("sts", region_name=region).get_caller_identity().get("Account")
+        account_id = get_account_id(region)
     print("job_id", job_id)
     print("account_id", account_id)
     print("thing_name", thing_name)
     print("region", region)
-    client = boto3.client("iot", region_name=region)
+    client = get_client("iot", region)
     target = f"arn:aws:iot:{region}:{account_id}:thing/{thing_name}"
     job_document = {"operation": "Deploy-ROS-Firmware", "version": version}
     response = client.create_job(
@@ -32,6 +76,136 @@ def create_deployment_job(version, thing_name, job_id, account_id, region):
     print(response)
 
 
+def get_rollout_job_config(args):
+    return {
+        "jobExecutionsRolloutConfig": {
+            "maximumPerMinute": args.max_per_minute,
+            "exponentialRate": {
+                "baseRatePerMinute": args.base_rate_per_minute,
+                "incrementFactor": args.increment_factor,
+                "rateIncreaseCriteria": {"numberOfSucceededThings": args.succeeded_to_increase},
+            },
+        },
+        "abortConfig": {
+            "criteriaList": [
+                {
+                    "failureType": failure_type,
+                    "action": "CANCEL",
+                    "thresholdPercentage": args.abort_threshold_percentage,
+                    "minNumberOfExecutedThings": args.abort_min_executed,
+                }
+                for failure_type in ("FAILED", "TIMED_OUT")
+            ]
+        },
+        "timeoutConfig": {"inProgressTimeoutInMinutes": args.in_progress_timeout_minutes},
+    }
+
+
+def get_rollout_targets(thing_groups, account_id, region):
+    return [
+        f"arn:aws:iot:{region}:{account_id}:thinggroup/{thing_group}"
+        for thing_group in thing_groups
+    ]
+
+
+def create_rollout_thing_group(thing_names, thing_group, region, args):
+    # Makes the static thing group hold exactly the given things, so that a single job covers all
+    # of them, with one rollout rate and one set of abort thresholds however many things there are.
+    # The same group is reused by every rollout, because a thing can only be in 10 static groups:
+    # the things of the previous rollout are removed from it, which doesn't change the targets of
+    # its job when that job was created with SNAPSHOT target selection. Things are added and
+    # removed several at a time but no faster than the rate limit. All the calls are idempotent, so
+    # a rollout can be retried.
+    client = get_client("iot", region)
+    response = client.create_thing_group(
+        thingGroupName=thing_group,
+        thingGroupProperties={"thingGroupDescription": "Targets of the latest firmware rollout"},
+    )
+    members = set()
+    for page in client.get_paginator("list_things_in_thing_group").paginate(
+        thingGroupName=thing_group
+    ):
+        members.update(page["things"])
+    rate_limiter = RateLimiter(args.api_rate, burst=args.concurrency)
+
+    def add_thing(thing_name):
+        rate_limiter.acquire()
+        client.add_thing_to_thing_group(thingGroupName=thing_group, thingName=thing_name)
+
+    def remove_thing(thing_name):
+        rate_limiter.acquire()
+        client.remove_thing_from_thing_group(thingGroupName=thing_group, thingName=thing_name)
+
+    to_remove = members - set(thing_names)
+    print(
+        f"Adding {len(thing_names)} things to thing group {thing_group}, "
+        f"removing {len(to_remove)}"
+    )
+    failed = []
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = {executor.submit(add_thing, thing_name): thing_name for thing_name in thing_names}
+        futures.update(
+            {executor.submit(remove_thing, thing_name): thing_name for thing_name in to_remove}
+        )
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Failed to update {futures[future]} in thing group {thing_group}: {e}")
+                failed.append(futures[future])
+    print(f"Updated {len(futures) - len(failed)} things, {len(failed)} failed")
+    return response["thingGroupArn"], failed
+
+
+def create_rollout_job(version, targets, job_id, region, job_config, args):
+    client = get_client("iot", region)
+    print(f"Creating job {job_id} for {len(targets)} targets to deploy version {version}")
+    response = client.create_job(
+        jobId=job_id,
+        targets=targets,
+        description=f"Deployment to version {version}",
+        targetSelection=args.target_selection,
+        document=json.dumps({"operation": "Deploy-ROS-Firmware", "version": version}),
+        **job_config,
+    )
+    print(f"Created job {response['jobId']} ({response['jobArn']})")
+    return response["jobId"]
+
+
+def read_thing_names(thing_names, thing_names_file):
+    names = [name.strip() for name in (thing_names or "").split(",") if name.strip()]
+    if thing_names_file:
+        with open(thing_names_file) as f:
+            names += [line.strip() for line in f if line.strip()]
+    return names
+
+
+def deploy_rollout(version, args):
+    thing_names = read_thing_names(args.thing_names, args.thing_names_file)
+    thing_groups = [name.strip() for name in (args.thing_groups or "").split(",") if name.strip()]
+    account_id = args.account_id or get_account_id(args.region)
+    job_id = args.job_id or str(uuid.uuid4())
+    targets = get_rollout_targets(thing_groups, account_id, args.region)
+    target_count = len(targets) + (1 if thing_names else 0)
+    if target_count > MAX_TARGETS_PER_JOB:
+        print(f"A job can have at most {MAX_TARGETS_PER_JOB} targets, got {target_count}")
+        return False
+    if thing_names and args.target_selection == "CONTINUOUS":
+        # The group's members change with the next rollout, which a continuous job would follow
+        print("Listed thing names can only be deployed to with SNAPSHOT target selection")
+        return False
+    if thing_names:
+        thing_group_arn, failed = create_rollout_thing_group(
+            thing_names, args.rollout_group, args.region, args
+        )
+        if failed:
+            print(f"Not creating the job, retry with --job_id {job_id}")
+            return False
+        targets.append(thing_group_arn)
+    create_rollout_job(version, targets, job_id, args.region, get_rollout_job_config(args), args)
+    return True
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Create an iot job")
     parser.add_argument("version", help="version to deploy")
@@ -39,10 +213,53 @@ if __name__ == "__main__":
     parser.add_argument("--job_id", help="job id")
     parser.add_argument("--account_id", help="AWS account id")
     parser.add_argument("--region", help="AWS region", default="us-east-1")
+
+    rollout = parser.add_argument_group(
+        "rollout mode", "used when thing names or thing groups are given instead of --thing_name"
+    )
+    rollout.add_argument("--thing_names", help="comma separated thing names")
+    rollout.add_argument("--thing_names_file", help="file with one thing name per line")
+    rollout.add_argument("--thing_groups", help="comma separated thing group names")
+    rollout.add_argument(
+        "--rollout_group",
+        default="firmware-rollout",
+        help="static thing group that holds the listed thing names, reused by every rollout",
+    )
+    rollout.add_argument(
+        "--target_selection", choices=["SNAPSHOT", "CONTINUOUS"], default="SNAPSHOT"
+    )
+    rollout.add_argument(
+        "--concurrency", type=int, default=4, help="things added to the thing group at once"
+    )
+    rollout.add_argument(
+        "--api_rate", type=float, default=20, help="things added to the thing group per second"
+    )
+    rollout.add_argument("--base_rate_per_minute", type=int, default=10)
+    rollout.add_argument("--increment_factor", type=float, default=2)
+    rollout.add_argument(
+        "--succeeded_to_increase",
+        type=int,
+        default=10,
+        help="succeeded executions before the rollout rate is increased",
+    )
+    rollout.add_argument("--max_per_minute", type=int, default=1000)
+    rollout.add_argument(
+        "--abort_threshold_percentage",
+        type=float,
+        default=10,
+        help="cancel the job once this percentage of its executions failed or timed out",
+    )
+    rollout.add_argument("--abort_min_executed", type=int, default=10)
+    rollout.add_argument("--in_progress_timeout_minutes", type=int, default=30)
     args = parser.parse_args()
+
     version = args.version
-    job_id = args.job_id
-    account_id = args.account_id
-    thing_name = args.thing_name
-    region = args.region
-    create_deployment_job(version, thing_name, job_id, account_id, region)
+    if args.thing_names or args.thing_names_file or args.thing_groups:
+        if not deploy_rollout(version, args):
+            exit(1)
+    else:
+        job_id = args.job_id
+        account_id = args.account_id
+        thing_name = args.thing_name
+        region = args.region
+        create_deployment_job(version, thing_name, job_id, account_id, region)